@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+'''Micro-benchmark of splitting a firmware image into flash write blocks.
+
+Compares the bytes slicing loop of esptool.py v2.6 write_flash(), which
+copies the rest of the image for every block, with
+esp32flashengine.iter_blocks(), which slices a memoryview of the image.
+No ESP32 is needed: every block is only checksummed like esptool does
+before it is sent.
+
+   python3 benchmarks/bench_block_iter.py
+   python3 benchmarks/bench_block_iter.py --sizes 1 4 16 --block-size 0x4000
+
+Repository: https://github.com/sunbearc22/ESP32FlashWriter
+'''
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import esptool
+
+import esp32flashengine as engine
+
+
+MB = 1024 * 1024
+
+
+def _consume( block ):
+    # Stands in for esp.flash_block(), which needs the length and checksum.
+    return len( block ) + ( block[0] ^ block[-1] )
+
+
+def slicing_blocks( image, size ):
+    '''The block loop of esptool.py v2.6 write_flash() without compression.'''
+    seq = 0
+    while len(image) > 0:
+        block = image[ 0:size ]
+        # Pad the last block
+        block = block + b'\xff' * ( size - len(block) )
+        _consume( block )
+        image = image[ size: ]
+        seq += 1
+    return seq
+
+
+def memoryview_blocks( image, size ):
+    '''The block loop of esp32flashengine._write_blocks().'''
+    seq = 0
+    for seq, block in engine.iter_blocks( image, size, b'\xff' ):
+        _consume( block )
+    return seq + 1
+
+
+def best_of( func, image, size, repeat ):
+    '''Return the shortest duration of repeat calls of func( image, size ).'''
+    best = None
+    for i in range( repeat ):
+        t = time.perf_counter()
+        func( image, size )
+        t = time.perf_counter() - t
+        best = t if best is None else min( best, t )
+    return best
+
+
+def main( argv=None ):
+    parser = argparse.ArgumentParser( description=__doc__.split( '\n' )[0] )
+    parser.add_argument( '--sizes', type=int, nargs='+', default=[1, 4, 16],
+                         help='image sizes in MB (default: 1 4 16)' )
+    parser.add_argument( '--block-size', type=esptool.arg_auto_int,
+                         default=esptool.ESP32StubLoader.FLASH_WRITE_SIZE,
+                         help='bytes per block (default: 0x4000 of the stub)' )
+    parser.add_argument( '--repeat', type=int, default=3,
+                         help='runs per measurement, the best is shown' )
+    options = parser.parse_args( argv )
+
+    print( 'Block size 0x%x, best of %d runs' % ( options.block_size, options.repeat ) )
+    print( '%8s %8s %12s %12s %9s' % ( 'Image', 'Blocks', 'Slicing s', 'Memoryview s', 'Speedup' ) )
+    for mb in options.sizes:
+        # A size that is not a multiple of the block size checks the padding.
+        image = os.urandom( mb * MB - 0x100 )
+        blocks = memoryview_blocks( image, options.block_size )
+        assert blocks == slicing_blocks( image, options.block_size )
+        old = best_of( slicing_blocks, image, options.block_size, options.repeat )
+        new = best_of( memoryview_blocks, image, options.block_size, options.repeat )
+        print( '%6d MB %8d %12.4f %12.4f %8.1fx' % ( mb, blocks, old, new, old / new ) )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+'''Benchmark of the cost of esp32imagecache.ImageCache against what it saves.
+
+Prepares a firmware image with esp32flashengine.prepare_image() at each
+compression level, and reports:
+   key   -- seconds of ImageCache.key(), the sha256 of the content that every
+            lookup pays, a hit or a miss.
+   none  -- seconds to prepare the image without a cache.
+   miss  -- seconds to prepare it into an empty cache, i.e. with the key and
+            the write of the entry to disk.
+   hit   -- seconds to take it from the disk cache of another process, i.e.
+            with the key, the mapping and the md5 check of the entry.
+   key % -- key as a share of none.
+No ESP32 is needed.
+
+   python3 benchmarks/bench_image_cache.py
+   python3 benchmarks/bench_image_cache.py --sizes 1 4 --levels 1 9 auto
+
+Repository: https://github.com/sunbearc22/ESP32FlashWriter
+'''
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import esptool
+
+import esp32flashengine as engine
+from esp32imagecache import ImageCache
+from bench_write_flash import firmware
+
+
+MB = 1024 * 1024
+ADDRESS = 0x10000
+
+
+def _esp( baud=921600 ):
+    esp = esptool.ESP32ROM.__new__( esptool.ESP32ROM ) #Only its constants and baud are used
+    esp._port = types.SimpleNamespace( baudrate=baud )
+    return esp
+
+
+def _args( level, cache ):
+    args = engine.Args()
+    args.flash_mode = 'dio'
+    args.flash_freq = '40m'
+    args.flash_size = '4MB'
+    args.compress = True
+    args.compress_level = level
+    args.image_cache = cache
+    return args
+
+
+def _prepare( esp, args, path ):
+    t = time.perf_counter()
+    with open( path, 'rb' ) as argfile:
+        engine.prepare_image( esp, args, ADDRESS, argfile )
+    return time.perf_counter() - t
+
+
+def measure( path, level, repeat ):
+    '''Return the median seconds of key, none, miss and hit.'''
+    esp = _esp()
+    runs = { 'key': [], 'none': [], 'miss': [], 'hit': [] }
+    with open( path, 'rb' ) as f:
+        data = f.read()
+    for i in range( repeat ):
+        t = time.perf_counter()
+        ImageCache.key( data, ADDRESS, _args( level, None ), level )
+        runs['key'].append( time.perf_counter() - t )
+        runs['none'].append( _prepare( esp, _args( level, None ), path ) )
+        with tempfile.TemporaryDirectory() as directory:
+            runs['miss'].append( _prepare( esp, _args( level, ImageCache( directory ) ), path ) )
+            #A new ImageCache has nothing in memory, like another process
+            runs['hit'].append( _prepare( esp, _args( level, ImageCache( directory ) ), path ) )
+    return { name: statistics.median( values ) for name, values in runs.items() }
+
+
+def _level( text ):
+    return text if text == 'auto' else int( text )
+
+
+def main( argv=None ):
+    parser = argparse.ArgumentParser( description=__doc__.split( '\n' )[0] )
+    parser.add_argument( '--sizes', type=int, nargs='+', default=[1, 4],
+                         help='image sizes in MB (default: 1 4)' )
+    parser.add_argument( '--levels', type=_level, nargs='+', default=[1, 6, 9, 'auto'],
+                         help='zlib levels or auto (default: 1 6 9 auto)' )
+    parser.add_argument( '--repeat', type=int, default=3,
+                         help='runs of each measurement, the median is reported (default: 3)' )
+    options = parser.parse_args( argv )
+
+    print( '%8s %6s %10s %10s %10s %10s %7s' % ( 'Image', 'Level', 'Key s', 'None s',
+                                                 'Miss s', 'Hit s', 'Key %' ) )
+    for mb in options.sizes:
+        with tempfile.NamedTemporaryFile( suffix='.bin', delete=False ) as f:
+            f.write( firmware( mb * MB ) )
+        try:
+            for level in options.levels:
+                result = measure( f.name, level, options.repeat )
+                print( '%6d MB %6s %10.4f %10.4f %10.4f %10.4f %6.1f%%'
+                       % ( mb, level, result['key'], result['none'], result['miss'],
+                           result['hit'], 100 * result['key'] / result['none'] ) )
+        finally:
+            os.remove( f.name )
+
+
+if __name__ == '__main__':
+    main()
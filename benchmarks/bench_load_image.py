@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+'''Memory benchmark of loading and preparing a firmware image.
+
+Compares the loading of esptool.py v2.6 write_flash(), which reads the file,
+pads it, patches a copy of it and keeps the image and its compressed copy,
+with esp32flashengine.prepare_image(), which hashes and compresses the image
+from esp32flashengine.map_file(). Each way runs in its own process, which
+reports:
+   maxrss -- peak resident memory of the process, including mapped file pages.
+   anon   -- resident memory that is not backed by a file once the image is
+             prepared, i.e. what the OS can't drop under memory pressure.
+No ESP32 is needed.
+
+   python3 benchmarks/bench_load_image.py
+   python3 benchmarks/bench_load_image.py --sizes 4 16 --address 0x1000 --level 1
+
+Repository: https://github.com/sunbearc22/ESP32FlashWriter
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import esptool
+
+import esp32flashengine as engine
+from bench_write_flash import firmware
+
+
+MB = 1024 * 1024
+
+
+def _args( level ):
+    args = engine.Args()
+    args.flash_mode = 'dio'
+    args.flash_freq = '40m'
+    args.flash_size = '4MB'
+    args.compress = level > 0
+    args.compress_level = level
+    return args
+
+
+def read_image( esp, args, address, argfile ):
+    '''The loading of esptool.py v2.6 write_flash().'''
+    image = argfile.read()
+    argfile.seek(0)
+    image = esptool.pad_to( image, 4 )
+    image = esptool._update_image_flash_params( esp, address, args, image )
+    calcmd5 = hashlib.md5( image ).hexdigest()
+    uncimage = image
+    if args.compress:
+        image = zlib.compress( uncimage, args.compress_level )
+    return uncimage, image, calcmd5
+
+
+def _anon_kb():
+    with open( '/proc/self/status' ) as f:
+        for line in f:
+            if line.startswith( 'RssAnon:' ):
+                return int( line.split()[1] )
+    return 0
+
+
+def child( way, path, address, level ):
+    '''Prepare path in this process and print the measurements as JSON.'''
+    esp = esptool.ESP32ROM.__new__( esptool.ESP32ROM ) #Only its constants are used
+    args = _args( level )
+    t = time.perf_counter()
+    with open( path, 'rb' ) as argfile:
+        if way == 'read':
+            prepared = read_image( esp, args, address, argfile )
+        else:
+            prepared = engine.prepare_image( esp, args, address, argfile )
+    seconds = time.perf_counter() - t
+    print( json.dumps( { 'seconds': seconds, 'anon': _anon_kb(),
+                         'maxrss': resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss } ) )
+
+
+def measure( way, path, address, level ):
+    output = subprocess.check_output( [ sys.executable, os.path.abspath( __file__ ),
+                                        '--child', way, path, hex( address ), str( level ) ] )
+    return json.loads( output.decode().splitlines()[-1] ) #After esptool's messages
+
+
+def main( argv=None ):
+    parser = argparse.ArgumentParser( description=__doc__.split( '\n' )[0] )
+    parser.add_argument( '--sizes', type=int, nargs='+', default=[1, 4, 16],
+                         help='image sizes in MB (default: 1 4 16)' )
+    parser.add_argument( '--address', type=esptool.arg_auto_int, default=0x10000,
+                         help='flash offset, 0x1000 patches a bootloader header (default: 0x10000)' )
+    parser.add_argument( '--level', type=int, default=9,
+                         help='zlib level, 0 for no compression (default: 9)' )
+    parser.add_argument( '--child', nargs=4, help=argparse.SUPPRESS )
+    options = parser.parse_args( argv )
+    if options.child:
+        way, path, address, level = options.child
+        child( way, path, int( address, 0 ), int( level ) )
+        return
+
+    print( 'Offset 0x%x, zlib level %d, memory in MB' % ( options.address, options.level ) )
+    print( '%8s %10s %10s %10s %10s %10s %10s' % ( 'Image', 'Read s', 'maxrss', 'anon',
+                                                   'Mmap s', 'maxrss', 'anon' ) )
+    for mb in options.sizes:
+        data = bytearray( firmware( mb * MB ) )
+        data[0] = esptool.ESPLoader.ESP_IMAGE_MAGIC #A bootloader header at 0x1000
+        with tempfile.NamedTemporaryFile( suffix='.bin', delete=False ) as f:
+            f.write( data )
+        try:
+            old = measure( 'read', f.name, options.address, options.level )
+            new = measure( 'mmap', f.name, options.address, options.level )
+        finally:
+            os.remove( f.name )
+        print( '%6d MB %10.3f %10.1f %10.1f %10.3f %10.1f %10.1f'
+               % ( mb, old['seconds'], old['maxrss'] / 1024, old['anon'] / 1024,
+                   new['seconds'], new['maxrss'] / 1024, new['anon'] / 1024 ) )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+'''Wall-time benchmark of preparing the images of a multi-image write.
+
+Writes a job of several synthetic firmware images in two ways:
+   upfront   -- esp32flashengine.prepare_images() prepares every image, then
+                esp32flashengine.write_flash() writes and verifies them, i.e.
+                the host is idle while the ESP32 erases, receives and hashes.
+   pipelined -- esp32flashengine.write_flash() prepares the next image with
+                an ImagePrefetcher while the ESP32 is busy with the previous.
+and reports the time from the first preparation to the last verification,
+the preparation time and the part of it that was hidden.
+
+By default the writes go to an esp32simulator.py started in a separate
+process on a pty, whose spi_flash_md5 hashes at --md5-rate. With --port,
+they go to that port instead.
+
+   python3 benchmarks/bench_pipeline.py
+   python3 benchmarks/bench_pipeline.py --images 4 --size 2 --level 9 --erase-all
+
+Repository: https://github.com/sunbearc22/ESP32FlashWriter
+'''
+
+import argparse
+import contextlib
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import esp32flashengine as engine
+from bench_write_flash import firmware, simulator
+
+
+MB = 1024 * 1024
+
+
+def _args( paths, options ):
+    args = engine.Args()
+    args.chip = 'esp32'
+    args.no_stub = False
+    args.baud = options.baud
+    args.flash_size = '16MB'
+    args.verify = False
+    args.erase_all = options.erase_all
+    args.compress_level = options.level
+    args.stream_compress = options.stream
+    address = 0x10000
+    args.addr_filename = []
+    for path in paths:
+        args.addr_filename.append( ( address, open( path, 'rb' ) ) )
+        address += os.path.getsize( path )
+    return args
+
+
+def run( port, paths, way, options ):
+    '''Write the files paths once and return ( seconds, prepare_seconds,
+    hidden_seconds ).'''
+    args = _args( paths, options )
+    with contextlib.redirect_stdout( sys.stderr ):
+        esp = engine.open_esp( port )
+    try:
+        with contextlib.redirect_stdout( sys.stderr ):
+            esp = engine.setup_esp( esp, args )
+            t = time.time()
+            if way == 'upfront':
+                images = engine.prepare_images( esp, args )
+                prepare_seconds = time.time() - t
+                results = engine.write_flash( esp, args, images )
+                hidden = 0.0
+            else:
+                results = engine.write_flash( esp, args )
+                prepare_seconds = sum( result.prepare_seconds for result in results )
+                hidden = prepare_seconds - sum( result.wait_seconds for result in results )
+            seconds = time.time() - t
+        assert all( result.verified for result in results )
+    finally:
+        esp._port.close()
+        for address, argfile in args.addr_filename:
+            argfile.close()
+    return seconds, prepare_seconds, hidden
+
+
+def _level( text ):
+    return text if text == 'auto' else int( text )
+
+
+def main( argv=None ):
+    parser = argparse.ArgumentParser( description=__doc__.split( '\n' )[0] )
+    parser.add_argument( '--images', type=int, default=3,
+                         help='images per job (default: 3)' )
+    parser.add_argument( '--size', type=float, default=1,
+                         help='size of each image in MB (default: 1)' )
+    parser.add_argument( '--level', type=_level, default=9,
+                         help='zlib level or auto (default: 9)' )
+    parser.add_argument( '--stream', action='store_true',
+                         help='compress while sending, like a single-device write' )
+    parser.add_argument( '--erase-all', action='store_true',
+                         help='erase the entire flash before writing' )
+    parser.add_argument( '--baud', type=int, default=921600,
+                         help='baud to write at (default: 921600)' )
+    parser.add_argument( '--repeat', type=int, default=3,
+                         help='runs of each way, the fastest is reported (default: 3)' )
+    parser.add_argument( '--port', help='write to this port instead of a simulator' )
+    parser.add_argument( '--byte-time', type=float, default=None,
+                         help='simulator seconds per byte (default: 10 bits at the baud)' )
+    parser.add_argument( '--command-latency', type=float, default=0.0,
+                         help='simulator seconds per command' )
+    parser.add_argument( '--md5-rate', type=float, default=2 * MB,
+                         help='simulator bytes per second hashed by spi_flash_md5 '
+                              '(default: 2 MB/s)' )
+    options = parser.parse_args( argv )
+
+    paths = []
+    try:
+        for seed in range( options.images ):
+            with tempfile.NamedTemporaryFile( suffix='.bin', delete=False ) as f:
+                f.write( firmware( int( options.size * MB ), seed ) )
+            paths.append( f.name )
+        print( '%d images of %g MB, zlib level %s%s, %d baud'
+               % ( options.images, options.size, options.level,
+                   ' streamed' if options.stream else '', options.baud ) )
+        print( '%10s %10s %10s %10s' % ( 'Way', 'Total s', 'Prepare s', 'Hidden s' ) )
+        best = {}
+        with simulator( options ) as port:
+            for way in ( 'upfront', 'pipelined' ):
+                runs = [ run( port, paths, way, options ) for i in range( options.repeat ) ]
+                best[way] = min( runs )
+                print( '%10s %10.3f %10.3f %10.3f' % ( ( way, ) + best[way] ) )
+        saved = best['upfront'][0] - best['pipelined'][0]
+        print( 'Saved %.3f seconds (%.1f %%).' % ( saved, 100 * saved / best['upfront'][0] ) )
+    finally:
+        for path in paths:
+            os.remove( path )
+
+
+if __name__ == '__main__':
+    main()
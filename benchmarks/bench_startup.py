@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+'''Startup-time benchmark of the GUI.
+
+Starts esp32flashwriter_v4_2 in fresh processes, from a directory other than
+the repository, in two ways:
+   eager -- esptool.py, pyserial and the esp32 modules are imported before
+            the GUI module, like the GUI did before it imported them lazily.
+   lazy  -- only the GUI module is imported.
+Each process reports:
+   import -- seconds to import the GUI module.
+   paint  -- seconds from the start of the import until the window is first
+             drawn, i.e. after root.update(). Needs a display.
+   probe  -- seconds until the deferred first port scan has run.
+and the modules that were loaded by the first paint.
+
+   python3 benchmarks/bench_startup.py
+   xvfb-run python3 benchmarks/bench_startup.py --repeat 10
+
+Repository: https://github.com/sunbearc22/ESP32FlashWriter
+'''
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+REPO = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+
+#Modules that the GUI should not need to draw its window
+HEAVY = ( 'esptool', 'esp32flashengine', 'serial.tools.list_ports', 'hashlib', 'zlib',
+          'tkinter.filedialog', 'esp32hotplug', 'esp32imagecache' )
+EAGER = ( 'esptool', 'serial.tools.list_ports', 'esp32flashengine', 'esp32gangflash',
+          'esp32hotplug', 'esp32imagecache', 'esp32monitor', 'esp32preflight',
+          'esp32scheduler', 'tkinter.filedialog', 'tkinter.simpledialog',
+          'tkinter.messagebox' )
+
+
+def _loaded( name ):
+    module = sys.modules.get( name )
+    #A module of lazy_import() that is not executed yet is a _LazyModule
+    return module is not None and type( module ).__name__ == 'module'
+
+
+def child( way ):
+    '''Start the GUI in this process and print the measurements as JSON.'''
+    import importlib
+    preloaded = [ name for name in HEAVY if _loaded( name ) ] #e.g. zlib by tempfile
+    t = time.perf_counter()
+    if way == 'eager':
+        for name in EAGER:
+            importlib.import_module( name )
+    import esp32flashwriter_v4_2 as gui
+    result = { 'import': time.perf_counter() - t, 'paint': None, 'probe': None }
+    import tkinter as tk
+    try:
+        root = tk.Tk()
+    except tk.TclError: #No display
+        result['loaded'] = [ name for name in HEAVY
+                             if _loaded( name ) and name not in preloaded ]
+        print( json.dumps( result ) )
+        return
+    app = gui.App( root )
+    app.grid( row=0, column=0, sticky='nsew' )
+    root.update()
+    result['paint'] = time.perf_counter() - t
+    result['loaded'] = [ name for name in HEAVY
+                         if _loaded( name ) and name not in preloaded ]
+    deadline = time.perf_counter() + 10
+    while app.device._hotplug is None and time.perf_counter() < deadline:
+        root.update()
+    if app.device._hotplug is not None:
+        result['probe'] = time.perf_counter() - t
+    app.device.shutdown()
+    root.destroy()
+    print( json.dumps( result ) )
+
+
+def measure( way ):
+    env = dict( os.environ, PYTHONPATH=REPO )
+    with tempfile.TemporaryDirectory() as cwd: #Icons must not depend on the directory
+        output = subprocess.check_output( [ sys.executable, os.path.abspath( __file__ ),
+                                            '--child', way ], cwd=cwd, env=env )
+    return json.loads( output.decode().splitlines()[-1] )
+
+
+def _median( runs, key ):
+    values = [ run[key] for run in runs if run[key] is not None ]
+    return '%10.3f' % statistics.median( values ) if values else '%10s' % '-'
+
+
+def main( argv=None ):
+    parser = argparse.ArgumentParser( description=__doc__.split( '\n' )[0] )
+    parser.add_argument( '--repeat', type=int, default=5,
+                         help='processes started for each way, the median is reported (default: 5)' )
+    parser.add_argument( '--child', help=argparse.SUPPRESS )
+    options = parser.parse_args( argv )
+    if options.child:
+        child( options.child )
+        return
+
+    print( '%6s %10s %10s %10s  %s' % ( 'Way', 'Import s', 'Paint s', 'Probe s',
+                                        'Loaded by the first paint' ) )
+    for way in ( 'eager', 'lazy' ):
+        runs = [ measure( way ) for i in range( options.repeat ) ]
+        print( '%6s %s %s %s  %s' % ( way, _median( runs, 'import' ), _median( runs, 'paint' ),
+                                      _median( runs, 'probe' ),
+                                      ', '.join( runs[-1]['loaded'] ) or 'none' ) )
+
+
+if __name__ == '__main__':
+    main()
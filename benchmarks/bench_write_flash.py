@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+'''Throughput benchmark of the esp32flashengine write path.
+
+Writes a synthetic firmware image for every combination of image size, zlib
+level (0 for no compression, or auto), block size and baud, and measures:
+   seconds     -- per stage: connect, stub (upload, baud change & flash
+                  parameters), prepare (map, hash & compress), erase, write
+                  and md5, and their total.
+   cpu_seconds -- host CPU time of the run.
+   wire_bytes  -- bytes written to and read from the serial port.
+   kbps        -- effective kbit/s of the image over the write stage.
+
+The image is written to a file and goes through the same code as a write
+of the GUI or CLI: esp32flashengine.prepare_image() maps, hashes and
+compresses it, choosing the level for auto, and write_flash() writes it.
+With --stream, the image is compressed while it is written. With --cache,
+it is prepared from a warm esp32imagecache.ImageCache, so prepare measures
+a hit.
+
+By default the writes go to an esp32simulator.py started in a separate
+process, so that its CPU time isn't counted, on a pty. With --port, they go
+to that port instead, e.g. a real ESP32 or a simulator started by hand.
+
+The results are printed as a table on stderr and as JSON on stdout or to
+--output. --compare checks the results against those of an earlier run and
+exits with status 1 when a run got slower by more than --threshold.
+
+   python3 benchmarks/bench_write_flash.py --output before.json
+   python3 benchmarks/bench_write_flash.py --compare before.json
+   python3 benchmarks/bench_write_flash.py --sizes 1 4 --levels 0 1 9 --bauds 921600
+   python3 benchmarks/bench_write_flash.py --levels auto --stream
+
+Repository: https://github.com/sunbearc22/ESP32FlashWriter
+'''
+
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+sys.path.insert( 0, ROOT )
+
+import esptool
+
+import esp32flashengine as engine
+from esp32imagecache import ImageCache
+
+
+MB = 1024 * 1024
+
+
+def firmware( size, seed=1 ):
+    '''Return size bytes that compress about as well as ESP32 firmware: every
+    4 KB holds a random amount of random bytes followed by zeros.'''
+    rng = random.Random( seed )
+    chunks = []
+    for offset in range( 0, size, 0x1000 ):
+        length = min( 0x1000, size - offset )
+        noise = rng.randrange( length + 1 )
+        chunks.append( rng.getrandbits( 8 * noise ).to_bytes( noise, 'little' ) if noise else b'' )
+        chunks.append( b'\x00' * ( length - noise ) )
+    return b''.join( chunks )
+
+
+@contextlib.contextmanager
+def simulator( options ):
+    '''Start esp32simulator.py in a process and yield its port, or yield
+    options.port when it is given.'''
+    if options.port:
+        yield options.port
+        return
+    command = [ sys.executable, '-u', os.path.join( ROOT, 'esp32simulator.py' ),
+                '--flash-size', '16MB' ]
+    if options.byte_time is not None:
+        command += [ '--byte-time', str( options.byte_time ) ]
+    if options.command_latency:
+        command += [ '--command-latency', str( options.command_latency ) ]
+    if getattr( options, 'md5_rate', None ):
+        command += [ '--md5-rate', str( options.md5_rate ) ]
+    process = subprocess.Popen( command, stdout=subprocess.PIPE,
+                                universal_newlines=True )
+    try:
+        line = process.stdout.readline()
+        yield line.split()[-1]
+    finally:
+        process.terminate()
+        process.wait()
+
+
+class WireCounter(object):
+    '''Count the bytes written to and read from a serial port.'''
+
+    def __init__( self, port ):
+        self.bytes = 0
+        self._write = port.write
+        self._read = port.read
+        port.write = self.write
+        port.read = self.read
+
+
+    def write( self, data ):
+        self.bytes += len( data )
+        return self._write( data )
+
+
+    def read( self, size=1 ):
+        data = self._read( size )
+        self.bytes += len( data )
+        return data
+
+
+
+def _args( level, baud, options, cache=None ):
+    '''Return the Args of a write at baud, compressed at zlib level, which
+    may be 'auto', or not compressed for level 0.'''
+    args = engine.Args()
+    args.chip = 'esp32'
+    args.no_stub = False
+    args.baud = baud
+    args.compress = level != 0
+    args.no_compress = not args.compress
+    args.compress_level = level if args.compress else 9
+    args.stream_compress = options.stream
+    args.image_cache = cache
+    args.verify = False
+    return args
+
+
+def prepare( esp, args, path, address ):
+    '''Return the PreparedImage of the file path by
+    esp32flashengine.prepare_image().'''
+    with open( path, 'rb' ) as argfile:
+        return engine.prepare_image( esp, args, address, argfile )
+
+
+def run( port, path, level, block_size, baud, options, cache=None ):
+    '''Write the file path once and return the measurements as a dict.'''
+    args = _args( level, baud, options, cache )
+    seconds = {}
+    cpu = time.process_time()
+    t0 = t = time.time()
+    esp = engine.open_esp( port )
+    try:
+        counter = WireCounter( esp._port )
+        seconds['connect'] = time.time() - t; t = time.time()
+        esp = engine.setup_esp( esp, args )
+        esp.FLASH_WRITE_SIZE = block_size
+        seconds['stub'] = time.time() - t
+        if cache is not None:
+            prepare( esp, args, path, options.offset ) #Warms the cache
+        t = time.time()
+        prepared = prepare( esp, args, path, options.offset )
+        seconds['prepare'] = time.time() - t; t = time.time()
+        if options.erase_all:
+            esp.erase_flash()
+        seconds['erase'] = time.time() - t
+        with contextlib.redirect_stdout( sys.stderr ):
+            result = engine.write_flash( esp, args, [ prepared ] )[0]
+        seconds['write'] = result.seconds
+        seconds['md5'] = result.md5_seconds
+        seconds['total'] = time.time() - t0
+    finally:
+        esp._port.close()
+    return { 'size': result.uncsize, 'level': level, 'block_size': block_size,
+             'baud': baud, 'stream': options.stream, 'cache': cache is not None,
+             'chosen_level': prepared.level if args.compress else 0,
+             'verified': result.verified,
+             'seconds': { stage: round( value, 4 ) for stage, value in seconds.items() },
+             'cpu_seconds': round( time.process_time() - cpu, 4 ),
+             'wire_bytes': counter.bytes,
+             'kbps': round( result.uncsize * 8 / 1000 / result.seconds, 1 ) if result.seconds else None }
+
+
+def _key( result ):
+    return ( result['size'], result['level'], result['block_size'], result['baud'],
+             result.get( 'stream', False ), result.get( 'cache', False ) )
+
+
+def _name( result ):
+    return '%8d B level %4s block 0x%05x %7d baud%s%s' % (
+        result['size'], result['level'], result['block_size'], result['baud'],
+        ' stream' if result.get( 'stream' ) else '', ' cache' if result.get( 'cache' ) else '' )
+
+
+def compare( results, baseline, threshold ):
+    '''Print the change of every run against baseline. Returns the number of
+    runs whose total time grew by more than threshold.'''
+    old = { _key( result ): result for result in baseline['runs'] }
+    regressions = 0
+    for result in results:
+        before = old.get( _key( result ) )
+        if before is None:
+            continue
+        change = result['seconds']['total'] / before['seconds']['total'] - 1
+        flag = ''
+        if change > threshold:
+            regressions += 1
+            flag = '  REGRESSION'
+        print( '%s: %7.3fs -> %7.3fs (%+.1f%%)%s'
+               % ( _name( result ), before['seconds']['total'],
+                   result['seconds']['total'], change * 100, flag ), file=sys.stderr )
+    return regressions
+
+
+def _level( text ):
+    return text if text == 'auto' else int( text )
+
+
+def main( argv=None ):
+    parser = argparse.ArgumentParser( description=__doc__.split( '\n' )[0] )
+    parser.add_argument( '--sizes', type=float, nargs='+', default=[0.5, 1],
+                         help='image sizes in MB (default: 0.5 1)' )
+    parser.add_argument( '--levels', type=_level, nargs='+', default=[0, 1, 6, 9],
+                         help='zlib levels, 0 for no compression, or auto (default: 0 1 6 9)' )
+    parser.add_argument( '--block-sizes', type=esptool.arg_auto_int, nargs='+',
+                         default=[esptool.ESP32StubLoader.FLASH_WRITE_SIZE],
+                         help='bytes per flash block (default: 0x4000)' )
+    parser.add_argument( '--bauds', type=int, nargs='+', default=[460800, 921600],
+                         help='bauds to write at (default: 460800 921600)' )
+    parser.add_argument( '--offset', type=esptool.arg_auto_int, default=0x10000,
+                         help='flash offset of the image (default: 0x10000)' )
+    parser.add_argument( '--stream', action='store_true',
+                         help='compress the image while it is written' )
+    parser.add_argument( '--cache', action='store_true',
+                         help='prepare the image from a warm image cache' )
+    parser.add_argument( '--erase-all', action='store_true',
+                         help='erase the entire flash before each write' )
+    parser.add_argument( '--port', help='write to this port instead of a simulator' )
+    parser.add_argument( '--byte-time', type=float, default=None,
+                         help='simulator seconds per byte (default: 10 bits at the baud)' )
+    parser.add_argument( '--command-latency', type=float, default=0.0,
+                         help='simulator seconds per command' )
+    parser.add_argument( '--output', '-o', help='write the JSON results to this file' )
+    parser.add_argument( '--compare', help='JSON results of an earlier run' )
+    parser.add_argument( '--threshold', type=float, default=0.1,
+                         help='slow down counted as a regression (default: 0.1)' )
+    options = parser.parse_args( argv )
+
+    results = []
+    with simulator( options ) as port, tempfile.TemporaryDirectory() as directory:
+        print( 'Benchmarking on %s' % port, file=sys.stderr )
+        cache = None
+        if options.cache:
+            os.mkdir( os.path.join( directory, 'cache' ) )
+            cache = ImageCache( os.path.join( directory, 'cache' ) )
+        images = {}
+        for mb, level, block_size, baud in itertools.product(
+                options.sizes, options.levels, options.block_sizes, options.bauds ):
+            path = images.get( mb )
+            if path is None:
+                path = images[ mb ] = os.path.join( directory, '%g.bin' % mb )
+                with open( path, 'wb' ) as f:
+                    f.write( firmware( int( mb * MB ) ) )
+            result = run( port, path, level, block_size, baud, options, cache )
+            results.append( result )
+            print( '%s: %7.3fs total, %6.3fs prepare, %7.3fs write, '
+                   '%6.3fs cpu, %9d wire B, %8.1f kbit/s'
+                   % ( _name( result ), result['seconds']['total'], result['seconds']['prepare'],
+                       result['seconds']['write'], result['cpu_seconds'], result['wire_bytes'],
+                       result['kbps'] or 0 ), file=sys.stderr )
+
+    report = { 'meta': { 'time': time.strftime( '%Y-%m-%dT%H:%M:%S' ),
+                         'python': platform.python_version(),
+                         'esptool': esptool.__version__,
+                         'platform': platform.platform(),
+                         'port': options.port or 'simulator',
+                         'byte_time': options.byte_time,
+                         'command_latency': options.command_latency,
+                         'stream': options.stream,
+                         'cache': options.cache },
+               'runs': results }
+    if options.output:
+        with open( options.output, 'w' ) as f:
+            json.dump( report, f, indent=1 )
+    else:
+        print( json.dumps( report, indent=1 ) )
+
+    if options.compare:
+        with open( options.compare ) as f:
+            baseline = json.load( f )
+        if compare( results, baseline, options.threshold ):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit( main() )
@@ -0,0 +1,526 @@
+#!/usr/bin/env python3
+
+'''Headless command line interface of ESP32FlashWriter.
+
+Writes firmware to one or more ESP32 devices without creating the Tk GUI,
+e.g. on CI rigs and bench PCs without a display:
+
+   python3 esp32flashwriter.py --port /dev/ttyUSB0 --offset 0x1000 fw.bin
+   python3 esp32flashwriter.py --all --baud 921600 --json fw.bin
+   python3 esp32flashwriter.py --port /dev/ttyUSB0 --baud auto fw.bin
+   python3 esp32flashwriter.py -p /dev/ttyUSB0 0x1000 bootloader.bin 0x8000 partitions.bin 0x10000 app.bin
+   python3 esp32flashwriter.py -p /dev/ttyUSB0 --baud 921600 --read dump.bin
+   python3 esp32flashwriter.py --boards 50 --workers 4 --baud 921600 fw.bin
+   python3 esp32flashwriter.py --jobs jobs.json
+   python3 esp32flashwriter.py --devices --json
+
+All images of a job are written in one stub session, at one baud change.
+With --read, the flash of one ESP32 is saved to a file instead, see
+esp32flashengine.read_flash(). With --boards or --jobs, the writes are jobs
+of an esp32scheduler.FlashScheduler, which retries transient failures. A
+jobs file is a JSON list of objects like:
+
+   { "mac": "24:0a:c4:00:01:02",             # or "port": "/dev/ttyUSB0"
+     "images": [ [ "0x1000", "bootloader.bin" ], [ "0x10000", "app.bin" ] ],
+     "options": { "baud": 921600 }, "priority": 1 }
+
+where "images" defaults to the firmware files given on the command line.
+With --devices, the boards of esp32registry, i.e. their chip info, last
+baud and last firmware, are listed without opening any port.
+
+The same esp32flashengine.Args and esp32flashengine.write_flash() that are
+used by the GUI do the work. When more than one port is given, the devices
+are written in parallel by esp32gangflash.GangFlasher.
+
+The exit status is one of EXIT_OK, EXIT_FAILED, EXIT_USAGE or EXIT_NO_DEVICE.
+With --json, a timing summary is printed to stdout as one JSON object and
+all other messages go to stderr.
+
+Repository: https://github.com/sunbearc22/ESP32FlashWriter
+'''
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+
+from serial.serialutil import SerialException
+import esptool
+
+import esp32flashengine as engine
+import esp32log
+import esp32metrics
+import esp32preflight as preflight
+import esp32registry
+from esp32flashengine import Args
+from esp32gangflash import GangFlasher, GangDevice
+from esp32imagecache import ImageCache
+from esp32scheduler import FlashScheduler, FlashJob
+
+
+EXIT_OK        = 0 #Every device was written and verified
+EXIT_FAILED    = 1 #At least one device failed
+EXIT_USAGE     = 2 #Invalid arguments (argparse also uses 2)
+EXIT_NO_DEVICE = 3 #No port to write to
+
+JOBS_BOARD_TIMEOUT = 60 #Default seconds a job of --jobs waits for its board
+
+
+def _baud( text ):
+    '''argparse type of --baud: an int or 'auto'.'''
+    if text == 'auto':
+        return text
+    try:
+        return int( text )
+    except ValueError:
+        raise argparse.ArgumentTypeError( 'invalid baud: {}'.format( text ) )
+
+
+def _level( text ):
+    '''argparse type of --compress-level: 1 to 9 or 'auto'.'''
+    if text == 'auto':
+        return text
+    if text.isdigit() and 1 <= int( text ) <= 9:
+        return int( text )
+    raise argparse.ArgumentTypeError( 'invalid level: {}'.format( text ) )
+
+
+def _parse_args( argv ):
+    parser = argparse.ArgumentParser(
+        prog='esp32flashwriter.py',
+        description='Write firmware to ESP32 flash without the GUI. '
+                    'Run without arguments to start the GUI.' )
+    parser.add_argument( '--port', '-p', action='append', default=[],
+                         help='serial port of the ESP32, may be repeated' )
+    parser.add_argument( '--all', action='store_true',
+                         help='write to every detected ESP32 in parallel' )
+    parser.add_argument( '--baud', '-b', type=_baud,
+                         default=esptool.ESPLoader.ESP_ROM_BAUD,
+                         help='baud to write flash, or auto for the fastest '
+                              'reliable baud (default: %(default)s)' )
+    parser.add_argument( '--offset', '-o', type=esptool.arg_auto_int,
+                         default=0x1000,
+                         help='flash offset of the firmware (default: 0x1000)' )
+    parser.add_argument( '--flash-size', default='detect',
+                         choices=['detect'] + sorted( esptool.ESP32ROM.FLASH_SIZES ),
+                         help='flash size (default: %(default)s)' )
+    parser.add_argument( '--erase-all', action='store_true',
+                         help='erase the entire flash before writing' )
+    parser.add_argument( '--delta', action='store_true',
+                         help='only write the flash sectors that differ from the firmware' )
+    parser.add_argument( '--compress-level', type=_level, default='auto',
+                         help='zlib level 1-9, or auto for the level that is '
+                              'predicted to write fastest (default: %(default)s)' )
+    parser.add_argument( '--no-compress', action='store_true',
+                         help='send the firmware uncompressed' )
+    parser.add_argument( '--no-cache', action='store_true',
+                         help='prepare the firmware again instead of using the image cache' )
+    parser.add_argument( '--json', action='store_true',
+                         help='print a machine-readable summary to stdout' )
+    parser.add_argument( '--read', metavar='FILE',
+                         help='save the flash of one ESP32 to FILE instead of writing' )
+    parser.add_argument( '--read-offset', type=esptool.arg_auto_int, default=0,
+                         help='flash offset to read from (default: 0)' )
+    parser.add_argument( '--read-size', type=esptool.arg_auto_int, default=None,
+                         help='bytes to read (default: to the end of the flash)' )
+    parser.add_argument( '--boards', type=int, default=0, metavar='N',
+                         help='write N boards, each on whichever port a new board '
+                              'is found, with retries' )
+    parser.add_argument( '--jobs', metavar='FILE',
+                         help='run the jobs of a JSON file, with retries' )
+    parser.add_argument( '--workers', type=int, default=4,
+                         help='boards written at once by --boards and --jobs (default: 4)' )
+    parser.add_argument( '--retries', type=int, default=3,
+                         help='attempts after a transient failure of a job (default: 3)' )
+    parser.add_argument( '--board-timeout', type=float, default=None, metavar='SECONDS',
+                         help='fail a job of --boards or --jobs when no board for it is '
+                              'plugged in for SECONDS, 0 to wait forever '
+                              '(default: %d for --jobs, forever for --boards)' % JOBS_BOARD_TIMEOUT )
+    parser.add_argument( '--devices', action='store_true',
+                         help='list the boards seen before, without opening any port' )
+    parser.add_argument( '--log-level', default=None,
+                         choices=[ 'DEBUG', 'INFO', 'WARNING', 'ERROR' ],
+                         help='level of the messages logged to stderr (default: INFO)' )
+    parser.add_argument( '--log-json', action='store_true', default=None,
+                         help='log one JSON object per line' )
+    parser.add_argument( '--log-file', metavar='FILE',
+                         help='also log to FILE' )
+    parser.add_argument( '--metrics', metavar='DIR',
+                         help='directory of the stage timing metrics '
+                              '(default: ~/.esp32flashwriter/metrics)' )
+    parser.add_argument( '--no-metrics', action='store_true',
+                         help="don't write the stage timing metrics" )
+    parser.add_argument( 'images', nargs='*', metavar='[OFFSET] FILE',
+                         help='firmware file written at --offset, or pairs of '
+                              'offset and file, e.g. 0x1000 bootloader.bin 0x10000 app.bin' )
+    options = parser.parse_args( argv )
+    if options.devices:
+        options.addr_filename = []
+        return options
+    if options.read:
+        if options.images:
+            parser.error( 'give either firmware files or --read' )
+        if options.all or len( options.port ) > 1:
+            parser.error( '--read takes a single --port' )
+        options.addr_filename = []
+        return options
+    if options.jobs and not options.images:
+        options.addr_filename = []
+        return options
+    if not options.images:
+        parser.error( 'give a firmware file or --read' )
+    options.addr_filename = _addr_filename( parser, options )
+    return options
+
+
+def _addr_filename( parser, options ):
+    '''Return a list of ( offset, filename ) of options.images.'''
+    images = options.images
+    if len( images ) == 1:
+        return [ ( options.offset, images[0] ) ]
+    if len( images ) % 2:
+        parser.error( 'give one firmware file or pairs of offset and file' )
+    pairs = []
+    for offset, filename in zip( images[0::2], images[1::2] ):
+        try:
+            pairs.append( ( esptool.arg_auto_int( offset ), filename ) )
+        except ValueError:
+            parser.error( 'invalid offset: {}'.format( offset ) )
+    return pairs
+
+
+def _create_args( options ):
+    '''Return an esp32flashengine.Args for options, or None when the file
+    can't be opened.'''
+    args = Args()
+    args.chip = 'esp32'
+    args.no_stub = False
+    if options.baud == 'auto':
+        args.auto_baud = True
+        args.baud = esptool.ESPLoader.ESP_ROM_BAUD
+    else:
+        args.baud = options.baud
+    args.flash_size = options.flash_size
+    args.erase_all = options.erase_all
+    args.delta = options.delta
+    args.compress = not options.no_compress
+    args.no_compress = options.no_compress
+    args.compress_level = options.compress_level
+    if not options.no_cache:
+        args.image_cache = ImageCache()
+    args.addr_filename = []
+    try:
+        for offset, filename in options.addr_filename:
+            args.addr_filename.append( ( offset, open( filename, 'rb' ) ) )
+    except IOError as err:
+        print( err, file=sys.stderr )
+        for offset, argfile in args.addr_filename:
+            argfile.close()
+        return None
+    return args
+
+
+def _results_summary( results ):
+    return [ { 'address': result.address,
+               'bytes': result.uncsize,
+               'written': result.written,
+               'skipped': result.skipped,
+               'seconds': round( result.seconds, 3 ),
+               'compare_seconds': round( result.compare_seconds, 3 ),
+               'prepare_seconds': round( result.prepare_seconds, 3 ),
+               'prepare_wait_seconds': round( result.wait_seconds, 3 ),
+               'md5': result.md5,
+               'verified': result.verified } for result in results ]
+
+
+def flash_port( port, args ):
+    '''Write args.addr_filename to the ESP32 on port. Returns a summary dict.'''
+    summary = { 'port': port, 'ok': False, 'error': None, 'images': [] }
+    timing = summary['seconds'] = {}
+    t0 = t = time.time()
+    esp = None
+    esp32log.set_context( port=port )
+    args.metrics = esp32metrics.Session( 'write', port )
+    summary['session'] = args.metrics.id
+    try:
+        esp = engine.open_esp( port, metrics=args.metrics )
+        with args.metrics.stage( 'read_mac' ):
+            summary['mac'] = args.metrics.mac = engine.mac_address( esp )
+        esp32log.update_context( mac=summary['mac'] )
+        timing['connect'] = round( time.time() - t, 3 ); t = time.time()
+        esp = engine.setup_esp( esp, args )
+        timing['setup'] = round( time.time() - t, 3 ); t = time.time()
+        results = engine.write_flash( esp, args )
+        timing['write'] = round( time.time() - t, 3 )
+        summary['images'] = _results_summary( results )
+        esp32registry.record_write( summary['mac'], results, esp._port.baudrate, port )
+        engine.hard_reset( esp )
+    except ( esptool.FatalError, SerialException, OSError ) as err:
+        summary['error'] = str( err )
+    else:
+        summary['ok'] = True
+    finally:
+        if esp:
+            esp._port.close()
+    timing['total'] = round( time.time() - t0, 3 )
+    args.metrics.finish( summary['error'] )
+    esp32metrics.export( args.metrics )
+    return summary
+
+
+def read_port( port, args, options ):
+    '''Save the flash of the ESP32 on port to options.read. Returns a summary
+    dict like flash_port().'''
+    summary = { 'port': port, 'ok': False, 'error': None, 'images': [] }
+    timing = summary['seconds'] = {}
+    t0 = t = time.time()
+    esp = None
+    esp32log.set_context( port=port )
+    args.metrics = esp32metrics.Session( 'read', port )
+    summary['session'] = args.metrics.id
+    try:
+        esp = engine.open_esp( port, metrics=args.metrics )
+        timing['connect'] = round( time.time() - t, 3 ); t = time.time()
+        esp = engine.setup_esp( esp, args )
+        timing['setup'] = round( time.time() - t, 3 ); t = time.time()
+        size = options.read_size
+        if size is None:
+            #setup_esp() has detected args.flash_size
+            size = esptool.flash_size_bytes( args.flash_size ) - options.read_offset
+        with open( options.read, 'wb' ) as outfile:
+            try:
+                result = engine.read_flash( esp, args, options.read_offset, size, outfile )
+            except ( esptool.FatalError, SerialException, OSError ):
+                outfile.close()
+                os.remove( options.read ) #Don't leave a partial dump
+                raise
+        timing['read'] = round( result.seconds, 3 )
+        timing['verify'] = round( result.md5_seconds, 3 )
+        summary['read'] = { 'file': options.read,
+                            'address': result.address,
+                            'bytes': result.size,
+                            'kbps': round( result.size / result.seconds * 8 / 1000, 1 )
+                                    if result.seconds else None,
+                            'md5': result.md5,
+                            'verified': result.verified }
+        engine.hard_reset( esp )
+    except ( esptool.FatalError, SerialException, OSError ) as err:
+        summary['error'] = str( err )
+    else:
+        summary['ok'] = True
+    finally:
+        if esp:
+            esp._port.close()
+    timing['total'] = round( time.time() - t0, 3 )
+    args.metrics.finish( summary['error'] )
+    esp32metrics.export( args.metrics )
+    return summary
+
+
+def gang_flash( ports, args ):
+    '''Write args.addr_filename to the ESP32 on every port in parallel.
+    Returns a list of summary dicts.'''
+    gang = GangFlasher( ports, args )
+    gang.start()
+    gang.join()
+    return [ { 'port': device.port,
+               'mac': device.mac,
+               'ok': device.state == GangDevice.DONE,
+               'error': str( device.error ) if device.error else None,
+               'images': _results_summary( device.results ),
+               'seconds': { 'total': round( device.seconds, 3 ) } }
+             for device in gang.devices ]
+
+
+def _create_jobs( options ):
+    '''Return a list of FlashJob for options.jobs and options.boards.'''
+    jobs = []
+    if options.jobs:
+        with open( options.jobs ) as f:
+            entries = json.load( f )
+        for entry in entries:
+            images = options.addr_filename
+            if 'images' in entry:
+                images = [ ( esptool.arg_auto_int( str( offset ) ), filename )
+                           for offset, filename in entry['images'] ]
+            if not images:
+                raise ValueError( 'Job without images: {}'.format( entry ) )
+            jobs.append( FlashJob( entry.get( 'port' ) or entry.get( 'mac' ), images,
+                                   entry.get( 'options' ), entry.get( 'priority', 0 ) ) )
+    for i in range( options.boards ):
+        jobs.append( FlashJob( None, options.addr_filename ) )
+    return jobs
+
+
+def schedule( jobs, args, options ):
+    '''Run jobs on a FlashScheduler until each is done or failed, or until
+    Ctrl-C. Returns the scheduler.'''
+    if options.port:
+        find_ports = lambda: list( options.port )
+    else:
+        find_ports = engine.find_ports
+    board_timeout = options.board_timeout
+    if board_timeout is None:
+        board_timeout = None if options.boards else JOBS_BOARD_TIMEOUT
+    scheduler = FlashScheduler( options.workers, options.retries, args=args,
+                                find_ports=find_ports, board_timeout=board_timeout or None )
+    for job in jobs:
+        scheduler.submit( job )
+    scheduler.start()
+    last = None
+    try:
+        while not scheduler.join( timeout=1.0 ):
+            summary = scheduler.summary()
+            if summary != last:
+                print( summary, file=sys.stderr )
+                last = summary
+    except KeyboardInterrupt:
+        print( 'Cancelling....', file=sys.stderr )
+        scheduler.stop( cancel=True )
+        scheduler.join()
+    return scheduler
+
+
+def _jobs_summary( scheduler ):
+    return [ { 'job': job.id,
+               'selector': job.selector,
+               'port': job.port,
+               'mac': job.mac,
+               'state': job.state,
+               'attempts': job.attempts,
+               'ok': job.state == FlashJob.DONE,
+               'error': str( job.error ) if job.error else None,
+               'images': _results_summary( job.results ),
+               'seconds': { 'total': round( job.seconds, 3 ) } }
+             for job in scheduler.jobs ]
+
+
+def _schedule_main( options ):
+    args = _create_args( options )
+    if args is None:
+        return EXIT_USAGE
+    for address, argfile in args.addr_filename:
+        argfile.close()
+    args.addr_filename = []
+    args.stream_compress = True #Each job writes one device
+    try:
+        jobs = _create_jobs( options )
+    except ( OSError, ValueError, KeyError, TypeError ) as err:
+        print( 'Invalid jobs file: {}'.format( err ), file=sys.stderr )
+        return EXIT_USAGE
+    t = time.time()
+    out = sys.stderr if options.json else sys.stdout
+    with contextlib.redirect_stdout( out ):
+        try:
+            scheduler = schedule( jobs, args, options )
+        except ( esptool.FatalError, OSError, ValueError ) as err:
+            print( err, file=sys.stderr )
+            return EXIT_USAGE
+    return _report( _jobs_summary( scheduler ), t, options, scheduler.stats() )
+
+
+def main( argv=None ):
+    '''Entry point. Returns the exit status.'''
+    options = _parse_args( argv )
+    esp32log.setup( options.log_level, options.log_json, filename=options.log_file )
+    esp32metrics.configure( options.metrics, not options.no_metrics )
+    if options.devices:
+        return _devices_main( options )
+    if options.boards or options.jobs:
+        return _schedule_main( options )
+    ports = options.port
+    if options.all:
+        ports = ports + [ port for port in engine.find_ports() if port not in ports ]
+    if not ports:
+        print( 'No ESP32 port given or found.', file=sys.stderr )
+        return EXIT_NO_DEVICE
+
+    args = _create_args( options )
+    if args is None:
+        return EXIT_USAGE
+    if options.read:
+        return _read_main( ports[0], args, options )
+    try:
+        engine.check_overlap( args )
+        preflight.check_args( args )
+    except ( esptool.FatalError, OSError ) as err:
+        print( err, file=sys.stderr )
+        for address, argfile in args.addr_filename:
+            argfile.close()
+        return EXIT_USAGE
+
+    t = time.time()
+    # Keep stdout clean for the JSON summary.
+    out = sys.stderr if options.json else sys.stdout
+    with contextlib.redirect_stdout( out ):
+        if len( ports ) == 1:
+            #Compress while sending; a gang shares one compressed image instead.
+            args.stream_compress = True
+            devices = [ flash_port( ports[0], args ) ]
+        else:
+            devices = gang_flash( ports, args )
+    for address, argfile in args.addr_filename:
+        argfile.close()
+
+    return _report( devices, t, options )
+
+
+def _devices_main( options ):
+    '''Print the records of esp32registry. Returns the exit status.'''
+    devices = esp32registry.devices()
+    if options.json:
+        print( json.dumps( { 'devices': devices } ) )
+        return EXIT_OK
+    for device in devices:
+        firmware = ', '.join( '0x{:x} {}'.format( image['address'], image['md5'] )
+                              for image in device.get( 'firmware', [] ) )
+        print( '{}: {} {} on {}, {} baud, firmware: {}'.format(
+            device['mac'], device.get( 'description' ) or '-', device.get( 'flashsize' ) or '-',
+            device.get( 'port' ), device.get( 'baud', '-' ), firmware or 'unknown' ) )
+    print( 'Total: {} devices'.format( len( devices ) ) )
+    return EXIT_OK
+
+
+def _read_main( port, args, options ):
+    t = time.time()
+    out = sys.stderr if options.json else sys.stdout
+    with contextlib.redirect_stdout( out ):
+        devices = [ read_port( port, args, options ) ]
+    return _report( devices, t, options )
+
+
+def _report( devices, t, options, stats=None ):
+    '''Print the summary of devices since time t and the stats of a
+    scheduler. Returns the exit status.'''
+    ok = all( device['ok'] for device in devices )
+    summary = { 'ok': ok,
+                'exit_status': EXIT_OK if ok else EXIT_FAILED,
+                'seconds': round( time.time() - t, 3 ),
+                'devices': devices }
+    if stats is not None:
+        summary['scheduler'] = stats
+    if options.json:
+        print( json.dumps( summary ) )
+    else:
+        for device in devices:
+            if device['ok'] and options.read:
+                read = device['read']
+                print( '{}: OK {} bytes read to {} in {} seconds, MD5 {}'.format(
+                    device['port'], read['bytes'], read['file'], device['seconds']['total'],
+                    read['md5'] ) )
+            elif device['ok']:
+                written = sum( image['bytes'] for image in device['images'] )
+                print( '{}: OK {} bytes in {} seconds'.format(
+                    device['port'], written, device['seconds']['total'] ) )
+            else:
+                print( '{}: FAILED {}'.format( device['port'], device['error'] ) )
+        if stats is not None:
+            print( 'Failures: {}'.format( stats['failures'] or 'none' ) )
+        print( 'Total: {} seconds'.format( summary['seconds'] ) )
+    return summary['exit_status']
+
+
+if __name__ == '__main__':
+    sys.exit( main() )
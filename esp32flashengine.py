@@ -0,0 +1,1263 @@
+#!/usr/bin/env python3
+
+'''Flashing engine of ESP32FlashWriter.
+
+The functions in this module talk to ESP32 devices through esptool.py without
+creating any Tk widget. They are used by the GUI in esp32flashwriter_v4_2.py
+and by esp32gangflash.py, which drives many devices at the same time.
+
+Progress is reported through plain callables:
+   status( msg )                     -- a one line description of the stage.
+   progress( report )                -- called with a ProgressReport at a
+                                        rate limited by a ProgressReporter.
+A write is cancelled by setting a threading.Event given as cancel.
+Messages are logged to the 'esp32flashwriter.engine' logger, see esp32log;
+those of esptool.py itself are still printed.
+
+Repository: https://github.com/sunbearc22/ESP32FlashWriter
+'''
+
+import hashlib
+import io
+import mmap
+import os
+import platform
+import queue
+import struct
+import threading
+import time
+import zlib
+
+import serial.tools.list_ports
+from serial.serialutil import SerialException
+import esptool
+
+import esp32log
+import esp32metrics
+import esp32registry
+import esp32settings
+
+log = esp32log.get_logger( 'engine' )
+
+
+class Args(object):
+
+    def __init__( self ):
+        self.chip = None
+        self.port = None
+        #self.baud = esptool.ESPLoader.ESP_ROM_BAUD
+        self.baud = None
+        self.before = 'default_reset'
+        self.after = 'hard_reset'
+        self.no_stub = True
+        self.trace = True
+        self.override_vddsdio = "Off"
+
+        self.spi_connection = None
+
+        #positional arguments:
+        #load_ram
+        self.load_ram = None
+        self.filename = None
+
+        #dump_mem
+        self.dump_mem = None
+        self.address = None
+        self.size = None
+        self.filename = None
+
+        #read_mem
+        self.read_mem = None
+        self.address = None
+
+        #write_mem
+        self.write_mem = None
+        self.address = None
+        self.value = None
+        self.mask = None
+
+        #spi_flash
+        self.flash_freq = '40m'
+        self.flash_mode = 'dio' #Needs 'dio' to work
+        self.flash_size = 'detect'
+        #self.flash_size = '4MB'
+
+        #write_flash
+        self.write_flash = None
+        self.erase_all = False
+        self.addr_filename = None
+        self.no_progress = True
+        self.progress_rate = 10.0          #Max progress reports per second
+        self.progress_per_percent = False  #Also report every whole percent
+        self.verify = True
+        self.compress = True
+        self.no_compress = False
+        self.stream_compress = False #Compress while sending; see StreamCompressor
+        self.image_cache = None      #esp32imagecache.ImageCache of prepared images
+        self.delta = False           #Only write the sectors that differ; see find_changed_segments
+        self.delta_region = 0x10000  #Bytes per flash_md5sum before comparing sectors
+        self.auto_baud = False       #Use the fastest reliable baud; see auto_baud
+        self.compress_level = 9      #zlib level, or 'auto'; see choose_compress_level
+        self.metrics = None          #esp32metrics.Session timing the stages
+
+
+
+class PreparedImage(object):
+    '''A firmware image that is padded, patched, hashed and, if needed, compressed.
+
+    A PreparedImage holds no reference to an esp or to an open file, so one
+    instance can be written to any number of ESP32 devices.'''
+
+    def __init__( self, address, name, image, calcmd5, compressed=None, level=9 ):
+        self.address = address       #Flash offset
+        self.name = name             #Name of the source file
+        self.image = image           #Padded & patched image, bytes or a mmap
+        self.level = level           #zlib level of self.compressed or of a streamed write
+        self.predicted = None        #Seconds to compress & send predicted for self.level
+        self.compress_seconds = 0.0  #Seconds spent on compressing self.compressed
+        self.calcmd5 = calcmd5       #Hex md5 digest of self.image
+        self.uncsize = len( image )
+        self.compressed = compressed #zlib stream of self.image or None
+
+
+
+class WriteCancelled(esptool.FatalError):
+    '''Raised by write_flash() when its cancel event is set.'''
+
+    def __init__( self ):
+        super().__init__( 'Write cancelled.' )
+
+
+
+class ReadCancelled(esptool.FatalError):
+    '''Raised by read_flash() when its cancel event is set. The stub is left
+    sending the rest of the region, so esp has to be connected again.'''
+
+    def __init__( self ):
+        super().__init__( 'Read cancelled.' )
+
+
+
+class ProgressReport(object):
+    '''Progress of the write of one image, or of a read_flash().'''
+
+    def __init__( self, address, sent, total, seconds, verb='Writing' ):
+        self.address = address #Flash address being written
+        self.sent = sent       #Bytes sent over serial so far
+        self.total = total     #Bytes to send over serial for this image
+        self.seconds = seconds #Time since the first block was sent
+        self.verb = verb       #'Writing' or 'Reading'
+        self.percent = 100 * sent // total if total else 100
+        self.kbps = sent / seconds * 8 / 1000 if seconds > 0.0 else 0.0
+        if sent and seconds > 0.0:
+            self.eta = ( total - sent ) * seconds / sent #Seconds left
+        else:
+            self.eta = None
+
+
+    def __str__( self ):
+        msg = '%s at 0x%08x... (%d %%)' % ( self.verb, self.address, self.percent )
+        if self.kbps:
+            msg += ' %.1f kbit/s' % self.kbps
+        if self.eta is not None and self.sent < self.total:
+            msg += ', %.0fs left' % self.eta
+        return msg
+
+
+
+class ProgressReporter(object):
+    '''Coalesce per-block progress into at most rate reports per second.
+
+    callback( report ) is called with a ProgressReport when 1/rate seconds
+    have passed since the previous report or, if per_percent is True, when
+    the whole percent changes. The first and the last block are always
+    reported, so the final totals are exact whatever the rate.'''
+
+    def __init__( self, callback, rate=10.0, per_percent=False, verb='Writing' ):
+        self.callback = callback
+        self.verb = verb
+        self.interval = 1.0 / rate if rate else float( 'inf' )
+        self.per_percent = per_percent
+        self.reports = 0 #Number of reports made
+        self._total = 0
+        self._t0 = self._last = 0.0
+        self._percent = -1
+
+
+    def start( self, total ):
+        '''Begin reporting the write of total bytes.'''
+        self._total = total
+        self._t0 = time.time()
+        self._last = None
+        self._percent = -1
+
+
+    def update( self, address, sent ):
+        now = time.time()
+        percent = 100 * sent // self._total if self._total else 100
+        if ( self._last is None or sent >= self._total
+             or now - self._last >= self.interval
+             or ( self.per_percent and percent != self._percent ) ):
+            self._last = now
+            self._percent = percent
+            self.reports += 1
+            self.callback( ProgressReport( address, sent, self._total, now - self._t0,
+                                           self.verb ) )
+
+
+
+class StreamCompressor(object):
+    '''Compress an image segment by segment in a producer thread.
+
+    Iterating yields ( offset, length, compressed ) for each segment of the
+    image in order, while the following segments are being compressed. zlib
+    releases the GIL while it compresses, so compression and the serial
+    transfer of the previous segment overlap.
+
+    Segments are sector aligned: the first one is first bytes long, so that
+    it is compressed in a few milliseconds, and the others are size bytes.
+    At most depth compressed segments wait to be sent.'''
+
+    def __init__( self, image, level=9, first=0x10000, size=0x40000, depth=2,
+                  segments=None ):
+        self.image = image
+        self.level = level
+        self.first = first
+        self.size = size
+        self._segments = segments
+        self._queue = queue.Queue( maxsize=depth )
+        self._stop = threading.Event()
+        self._context = esp32log.get_context() #Of the device, for the producer thread
+        self._thread = threading.Thread( target=self._produce,
+                                         name='compressor', daemon=True )
+        self._thread.start()
+
+
+    def segments( self ):
+        '''Return a list of ( offset, length ) of the segments of self.image,
+        or the segments given when created, e.g. the changed sectors only.'''
+        if self._segments is not None:
+            return self._segments
+        segments = []
+        offset = 0
+        length = self.first
+        while offset < len( self.image ):
+            length = min( length, len( self.image ) - offset )
+            segments.append( ( offset, length ) )
+            offset += length
+            length = self.size
+        return segments
+
+
+    def _produce( self ):
+        esp32log.set_context( **self._context )
+        try:
+            for offset, length in self.segments():
+                compressed = zlib.compress( memoryview( self.image )[offset:offset+length],
+                                            self.level )
+                if not self._put( ( offset, length, compressed ) ):
+                    return
+        except Exception as err:
+            self._put( err )
+            return
+        self._put( None )
+
+
+    def _put( self, item ):
+        '''Queue item unless self.close() is called. Returns False if closed.'''
+        while not self._stop.is_set():
+            try:
+                self._queue.put( item, timeout=0.1 )
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+    def __iter__( self ):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if isinstance( item, Exception ):
+                raise item
+            yield item
+
+
+    def close( self ):
+        '''Stop the producer thread, e.g. when a write is cancelled.'''
+        self._stop.set()
+        self._thread.join()
+
+
+
+class WriteResult(object):
+    '''Outcome of writing one PreparedImage to flash.'''
+
+    def __init__( self, address, uncsize, written, seconds, skipped=0 ):
+        self.address = address
+        self.uncsize = uncsize #Bytes of image
+        self.written = written #Bytes sent over serial (compressed or padded)
+        self.seconds = seconds #Duration of the block transfer
+        self.skipped = skipped #Bytes of image not written as already in flash
+        self.compare_seconds = 0.0 #Duration of the delta comparison with flash
+        self.md5_seconds = 0.0 #Duration of the flash md5 check
+        self.verified = False  #True when flash md5 matched the image md5
+        self.prepare_seconds = 0.0 #Duration of the preparation of the image
+        self.wait_seconds = 0.0    #Part of self.prepare_seconds the write waited for
+        self.md5 = None            #Hex md5 digest of the image
+
+
+
+class ReadResult(object):
+    '''Outcome of reading a region of flash to a file.'''
+
+    def __init__( self, address, size, seconds, md5 ):
+        self.address = address #Flash offset of the region
+        self.size = size       #Bytes read
+        self.seconds = seconds #Duration of the transfer
+        self.md5 = md5         #Hex md5 digest of the bytes read
+        self.md5_seconds = 0.0 #Duration of the flash md5 check
+        self.verified = False  #True when the flash md5 of the region matched self.md5
+
+
+
+def _no_status( msg ):
+    pass
+
+
+def find_ports():
+    '''Return a sorted list of the serial ports that may host an ESP32.
+
+    The ports in the ESP32_EXTRA_PORTS environment variable, separated by
+    os.pathsep, are added, e.g. the /dev/pts/N of an esp32simulator.'''
+    # In module "serial.tools.list_ports", its .grep() method returns
+    #  an iterable of its ListPortInfo class object
+    if 'Linux' in platform.system():
+        devices = [ port.device for port in serial.tools.list_ports.grep('ttyUSB|ttyACM') ]
+    elif 'Windows' in platform.system():
+        devices = [ port.device for port in serial.tools.list_ports.comports() ]
+    else:
+        devices = []
+    extra = os.environ.get( 'ESP32_EXTRA_PORTS', '' )
+    devices += [ port for port in extra.split( os.pathsep ) if port ]
+    return sorted( set( devices ) )
+
+
+def is_pty( port ):
+    '''Return True if port is a pseudo-terminal, e.g. of an esp32simulator.'''
+    return os.path.realpath( port ).startswith( '/dev/pts/' )
+
+
+def connect( esp ):
+    '''Connect esp, which resets the ESP32 into its bootloader.
+
+    A pty has no DTR & RTS lines to reset with, so it is synced as is.'''
+    mode = 'no_reset' if is_pty( esp._port.port ) else 'default_reset'
+    esp.connect( mode )
+
+
+def hard_reset( esp ):
+    '''Hard reset the ESP32 via the RTS pin to run its firmware.'''
+    if not is_pty( esp._port.port ):
+        esp.hard_reset()
+
+
+def port_is_busy( port ):
+    '''Return True if port is used by another application.'''
+    if 'Linux' in platform.system():
+        #Check if picocom or minicom is using the port
+        portname = os.path.basename( port )
+        linux_lock = "/var/lock/"
+        try:
+            files = os.listdir( linux_lock )
+        except OSError:
+            files = []
+        for file in files:
+           filename = os.path.basename( file )
+           if portname in filename:
+               log.info( 'picocom or minicom is using port' )
+               return True
+
+        #Todo: Need a more general algorithim to determine whether the port is
+        #      used by other applications.
+
+        log.debug( 'ESP32 is available.' )
+        return False #port is not busy
+
+    #Windows: treat port as not busy; no algorithm yet.
+    #To do: Need an appropriate algorithm
+    return False
+
+
+def open_esp( port, baud=esptool.ESPLoader.ESP_ROM_BAUD, metrics=None ):
+    '''Return an esptool.ESP32ROM instance that is connected to port.
+
+    The opening and connecting are timed as stages of metrics, an
+    esp32metrics.Session, if given.'''
+    with esp32metrics.timed( metrics, 'open' ):
+        esp = esptool.ESP32ROM( port, baud )
+    try:
+        with esp32metrics.timed( metrics, 'connect' ):
+            connect( esp )
+    except Exception:
+        esp._port.close()
+        raise
+    return esp
+
+
+def mac_address( esp ):
+    '''Return the mac of a connected esp as e.g. '24:0a:c4:00:01:02'.'''
+    # '02x' means use at least 2 digits with zeros to pad to length,
+    #       and x means lower-case hexadecimal.
+    return ':'.join( format(x,'02x') for x in esp.read_mac() )
+
+
+def get_chip_info( esp, mac=None ):
+    '''Return a dict of the chip description, mac, features, manufacturer,
+    device and flashsize of a connected esp. mac is read unless given.
+
+    description is None when the chip has no description.'''
+    try:
+        description = esp.get_chip_description()
+    except esptool.FatalError:
+        return { 'description': None }
+
+    if mac is None:
+        mac = mac_address( esp )
+
+    features = esp.get_chip_features()
+    features = ', '.join(features)
+
+    flash_id = esp.flash_id()
+    manufacturer = '{:02x}'.format(flash_id & 0xff)
+
+    flid_lowbyte = (flash_id >> 16) & 0xFF
+    device = '{:02x}{:02x}'.format( (flash_id >> 8) & 0xff, flid_lowbyte )
+
+    flashsize = esptool.DETECTED_FLASH_SIZES.get( flid_lowbyte, "Unknown")
+    flashsize = '{}'.format( '4MB' if flashsize == "Unknown" else flashsize )
+
+    return { 'description': description, 'mac': mac, 'features': features,
+             'manufacturer': manufacturer, 'device': device,
+             'flashsize': flashsize }
+
+
+def identify( esp ):
+    '''Return get_chip_info() of a connected esp, read with a single MAC
+    check if the board is in esp32registry, and record it there.'''
+    port = esp._port.port
+    adapter = adapter_id( port )
+    try:
+        mac = mac_address( esp )
+    except esptool.FatalError:
+        mac = None
+    record = esp32registry.lookup( mac ) if mac else None
+    if record and all( record.get( name ) for name in esp32registry.INFO ):
+        log.debug( 'Known board %s, chip info read from the registry.', mac )
+        info = { name: record[ name ] for name in esp32registry.INFO }
+        info['mac'] = mac
+    else:
+        info = get_chip_info( esp, mac )
+        if info['description'] is None:
+            return info
+        mac = info['mac']
+    esp32registry.update( mac, adapter, port=port,
+                          **{ name: info[ name ] for name in esp32registry.INFO } )
+    return info
+
+
+def setup_esp( esp, args, status=_no_status ):
+    '''Prepare a connected esp for writing.
+
+    Uploads the stub loader, changes to args.baud and sets the flash size.
+    The stub upload and baud change are skipped for an esp that is already
+    the stub loader at that baud, e.g. of a session kept between writes.
+    Returns the esp instance to use from hereon, i.e. the stub loader.'''
+    metrics = getattr( args, 'metrics', None )
+    #1. Use "stub loader" program instead of the UART bootloader in the ESP32 ROM.
+    if not esp.IS_STUB:
+        status( 'Uploading stub....' )
+        with esp32metrics.timed( metrics, 'run_stub' ):
+            esp = esp.run_stub()
+
+    #2. Use a different baud to write flash if avaialble
+    if args.auto_baud:
+        if esp._port.baudrate == esptool.ESPLoader.ESP_ROM_BAUD:
+            with esp32metrics.timed( metrics, 'change_baud' ):
+                esp = auto_baud( esp, status )
+        #else keep the baud of a kept session
+    elif args.baud and args.baud != esp._port.baudrate:
+        with esp32metrics.timed( metrics, 'change_baud' ):
+            change_baud( esp, args.baud )
+
+    #3. Set some parameters of the SPI flash chip
+    if hasattr(args, "flash_size"):
+        log.info( "Configuring flash size..." )
+        with esp32metrics.timed( metrics, 'flash_params' ):
+            esptool.detect_flash_size( esp, args )
+            esp.flash_set_parameters( esptool.flash_size_bytes( args.flash_size ) )
+    return esp
+
+
+def change_baud( esp, baud ):
+    '''Change baud of esp. Return False if the ROM can't change baud.'''
+    try:
+        esp.change_baud( baud )
+    except esptool.NotImplementedInROMError:
+        log.warning( "ROM doesn't support changing baud rate. Keeping initial baud rate %d",
+                     esp._port.baudrate )
+        return False
+    return True
+
+
+AUTO_BAUDS = ( 230400, 460800, 921600, 1500000, 2000000, 3000000 )
+BAUDS_SETTINGS = 'bauds.json' #{adapter_id: baud} of esp32settings
+_bauds_lock = threading.Lock()
+
+
+def adapter_id( port ):
+    '''Return 'vid:pid:serial number' of the USB-serial adapter of port, or
+    None if port is not a USB device.'''
+    for info in serial.tools.list_ports.comports():
+        if info.device == port and info.vid is not None:
+            return '{:04x}:{:04x}:{}'.format( info.vid, info.pid,
+                                              info.serial_number or '' )
+    return None
+
+
+def baud_works( esp, rounds=4 ):
+    '''Return True if rounds flash_md5sum round-trips succeed at the current
+    baud of esp and agree with each other.'''
+    digests = set()
+    try:
+        for i in range( rounds ):
+            digests.add( esp.flash_md5sum( 0, esp.FLASH_SECTOR_SIZE ) )
+    except ( esptool.FatalError, SerialException, OSError, StopIteration ):
+        esp.flush_input() # Also restarts the packet reader ended by a timeout
+        return False
+    return len( digests ) == 1
+
+
+def _try_baud( esp, baud ):
+    '''Change esp to baud. Return True if the link works at baud.'''
+    try:
+        esp.change_baud( baud )
+    except ( esptool.FatalError, SerialException, OSError, ValueError, StopIteration ):
+        esp.flush_input()
+        return False
+    return baud_works( esp )
+
+
+def _restore_baud( esp, baud ):
+    '''Return an esp that works at baud after a failed _try_baud().
+
+    The stub may or may not have changed to the failed baud, so it is first
+    asked to change back, at the failed baud. If the link still fails, the
+    ESP32 is reset into its bootloader and the stub is uploaded again.'''
+    if _try_baud( esp, baud ):
+        return esp
+    try:
+        esp._port.baudrate = baud
+    except ( SerialException, ValueError ):
+        pass
+    if baud_works( esp ):
+        return esp
+    log.info( 'Reconnecting at %d baud...' % esptool.ESPLoader.ESP_ROM_BAUD )
+    esp = esptool.ESP32ROM( esp._port, esptool.ESPLoader.ESP_ROM_BAUD )
+    connect( esp )
+    esp = esp.run_stub()
+    if baud != esp._port.baudrate:
+        esp.change_baud( baud )
+    return esp
+
+
+def negotiate_baud( esp, bauds=AUTO_BAUDS, status=_no_status ):
+    '''Step esp through the bauds faster than its current baud, in ascending
+    order, until a baud fails baud_works(). Returns ( esp, baud ) of the
+    fastest baud that works, which esp is left at.'''
+    good = esp._port.baudrate
+    for baud in sorted( bauds ):
+        if baud <= good:
+            continue
+        status( 'Trying %d baud....' % baud ); log.info( 'Trying %d baud...' % baud )
+        if not _try_baud( esp, baud ):
+            log.info( '%d baud is not reliable.' % baud )
+            esp = _restore_baud( esp, good )
+            break
+        good = baud
+    return esp, good
+
+
+def auto_baud( esp, status=_no_status ):
+    '''Change the stub loader esp to the fastest baud that works reliably.
+
+    The baud found is remembered for the USB-serial adapter of the port, see
+    adapter_id(), and is tried first the next time. Returns the esp to use.'''
+    port = esp._port.port
+    adapter = adapter_id( port )
+    with _bauds_lock:
+        bauds = esp32settings.load( BAUDS_SETTINGS, {} )
+    baud = bauds.get( adapter ) if adapter else None
+    if baud:
+        status( 'Trying remembered %d baud....' % baud )
+        if _try_baud( esp, baud ):
+            log.info( 'Changed to remembered %d baud.' % baud )
+            return esp
+        log.info( 'Remembered %d baud is not reliable.' % baud )
+        esp = _restore_baud( esp, esptool.ESPLoader.ESP_ROM_BAUD )
+    esp, baud = negotiate_baud( esp, AUTO_BAUDS, status )
+    status( 'Using %d baud....' % baud ); log.info( 'Using %d baud.' % baud )
+    if adapter:
+        with _bauds_lock:
+            bauds = esp32settings.load( BAUDS_SETTINGS, {} )
+            bauds[ adapter ] = baud
+            esp32settings.save( BAUDS_SETTINGS, bauds )
+    return esp
+
+
+def check_fit( args ):
+    '''Raise esptool.FatalError if a file of args.addr_filename can't fit in flash.'''
+    flash_end = esptool.flash_size_bytes( args.flash_size )
+    for address, argfile in args.addr_filename:
+        argfile.seek(0,2)  # seek to end
+        if address + argfile.tell() > flash_end:
+            raise esptool.FatalError(("File %s (length %d) at offset %d will not fit in %d bytes of flash. " +
+                             "Use --flash-size argument, or change flashing address.")
+                             % (argfile.name, argfile.tell(), address, flash_end))
+        argfile.seek(0)
+
+
+def check_overlap( args ):
+    '''Raise esptool.FatalError if two files of args.addr_filename overlap.
+
+    The flash is erased in whole sectors, so a file overlaps the next one
+    when its last sector does.'''
+    ends = []
+    for address, argfile in args.addr_filename:
+        argfile.seek(0,2)  # seek to end
+        ends.append( ( address, address + argfile.tell(), argfile.name ) )
+        argfile.seek(0)
+    ends.sort()
+    sector = esptool.ESPLoader.FLASH_SECTOR_SIZE
+    for ( address, end, name ), ( next_address, next_end, next_name ) in zip( ends, ends[1:] ):
+        if next_address < ( end + sector - 1 ) // sector * sector:
+            raise esptool.FatalError( 'File %s at offset 0x%x overlaps file %s at offset 0x%x.'
+                                      % ( name, address, next_name, next_address ) )
+
+
+COMPRESS_LEVELS = ( 1, 3, 6, 9 ) #Levels tried by choose_compress_level()
+
+
+def link_rate( esp ):
+    '''Return the bytes per second that esp is estimated to receive: as
+    measured by the last write to esp, else 10 bits per byte at its baud.'''
+    return getattr( esp, 'measured_rate', None ) or esp._port.baudrate / 10
+
+
+def choose_compress_level( image, rate, overlap=False, levels=COMPRESS_LEVELS,
+                           sample=0x10000, samples=4 ):
+    '''Return ( level, seconds ) of the zlib level that is predicted to
+    compress and send image to a link of rate bytes per second the fastest.
+
+    Each level compresses samples slices of sample bytes spread over image,
+    which gives its compression speed and ratio. With overlap, e.g. for a
+    StreamCompressor, compression and transfer happen at the same time.'''
+    view = memoryview( image )
+    count = max( 1, min( samples, len( image ) // sample ) )
+    step = len( image ) // count
+    best = None
+    for level in levels:
+        uncsize = compsize = 0
+        t = time.perf_counter()
+        for i in range( count ):
+            chunk = view[ i*step:i*step+sample ]
+            uncsize += len( chunk )
+            compsize += len( zlib.compress( chunk, level ) )
+        t = time.perf_counter() - t
+        compress_seconds = t * len( image ) / uncsize
+        send_seconds = compsize / uncsize * len( image ) / rate
+        if overlap:
+            seconds = max( compress_seconds, send_seconds )
+        else:
+            seconds = compress_seconds + send_seconds
+        if best is None or seconds < best[1]:
+            best = ( level, seconds )
+    return best
+
+
+def _compress( prepared ):
+    '''Compress prepared.image at prepared.level into prepared.compressed.'''
+    t = time.time()
+    prepared.compressed = zlib.compress( prepared.image, prepared.level )
+    prepared.compress_seconds = time.time() - t
+
+
+def map_file( argfile ):
+    '''Return the content of argfile, a file opened in binary mode, padded to
+    4 bytes.
+
+    A regular file is returned as a private copy-on-write mmap, so it is not
+    read into memory and only the pages that are patched are copied. Other
+    files, e.g. pipes, and files that need padding are read as bytes.'''
+    try:
+        size = os.fstat( argfile.fileno() ).st_size
+        if size and size % 4 == 0:
+            return mmap.mmap( argfile.fileno(), 0, access=mmap.ACCESS_COPY )
+    except ( OSError, ValueError, io.UnsupportedOperation ):
+        pass
+    argfile.seek(0)
+    data = argfile.read()
+    argfile.seek(0)  # in case we need it again
+    return esptool.pad_to( data, 4 )
+
+
+def update_image_flash_params( esp, address, args, image ):
+    '''Return image with the flash parameters of a bootloader image set like
+    esptool._update_image_flash_params(), which copies the whole image. Only
+    the header is passed to it and a mmap is patched in place.'''
+    header = bytes( image[:8] )
+    patched = esptool._update_image_flash_params( esp, address, args, header )
+    if patched == header:
+        return image
+    if isinstance( image, mmap.mmap ):
+        image[:8] = patched
+        return image
+    return patched + image[8:]
+
+
+def prepare_image( esp, args, address, argfile ):
+    '''Return a PreparedImage of argfile, or None when argfile is empty.
+
+    esp is only used to patch the flash parameters of a bootloader image and,
+    with args.compress_level 'auto', for its link_rate(), so any esp instance
+    of the same chip type may be used. With args.stream_compress, the image
+    is compressed while it is written instead. Images are looked up in and
+    added to args.image_cache.
+
+    The image is hashed and compressed straight from map_file(), so a large
+    image is not copied in memory.'''
+    data = map_file( argfile )
+    if len(data) == 0:
+        return None
+    level = args.compress_level if args.compress else 0
+    if level == 'auto':
+        level = 'auto@%d' % esp._port.baudrate
+    cache = args.image_cache
+    if cache is not None:
+        key = cache.key( data, address, args, level )
+        prepared = cache.get( key, argfile.name )
+        if prepared is not None:
+            if args.compress and not args.stream_compress and prepared.compressed is None:
+                # Cached by a streamed write, which compressed it in segments
+                _compress( prepared )
+                cache.put( key, prepared )
+            return prepared
+    image = update_image_flash_params( esp, address, args, data )
+    calcmd5 = hashlib.md5( image ).hexdigest()
+    prepared = PreparedImage( address, argfile.name, image, calcmd5 )
+    if args.compress:
+        if args.compress_level == 'auto':
+            stream = args.stream_compress and can_stream( esp, address )
+            prepared.level, prepared.predicted = choose_compress_level(
+                image, link_rate( esp ), overlap=stream )
+            log.info( 'Compression level %d chosen for %s: %.1f seconds predicted...'
+                   % ( prepared.level, argfile.name, prepared.predicted ) )
+        else:
+            prepared.level = args.compress_level
+        if not args.stream_compress:
+            _compress( prepared )
+    if cache is not None:
+        cache.put( key, prepared )
+    return prepared
+
+
+def check_images( args, status=_no_status ):
+    '''Set args.compress and raise esptool.FatalError if the files of
+    args.addr_filename don't fit in flash or overlap.'''
+    # set args.compress based on default behaviour:
+    # -> if either --compress or --no-compress is set, honour that
+    # -> otherwise, set --compress unless --no-stub is set
+    if args.compress is None and not args.no_compress:
+        args.compress = not args.no_stub
+
+    # verify file sizes fit in flash
+    msg = 'Verifying file sizes can fit in flash...'
+    status( msg ); log.info( msg )
+    check_fit( args )
+    check_overlap( args )
+
+
+def _prepare_each( esp, args, status=_no_status ):
+    '''Yield ( prepared, seconds ) of each file of args.addr_filename, where
+    seconds is the time taken to prepare it. Empty files are skipped with a
+    warning.'''
+    for address, argfile in args.addr_filename:
+        t = time.time()
+        prepared = prepare_image( esp, args, address, argfile )
+        if prepared is None:
+            msg = 'WARNING: File %s is empty' % argfile.name
+            status( msg ); log.info( msg )
+            continue
+        yield prepared, time.time() - t
+
+
+def prepare_images( esp, args, status=_no_status ):
+    '''Return a list of PreparedImage for args.addr_filename.
+
+    Empty files are skipped with a warning.'''
+    check_images( args, status )
+    return [ prepared for prepared, seconds in _prepare_each( esp, args, status ) ]
+
+
+
+class ImagePrefetcher(object):
+    '''Prepare the images of args.addr_filename in a producer thread.
+
+    Iterating yields the PreparedImage of each file in order, like
+    prepare_images(), while the next one is being prepared. So the host
+    hashes and compresses an image while the ESP32 erases the flash, receives
+    the previous image and computes its flash md5, instead of preparing every
+    image up front. hashlib and zlib release the GIL. At most depth prepared
+    images wait to be written.
+
+    prepare_seconds is the time spent preparing the images taken so far and
+    wait_seconds the part of it the caller had to wait for. last is
+    ( prepare_seconds, wait_seconds ) of the image taken last.'''
+
+    def __init__( self, esp, args, status=_no_status, depth=1 ):
+        self.prepare_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.last = ( 0.0, 0.0 )
+        self._esp = esp
+        self._args = args
+        self._status = status
+        self._queue = queue.Queue( maxsize=depth )
+        self._stop = threading.Event()
+        self._context = esp32log.get_context() #Of the device, for the producer thread
+        self._thread = threading.Thread( target=self._produce,
+                                         name='prefetcher', daemon=True )
+        self._thread.start()
+
+
+    def _produce( self ):
+        esp32log.set_context( **self._context )
+        try:
+            for item in _prepare_each( self._esp, self._args, self._status ):
+                if not self._put( item ):
+                    return
+        except Exception as err:
+            self._put( err )
+            return
+        self._put( None )
+
+
+    def _put( self, item ):
+        '''Queue item unless self.close() is called. Returns False if closed.'''
+        while not self._stop.is_set():
+            try:
+                self._queue.put( item, timeout=0.1 )
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+    def __iter__( self ):
+        while True:
+            t = time.time()
+            item = self._queue.get()
+            waited = time.time() - t
+            if item is None:
+                return
+            if isinstance( item, Exception ):
+                raise item
+            prepared, seconds = item
+            waited = min( waited, seconds )
+            self.prepare_seconds += seconds
+            self.wait_seconds += waited
+            self.last = ( seconds, waited )
+            yield prepared
+
+
+    def close( self ):
+        '''Stop the producer thread, e.g. when a write failed.'''
+        self._stop.set()
+        self._thread.join()
+
+
+
+def can_stream( esp, address ):
+    '''Return True if an image at address can be sent by _write_segments().
+
+    Each segment gets its own flash_defl_begin, which makes the stub erase
+    the sectors it writes. Segments must thus start on a sector boundary and
+    the ROM loader, which erases the whole region up front, is not used.'''
+    return esp.IS_STUB and address % esp.FLASH_SECTOR_SIZE == 0
+
+
+def iter_blocks( image, size, pad=None ):
+    '''Yield ( seq, block ) for the size bytes blocks of image.
+
+    The blocks are memoryview slices of image, so the image is not copied.
+    When pad is a byte value, e.g. b'\\xff', the last block is padded to size
+    bytes with it, which is the only block that is copied.'''
+    view = memoryview( image )
+    for seq, offset in enumerate( range( 0, len( view ), size ) ):
+        block = view[ offset:offset+size ]
+        if pad is not None and len( block ) < size:
+            block = bytes( block ) + pad * ( size - len( block ) )
+        yield seq, block
+
+
+def can_delta( esp, address ):
+    '''Return True if an image at address can be written by its changed
+    sectors only, see find_changed_segments().'''
+    return address % esp.FLASH_SECTOR_SIZE == 0
+
+
+def _write_blocks( esp, image, compress, ratio, cancel, on_block=None ):
+    '''Send image in esp.FLASH_WRITE_SIZE blocks after a flash_begin or a
+    flash_defl_begin. on_block( seq, sent ) is called after each block.
+    Returns the number of bytes sent.'''
+    written = 0
+    # Pad the last block of an uncompressed image
+    pad = None if compress else b'\xff'
+    for seq, block in iter_blocks( image, esp.FLASH_WRITE_SIZE, pad ):
+        if cancel is not None and cancel.is_set():
+            raise WriteCancelled()
+        if compress:
+            esp.flash_defl_block( block, seq, timeout=esptool.DEFAULT_TIMEOUT * ratio * 2 )
+        else:
+            esp.flash_block( block, seq )
+        written += len(block)
+        if on_block:
+            on_block( seq + 1, written )
+    return written
+
+
+def find_changed_segments( esp, prepared, region=0x10000, cancel=None ):
+    '''Return ( segments, skipped ) for a delta write of prepared.
+
+    The flash md5sum of every region bytes of prepared.image is compared with
+    the md5 of the image. Regions that differ are compared sector by sector.
+    segments is a list of ( offset, length ) of the sectors that differ,
+    merged when adjacent, and skipped is the number of bytes that are already
+    in flash.'''
+    sector = esp.FLASH_SECTOR_SIZE
+    image = memoryview( prepared.image )
+
+    def differs( offset, length ):
+        if cancel is not None and cancel.is_set():
+            raise WriteCancelled()
+        md5 = esp.flash_md5sum( prepared.address + offset, length )
+        return md5 != hashlib.md5( image[ offset:offset+length ] ).hexdigest()
+
+    segments = []
+    for offset in range( 0, len( image ), region ):
+        length = min( region, len( image ) - offset )
+        if not differs( offset, length ):
+            continue
+        for start in range( offset, offset + length, sector ):
+            size = min( sector, offset + length - start )
+            if not differs( start, size ):
+                continue
+            if segments and sum( segments[-1] ) == start and segments[-1][1] < 0x40000:
+                segments[-1] = ( segments[-1][0], segments[-1][1] + size )
+            else:
+                segments.append( ( start, size ) )
+    skipped = len( image ) - sum( length for offset, length in segments )
+    return segments, skipped
+
+
+def _write_segments( esp, prepared, segments, compress, reporter, cancel ):
+    '''Send the ( offset, length ) segments of prepared.image, each after its
+    own flash_defl_begin or flash_begin. With segments None, the whole image
+    is sent as the segments of a StreamCompressor.
+
+    A StreamCompressor compresses the next segments while the current one is
+    sent, so the first block is on the wire once the small first segment is
+    compressed instead of after the whole image is compressed.
+    Returns the number of bytes sent.'''
+    address = prepared.address
+    compressor = None
+    if compress:
+        compressor = StreamCompressor( prepared.image, prepared.level, segments=segments )
+        segments = compressor.segments()
+        items = compressor
+    else:
+        image = memoryview( prepared.image )
+        items = ( ( offset, length, image[ offset:offset+length ] )
+                  for offset, length in segments )
+    if reporter:
+        reporter.start( sum( length for offset, length in segments ) )
+    written = 0
+    done = 0 #Image bytes of the segments sent
+    try:
+        for offset, length, data in items:
+            if compress:
+                ratio = length / len( data )
+                esp.flash_defl_begin( length, len( data ), address + offset )
+            else:
+                ratio = 1.0
+                esp.flash_begin( length, address + offset )
+            on_block = None
+            if reporter:
+                def on_block( seq, sent, offset=offset, length=length, size=len( data ), done=done ):
+                    reporter.update( address + offset + seq * esp.FLASH_WRITE_SIZE,
+                                     done + min( length, length * sent // size ) )
+            written += _write_blocks( esp, data, compress, ratio, cancel, on_block )
+            done += length
+    finally:
+        if compressor:
+            compressor.close()
+    return written
+
+
+def _write_images( esp, args, images, status, reporter, cancel, prefetcher=None ):
+    '''Write and verify each PreparedImage of images for write_flash().
+    Returns a list of WriteResult.'''
+    metrics = getattr( args, 'metrics', None )
+    results = []
+    for prepared in images:
+        if args.no_stub:
+            msg = 'Erasing flash...'
+            status( msg ); log.info( msg )
+        address = prepared.address
+        uncsize = prepared.uncsize
+        precompressed = prepared.compressed is not None
+        t = time.time()
+        skipped = 0
+        compare_seconds = 0.0
+        if args.delta and not args.erase_all and can_delta( esp, address ):
+            msg = 'Comparing flash with image...'
+            status( msg ); log.info( msg )
+            segments, skipped = find_changed_segments( esp, prepared, args.delta_region, cancel )
+            compare_seconds = time.time() - t
+            t = time.time()
+            msg = ( 'Compared in %.1f seconds, skipping %d of %d bytes that are unchanged...'
+                    % ( compare_seconds, skipped, uncsize ) )
+            status( msg ); log.info( msg )
+            written = _write_segments( esp, prepared, segments, args.compress, reporter, cancel )
+        elif ( args.compress and args.stream_compress and prepared.compressed is None
+               and can_stream( esp, address ) ):
+            written = _write_segments( esp, prepared, None, True, reporter, cancel )
+        else:
+            if args.compress:
+                image = prepared.compressed
+                if image is None: #prepared for streaming
+                    _compress( prepared )
+                    image = prepared.compressed
+                ratio = uncsize / len( image )
+                blocks = esp.flash_defl_begin( uncsize, len(image), address )
+                total = len( image )
+            else:
+                image = prepared.image
+                ratio = 1.0
+                blocks = esp.flash_begin( uncsize, address )
+                total = blocks * esp.FLASH_WRITE_SIZE
+            on_block = None
+            if reporter:
+                reporter.start( total )
+                def on_block( seq, sent ):
+                    reporter.update( address + seq * esp.FLASH_WRITE_SIZE, sent )
+            written = _write_blocks( esp, image, args.compress, ratio, cancel, on_block )
+        t = time.time() - t #Of the write only, without the comparison
+        result = WriteResult( address, uncsize, written, t, skipped )
+        result.compare_seconds = compare_seconds
+        result.md5 = prepared.calcmd5
+        results.append( result )
+        if prefetcher:
+            result.prepare_seconds, result.wait_seconds = prefetcher.last
+        if metrics:
+            if prefetcher:
+                metrics.add( 'prepare', result.prepare_seconds, uncsize, address )
+            if compare_seconds:
+                metrics.add( 'compare', compare_seconds, uncsize, address )
+            metrics.add( 'transmit', t, written, address )
+        speed_msg = ""
+        if args.compress:
+            if t > 0.0:
+                #Only the bytes written, not those skipped by a delta write
+                speed_msg = " (effective %.1f kbit/s)" % ( ( uncsize - skipped ) / t * 8 / 1000 )
+            log.info( 'Wrote %d bytes (%d compressed) at 0x%08x in %.1f seconds%s...' % ( uncsize - skipped, written, address, t, speed_msg ) )
+        else:
+            if t > 0.0:
+                speed_msg = " (%.1f kbit/s)" % ( written / t * 8 / 1000 )
+            log.info( 'Wrote %d bytes at 0x%08x in %.1f seconds%s...' % ( written, address, t, speed_msg ) )
+        if not skipped:
+            if prepared.predicted is not None:
+                actual = t + ( prepared.compress_seconds if precompressed else 0.0 )
+                log.info( 'Compression level %d: %.1f seconds predicted, %.1f seconds taken.'
+                       % ( prepared.level, prepared.predicted, actual ) )
+            if t > 0.5:
+                # Effective rate of the link, including the flash writes of
+                # the ESP32, for link_rate() of the next write to esp.
+                esp.measured_rate = written / t
+        msg = 'Writing completed in %.1f seconds%s...' % ( t, speed_msg )
+        status( msg )
+        t = time.time()
+        try:
+            res = esp.flash_md5sum( address, uncsize )
+            if res != prepared.calcmd5:
+                log.error( 'File  md5: %s', prepared.calcmd5 )
+                log.error( 'Flash md5: %s', res )
+                log.error( 'MD5 of 0xFF is %s', hashlib.md5( b'\xFF' * uncsize ).hexdigest() )
+                raise esptool.FatalError("MD5 of file does not match data in flash!")
+            else:
+                msg = 'Hash of data verified.'
+                status( msg ); log.info( msg )
+                result.verified = True
+        except esptool.NotImplementedInROMError:
+            pass
+        finally:
+            result.md5_seconds = time.time() - t
+            if metrics:
+                metrics.add( 'md5', result.md5_seconds, uncsize, address )
+
+    return results
+
+
+def write_flash( esp, args, images=None, status=_no_status, progress=None,
+                 cancel=None ):
+    '''Write firmware to flash.
+
+    This function implements the esptool.py v2.6 write_flash(esp, args)
+    function with some modifications. The modifications are to allow the
+    progress of the write to be reported to the caller and to allow images
+    that are already prepared, e.g. shared by a gang-flash, to be written.
+    WriteCancelled is raised between blocks once cancel, a threading.Event,
+    is set.
+
+    Without images, the files of args.addr_filename are prepared by an
+    ImagePrefetcher, so that the next image is prepared while the ESP32
+    erases, writes and hashes the previous one.
+
+    Returns a list of WriteResult, one for each image written.'''
+    prefetcher = None
+    if images is None:
+        check_images( args, status )
+        images = prefetcher = ImagePrefetcher( esp, args, status )
+
+    reporter = None
+    if progress:
+        reporter = ProgressReporter( progress, args.progress_rate,
+                                     args.progress_per_percent )
+
+    try:
+        if args.erase_all:
+            msg = 'Erasing flash (this may take a while)...'
+            status( msg )
+            with esp32metrics.timed( getattr( args, 'metrics', None ), 'erase' ):
+                esptool.erase_flash( esp, args )
+        results = _write_images( esp, args, images, status, reporter, cancel, prefetcher )
+    finally:
+        if prefetcher:
+            prefetcher.close()
+    if prefetcher and ( len( results ) > 1 or args.erase_all ):
+        log.info( 'Prepared the images in %.1f seconds, %.1f seconds of it while the ESP32 was busy.'
+               % ( prefetcher.prepare_seconds, prefetcher.prepare_seconds - prefetcher.wait_seconds ) )
+
+    log.info( 'Leaving...' )
+
+    if esp.IS_STUB:
+        # skip sending flash_finish to ROM loader here,
+        # as it causes the loader to exit and run user code
+        esp.flash_begin(0, 0)
+        if args.compress:
+            esp.flash_defl_finish(False)
+        else:
+            esp.flash_finish(False)
+
+    if args.verify:
+        # _write_images() has already checked the flash md5sum of every image
+        # against its PreparedImage. esptool.verify_flash() would read each
+        # file into memory again only to repeat that check.
+        unverified = [ '0x%x' % result.address for result in results if not result.verified ]
+        if unverified:
+            log.warning( 'Flash at %s not verified: the ROM loader has no md5sum.',
+                         ', '.join( unverified ) )
+        else:
+            msg = '-- verify OK (digest matched)'
+            status( msg ); log.info( msg )
+    return results
+
+
+READ_BLOCK_SIZE = esptool.ESPLoader.FLASH_SECTOR_SIZE #Bytes per read_flash packet
+READ_IN_FLIGHT  = 64 #Packets the stub sends ahead of the acks
+
+
+def read_flash( esp, args, address, size, outfile, status=_no_status, progress=None,
+                cancel=None, verify=True ):
+    '''Read size bytes of flash at address into outfile, a file opened for
+    binary writing, at the baud of esp, which must run the stub.
+
+    esptool.py v2.6 read_flash() appends every 4 KB packet to one bytes
+    object, which keeps the whole dump in memory and copies it for each
+    packet. This loop acks a packet, then writes it to outfile and hashes it,
+    so only one packet is held. The md5 the stub sends at the end is
+    compared with the bytes read and, with verify, with a separate
+    flash_md5sum() of the region. ReadCancelled is raised between packets
+    once cancel is set.
+
+    Returns a ReadResult.'''
+    if not esp.IS_STUB:
+        raise esptool.FatalError( 'Reading flash needs the stub loader.' )
+    reporter = None
+    if progress:
+        reporter = ProgressReporter( progress, args.progress_rate,
+                                     args.progress_per_percent, verb='Reading' )
+        reporter.start( size )
+    msg = 'Reading %d bytes at 0x%08x...' % ( size, address )
+    status( msg ); log.info( msg )
+    t = time.time()
+    esp.check_command( 'read flash', esp.ESP_READ_FLASH,
+                       struct.pack( '<IIII', address, size, READ_BLOCK_SIZE, READ_IN_FLIGHT ) )
+    md5 = hashlib.md5()
+    received = 0
+    while received < size:
+        if cancel is not None and cancel.is_set():
+            raise ReadCancelled()
+        packet = esp.read()
+        received += len( packet )
+        if received < size and len( packet ) < READ_BLOCK_SIZE:
+            raise esptool.FatalError( 'Corrupt data, expected 0x%x bytes but received 0x%x bytes'
+                                      % ( READ_BLOCK_SIZE, len( packet ) ) )
+        if received > size:
+            raise esptool.FatalError( 'Read more than expected' )
+        # Ack first, so the stub sends on while the packet is stored.
+        esp.write( struct.pack( '<I', received ) )
+        outfile.write( packet )
+        md5.update( packet )
+        if reporter:
+            reporter.update( address + received, received )
+    digest = esp.read()
+    if len( digest ) != 16:
+        raise esptool.FatalError( 'Expected digest, got: %s' % esptool.hexify( digest ) )
+    if digest != md5.digest():
+        raise esptool.FatalError( 'Digest mismatch: expected %s, got %s'
+                                  % ( esptool.hexify( digest ), md5.hexdigest().upper() ) )
+    t = time.time() - t
+    result = ReadResult( address, size, t, md5.hexdigest() )
+    metrics = getattr( args, 'metrics', None )
+    if metrics:
+        metrics.add( 'read', t, size, address )
+    speed_msg = ''
+    if t > 0.0:
+        speed_msg = ' (%.1f kbit/s)' % ( size / t * 8 / 1000 )
+    msg = 'Read %d bytes at 0x%08x in %.1f seconds%s.' % ( size, address, t, speed_msg )
+    status( msg ); log.info( msg )
+    if verify:
+        t = time.time()
+        res = esp.flash_md5sum( address, size )
+        result.md5_seconds = time.time() - t
+        if metrics:
+            metrics.add( 'md5', result.md5_seconds, size, address )
+        if res != result.md5:
+            log.error( 'File  md5: %s', result.md5 )
+            log.error( 'Flash md5: %s', res )
+            raise esptool.FatalError( 'MD5 of flash does not match the data read!' )
+        msg = 'Hash of data verified.'
+        status( msg ); log.info( msg )
+        result.verified = True
+    return result
@@ -1,3 +1,10 @@
-import esp32flashwriter_v4_2 as esp32esp32flashwriter
+import sys
 
-esp32esp32flashwriter.main() 
+if len( sys.argv ) > 1:
+    #Headless: write firmware from the command line without the Tk GUI.
+    import esp32flashcli
+    sys.exit( esp32flashcli.main( sys.argv[1:] ) )
+else:
+    import esp32flashwriter_v4_2 as esp32esp32flashwriter
+
+    esp32esp32flashwriter.main() 
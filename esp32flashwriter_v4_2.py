@@ -29,23 +29,56 @@ Modified on: 2019-03-08  -- Works in Windows 10 too.
 
 import tkinter as tk
 import tkinter.ttk as ttk
-from tkinter import filedialog
-import tkinter.messagebox as tkMessageBox
 
-import serial.tools.list_ports
-import esptool
+import importlib.util
 import os
-from pprint import pprint
 from serial.serialutil import SerialException
 
-import platform
-import time
+import logging
 
-import hashlib
-import zlib
 import sys
-import time
-import struct
+import codecs
+import queue
+import threading
+
+import esp32log
+import esp32metrics #First used by worker threads, so not lazy_import()ed
+import esp32registry
+
+
+def lazy_import( name ):
+    '''Return module name, which is only executed when one of its attributes
+    is first used, e.g. so that esptool.py is not loaded before the window
+    is drawn.'''
+    module = sys.modules.get( name )
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec( name )
+    spec.loader = importlib.util.LazyLoader( spec.loader )
+    module = importlib.util.module_from_spec( spec )
+    sys.modules[ name ] = module
+    spec.loader.exec_module( module )
+    parent, _, child = name.rpartition( '.' )
+    if parent:
+        setattr( sys.modules[ parent ], child, module )
+    return module
+
+
+filedialog      = lazy_import( 'tkinter.filedialog' )
+simpledialog    = lazy_import( 'tkinter.simpledialog' )
+tkMessageBox    = lazy_import( 'tkinter.messagebox' )
+esptool         = lazy_import( 'esptool' )
+engine          = lazy_import( 'esp32flashengine' )
+preflight       = lazy_import( 'esp32preflight' )
+esp32gangflash  = lazy_import( 'esp32gangflash' )
+esp32hotplug    = lazy_import( 'esp32hotplug' )
+esp32imagecache = lazy_import( 'esp32imagecache' )
+esp32monitor    = lazy_import( 'esp32monitor' )
+esp32scheduler  = lazy_import( 'esp32scheduler' )
+
+log = esp32log.get_logger( 'gui' )
+
+ICON_DIR = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'icon' )
 
 
 class App(ttk.Frame):
@@ -86,16 +119,19 @@ class App(ttk.Frame):
         self.device = ESP32Device( self, self.style, self.fonts )
         self.flashfirmware = FlashFirmware( self, self.device, self.style,
                                             self.fonts )
+        self.monitor = SerialMonitorPane( self, self.device, self.style, self.fonts )
         self.device.grid(        row=0, column=0, padx=10, pady=[10,5], sticky='we' )
-        self.flashfirmware.grid( row=1, column=0, padx=10, pady=[5,10], sticky='we' )
+        self.flashfirmware.grid( row=1, column=0, padx=10, pady=[5,5], sticky='we' )
+        self.monitor.grid(       row=2, column=0, padx=10, pady=[5,10], sticky='we' )
 
         
     def ask_quit( self ):
         '''Confirmation to quit application.'''
         if tkMessageBox.askokcancel( "Quit","Quit ESP32FlashWriter?" ):
+            self.flashfirmware.stop() #End a write in progress.
             self.device.shutdown() #Close port of serial.Serial() instance.
             self.master.destroy() #Destroy the Tk Window instance.
-            print( '\n<<< ENDED >>>')
+            log.info( '<<< ENDED >>>' )
 
 
 
@@ -109,6 +145,8 @@ class ESP32Device(ttk.Labelframe):
     MSG3  = 'Connected: No Chip description.'
     
     BAUD  = [ 9600,11520,38400,115200,230400,921600 ]
+    ROM_BAUD     = 115200 #esptool.ESPLoader.ESP_ROM_BAUD, known before esptool is loaded
+    MONITOR_BAUD = 115200 #Baud of the console of ESP32 firmware
 
 
     def __init__( self, master=None, style=None, fonts=None, *args, **kw ):
@@ -121,6 +159,13 @@ class ESP32Device(ttk.Labelframe):
         self.ports = None       #ttk.Combobox hosting detected serial devices
         self.bauds = None       #ttk.Combobox hosting known esp32 bauds
         self.connecting = False #Toggled True when connecting to esp32 else False
+        self.monitor = None     #SerialMonitor of the port of the esp32
+        self.logfile = None     #File the output of the esp32 is appended to
+        self.info = {}          #Chip info of the connected esp32, see engine.identify()
+        self._busy = False
+        self._connection = queue.Queue() #Result of the connection worker
+        self._hotplug_events = queue.Queue() #HotplugEvent of the hot-plug watcher thread
+        self._hotplug = None #esp32hotplug.HotplugWatcher, see self._start()
         self.status       = tk.StringVar( value=ESP32Device.MSG0 )
         self.mac          = tk.StringVar( value='' )
         self.features     = tk.StringVar( value='' )
@@ -128,13 +173,26 @@ class ESP32Device(ttk.Labelframe):
         self.device       = tk.StringVar( value='' )
         self.flashsize    = tk.StringVar( value='' )
         self.port         = tk.StringVar( value='-- please select --' )
-        self.baud         = tk.IntVar( value=esptool.ESPLoader.ESP_ROM_BAUD )
-        self.pic_reset = tk.PhotoImage( file='./icon/iconfinder_Reset_40005a.png' )
+        self.baud         = tk.IntVar( value=ESP32Device.ROM_BAUD )
+        self.auto_baud    = tk.IntVar( value=False ) #Write at the fastest reliable baud
+        self.pic_reset = tk.PhotoImage( file=os.path.join( ICON_DIR, 'iconfinder_Reset_40005a.png' ) )
         self._status_color = 'black'
         
         #Methods Initialized
         self._create_widgets()
+        #Look for ports once the window is drawn, see self._start().
+        self.after_idle( self._start )
+
+
+    def _start( self ):
+        '''Start the hot-plug watcher and show the state of the ports.
+
+        This loads esptool.py and pyserial, so it is only done after the
+        window is first drawn.'''
+        self._hotplug = esp32hotplug.HotplugWatcher( self._hotplug_events.put )
         self._connect_esp()
+        self._hotplug.start()
+        self._drain_hotplug()
         
 
     def _create_widgets( self ):
@@ -174,6 +232,8 @@ class ESP32Device(ttk.Labelframe):
         baud_reset = ttk.Button( self, text='Reset', width=5, image=self.pic_reset,
                                  style='device.TButton', command=self._reset_baud )
         baud_reset.bind('<KeyPress-Return>', self._reset_baud)
+        auto_baud = ttk.Checkbutton( self, text='Auto', variable=self.auto_baud )
+        self._reset = ttk.Button( self, text='RESET', width=6, command=self._reset_esp )
         
         lb_detect.grid( row=1, column=0, padx=10, pady=[0,0], sticky='ew',  )
         lb_mac.grid(         row=2, column=0, padx=10, pady=[0,0], sticky='ew',  )
@@ -186,19 +246,15 @@ class ESP32Device(ttk.Labelframe):
         self.ports.grid( row=1, column=1, padx=[0,0],  pady=[0,0], ipady=4 )
         self.bauds.grid( row=1, column=2, padx=[10,0], pady=[0,0], ipady=4 )
         baud_reset.grid( row=1, column=3, padx=[2,10], pady=[0,0])
+        auto_baud.grid(  row=2, column=2, padx=[10,0], pady=[0,0], sticky='w' )
+        self._reset.grid( row=2, column=1, padx=[0,0], pady=[2,0] )
 
 
     #PostCommand:
     def _list_ports( self ):
-        if 'Linux' in platform.system():
-            devices = [ port.device for port in serial.tools.list_ports.grep('ttyUSB') ]
-        elif 'Windows' in platform.system():
-            devices = [ port.device for port in serial.tools.list_ports.comports() ]
-            
-        # In module "serial.tools.list_ports", its .grep() method returns 
-        #  an iterable of its ListPortInfo class object
+        devices = engine.find_ports()
         if devices: #Update Combobox's dropdown list values
-            self.ports['values'] = sorted( devices )
+            self.ports['values'] = devices
             self.bauds['state'] = 'normal'
         else:
             self.ports['values'] = 'None_Found'
@@ -240,10 +296,20 @@ class ESP32Device(ttk.Labelframe):
             #Port(s) detected
             portIsBusy = self._port_is_busy( port )
             if not portIsBusy:           
-                #Selected port can be used, connect to it.
+                #Selected port can be used, connect to it in a worker thread.
+                try:
+                    baud = self.baud.get()
+                except tk.TclError as err:
+                    baud = esptool.ESPLoader.ESP_ROM_BAUD
+                    self.baud.set( baud )
+                    self.bauds.update_idletasks()
+                self._stop_monitor( close=self.esp is None ) #Port kept open after a reset
+                oldesp, self.esp = self.esp, None
+                worker = threading.Thread( target=self._create_esp_connection,
+                                           args=( port, baud, oldesp ),
+                                           name='connect', daemon=True )
+                worker.start()
                 self._monitor_esp_connection()
-                self._create_esp_connection()
-                self.connecting = False
             else:
                 #Selected port is used by other apps(don't use it)
                 self.status.set( ESP32Device.MSG1 )
@@ -256,10 +322,12 @@ class ESP32Device(ttk.Labelframe):
 
     #Methods:
     def _sop_for_not_connected( self ):
+        self._stop_monitor()
         self.esp = None
         self.connecting = False
         self.port.set( '-- please select --' )
         self.ports.selection_clear()
+        self.info = {}
         self.mac.set( '' )
         self.features.set( '' )
         self.manufacturer.set( '' )
@@ -273,6 +341,7 @@ class ESP32Device(ttk.Labelframe):
         self.connecting = True
         self.status.set( 'Connecting.....' )
         self.ports.selection_clear()
+        self.info = {}
         self.mac.set( '' )
         self.features.set( '' )
         self.manufacturer.set( '' )
@@ -282,168 +351,213 @@ class ESP32Device(ttk.Labelframe):
         
 
     def _port_is_busy( self, port):
-        if 'Linux' in platform.system():
-            #Check if picocom or minicom is using the port
-            portname = os.path.basename( port )
-            linux_lock = "/var/lock/"
-            files = os.listdir( linux_lock )       
-            for file in files:
-               filename = os.path.basename( file )
-               if portname in filename:
-                   print('picocom or minicom is using port')
-                   return True
-
-            #Todo: Need a more general algorithim to determine whether the port is
-            #      used by other applications.
-
-            print('ESP32 is available.')
-            return False #port is not busy
-
-        elif 'Windows' in platform.system():
-            #treat port as not busy; no algorithm yet.
-            #To do: Need an appropriate algorithm 
-            return False 
-             
-
-    def _create_esp_connection( self ):
+        return engine.port_is_busy( port )
+
+
+    def _create_esp_connection( self, port, baud, oldesp ):
         '''Connect to ESP32. Child method.
 
-        Need to indicate self.connecting=False when self.esp.connect() encounter
-        an exception. No need to update self.connecting=True when connected
-        as it is done Parent method.'''
-        port = self.port.get()
-        try:
-            baud = self.baud.get()
-        except tk.TclError as err:
-            baud = esptool.ESPLoader.ESP_ROM_BAUD
-            self.baud.set( baud )
-            self.bauds.update_idletasks()
-        
+        Runs in a worker thread, so it must not touch any Tk widget or
+        variable. The outcome is put in self._connection for
+        self._monitor_esp_connection() to show:
+          ('connected', esp, info) -- info is a dict from engine.get_chip_info()
+          ('failed', msg, err)     -- msg is the status to show.'''
+        esp32log.set_context( port=port )
+        esp = None
+        metrics = esp32metrics.Session( 'connect', port )
+        error = None
         try:
-            if self.esp:
-                self.esp._port.close()
-            self.esp = esptool.ESP32ROM( port, baud, #trace_enabled=True,
-                                         )
+            if oldesp:
+                oldesp._port.close()
+            with metrics.stage( 'open' ):
+                esp = esptool.ESP32ROM( port, baud, #trace_enabled=True,
+                                        )
             #Created attributes:
-            # self.esp._port - Is an instance of serial.Serial() or a compatible object
-            #                  see https://pythonhosted.org/pyserial/pyserial_api.html?highlight=setdtr#serial.Serial
-            #                - It will close the defined serial port when self.esp._port is freed, i.e.
-            #                  when tk.Tk() instance is destroyed. 
-            #                - set self.esp._port.baud
-            # self.esp._slip_reader   - Is a generator to read SLIP packets from the
-            #                           defined serial port in self.esp._port.
-            # self.esp._trace_enabled - Denotes wheather tracing is activated.
-            #                           For debugging. Default value is "False"
-            # self.esp._last_trace    - stores time.time()
-            self.esp.connect()
+            # esp._port - Is an instance of serial.Serial() or a compatible object
+            #             see https://pythonhosted.org/pyserial/pyserial_api.html?highlight=setdtr#serial.Serial
+            #           - It will close the defined serial port when esp._port is freed, i.e.
+            #             when tk.Tk() instance is destroyed. 
+            #           - set esp._port.baud
+            # esp._slip_reader   - Is a generator to read SLIP packets from the
+            #                      defined serial port in esp._port.
+            # esp._trace_enabled - Denotes wheather tracing is activated.
+            #                      For debugging. Default value is "False"
+            # esp._last_trace    - stores time.time()
+            with metrics.stage( 'connect' ):
+                engine.connect( esp )
+            with metrics.stage( 'chip_info' ):
+                info = engine.identify( esp ) #A single MAC check for a known board
+            metrics.mac = info.get( 'mac' )
+            esp32log.update_context( mac=metrics.mac )
         except (esptool.FatalError, OSError) as err:
-            self.esp._port.close()
-            self._sop_for_not_connected()
+            error = err
+            if esp:
+                esp._port.close()
             if "Failed to connect to ESP32: Timed out waiting for packet header" in err.__str__():
-                self.status.set( ESP32Device.MSG2a ) #Fail to Connect. Try another Baud value.
+                msg = ESP32Device.MSG2a #Fail to Connect. Try another Baud value.
             else:
-                self.status.set( ESP32Device.MSG2 ) #Fail to Connect. Hold down BOOT & click WRITE.'
-            print( err )
+                msg = ESP32Device.MSG2 #Fail to Connect. Hold down BOOT & click WRITE.'
+            log.error( err )
+            self._connection.put( ( 'failed', msg, err ) )
         except SerialException as err:
-            self.esp._port.close()
-            self._sop_for_not_connected()
-            print( "{} ESP32 device is busy".format( port ) )
-            self.status.set( ESP32Device.MSG1 )
-            print( err )
+            error = err
+            if esp:
+                esp._port.close()
+            log.error( '%s ESP32 device is busy: %s', port, err )
+            self._connection.put( ( 'failed', ESP32Device.MSG1, err ) )
         else:
-            pprint( self.esp.__dict__ )
-            print( 'esp is created & connected.\n' )
+            if log.isEnabledFor( logging.DEBUG ):
+                from pprint import pformat
+                log.debug( 'esp: %s', pformat( esp.__dict__ ) )
+            log.info( 'esp is created & connected.' )
+            self._connection.put( ( 'connected', esp, info ) )
+        finally:
+            metrics.finish( error )
+            esp32metrics.export( metrics )
 
 
     def _monitor_esp_connection(self):
-        '''Get ESP32 chip description, features, manufacturer, device and flashsize.
-
-        Thereafter, initiate after() method to check if serial connection continues
-        or is broken using self._connected= True or False, respectively.
-
-        Parent method to self._check_connection() method.'''
-                                        
-        def get_info():
-            mac = self.esp.read_mac()
-            mac = ':'.join( format(x,'02x') for x in mac )
-            # '02x' means use at least 2 digits with zeros to pad to length,
-            #       and x means lower-case hexadecimal.
-
-            features = self.esp.get_chip_features()
-            features = ', '.join(features)
-            
-            flash_id = self.esp.flash_id()
-            manufacturer = '{:02x}'.format(flash_id & 0xff)
-            
-            flid_lowbyte = (flash_id >> 16) & 0xFF
-            device = '{:02x}{:02x}'.format( (flash_id >> 8) & 0xff, flid_lowbyte )
-            
-            flashsize = esptool.DETECTED_FLASH_SIZES.get( flid_lowbyte, "Unknown")
-            flashsize = '{}'.format( '4MB' if flashsize == "Unknown" else flashsize )
-
-            return mac, features, manufacturer, device, flashsize
+        '''Show the outcome of the connection worker.
 
+        Blinks the status while connecting. Once connected, shows the chip
+        description, mac, features, manufacturer, device and flashsize and
+        starts the serial monitor, which also finds out when the serial
+        connection is broken.'''
         if 'blue' in self._status_color:
             self._status_color = 'black'
             self.style.configure( 'detect.TLabel', foreground='black' )
         elif 'black' in self._status_color:
             self._status_color = 'blue'
             self.style.configure( 'detect.TLabel', foreground='blue' )
-        self.update_idletasks()
-                
-        if not self.connecting:
-            if self.esp:
-                # Connected
-                try: 
-                    chip_type = self.esp.get_chip_description()
-                except esptool.FatalError:
-                    # Connected: No Chip description.
-                    status = ESP32Device.MSG3
-                else:
-                    # Connected: Have Chip description.
-                    status = 'Connected: {}.'.format( chip_type )                   
-                    self.status.set( status )
-                    mac, features, manufacturer, device, flashsize = get_info()
-                    self.mac.set('{:19}{}{}'.format('','Mac: ',mac) )
-                    self.features.set('{:25}{}{}'.format('','Features: ',features) )
-                    self.manufacturer.set('{:25}{}{}'.format('','Manufacturer: ',manufacturer) )
-                    self.device.set('{:25}{}{}'.format('','Device: ',device) )
-                    self.flashsize.set('{:25}{}{}'.format('','Flash size: ', flashsize) )
-                    self._connected = True
-                    self._check_connection() # Check esp32 device is connected regularly.
-                self.connected = True
+
+        try:
+            outcome = self._connection.get_nowait()
+        except queue.Empty:
+            # Connecting
+            self.after( 250, self._monitor_esp_connection ) # Call this method after 250 ms.
+            return
+
+        self.connecting = False
+        if outcome[0] == 'connected':
+            # Connected
+            esp, info = outcome[1:]
+            self.esp = esp
+            self.info = info
+            if info['description'] is None:
+                # Connected: No Chip description.
+                self.status.set( ESP32Device.MSG3 )
             else:
-                # Fail to Connect.
-                self.connected = False
+                # Connected: Have Chip description.
+                self.status.set( 'Connected: {}.'.format( info['description'] ) )
+                self.mac.set('{:19}{}{}'.format('','Mac: ',info['mac']) )
+                self.features.set('{:25}{}{}'.format('','Features: ',info['features']) )
+                self.manufacturer.set('{:25}{}{}'.format('','Manufacturer: ',info['manufacturer']) )
+                self.device.set('{:25}{}{}'.format('','Device: ',info['device']) )
+                self.flashsize.set('{:25}{}{}'.format('','Flash size: ', info['flashsize']) )
+            self._start_monitor( esp._port )
+            self.connected = True
         else:
-            # Connecting
-            self.after( 500, self._monitor_esp_connection ) # Call this method after 500 ms.
+            # Fail to Connect.
+            self._sop_for_not_connected()
+            self.status.set( outcome[1] )
+            self.connected = False
 
 
-    def _check_connection( self ):
-        '''Check ESP32 connection is ok or broken for Linux & Windows. 
+    @property
+    def busy( self ):
+        '''True when a worker, e.g. a write, is using self.esp. The serial
+        monitor doesn't read the port meanwhile.'''
+        return self._busy
 
-        If connection is broken, i.e. result in exception, update self._connected=False.
-        Child method of _monitor_esp_connection.'''
-        #print( '\ndef _check_connection( self )' )
-        if self._connected:
-            try:
-                in_bytes = self.esp._port.in_waiting
-                _ = self.esp._port.read( in_bytes )
-            except ( SerialException, OSError ) as err:
-                self._connected = False
-                print( 'Disconnection event detected.' )
-                self.after( 500, self._check_connection ) # Check connection every 500ms.
+
+    @busy.setter
+    def busy( self, busy ):
+        self._busy = busy
+        if self.monitor:
+            if busy:
+                self.monitor.pause()
             else:
-                #Some data was received
-                #print('self._connected = True')
-                self.after( 2000, self._check_connection ) # Check connection every 2s.
-        else:
-            print( 'Disconnected.\n' )
-            if self.esp:
-                self.esp._port.close()
-            self._sop_for_not_connected()
-            self.status.set( ESP32Device.MSG0 )
+                self.monitor.resume()
+
+
+    def _start_monitor( self, port ):
+        '''Read the output of the esp32 on port, a serial.Serial.'''
+        self._stop_monitor()
+        self.monitor = esp32monitor.SerialMonitor( port )
+        if self.logfile:
+            self._open_log( self.logfile )
+        self.monitor.start()
+
+
+    def _stop_monitor( self, close=False ):
+        '''Stop the serial monitor and, if close, close its port.'''
+        if self.monitor:
+            self.monitor.stop()
+            if close:
+                self.monitor.port.close()
+            self.monitor = None
+
+
+    def set_logfile( self, path ):
+        '''Append the output of the esp32 to the file path, or stop it for
+        path None. Returns False if path can't be opened.'''
+        self.logfile = path
+        if not self.monitor:
+            return True
+        if not path:
+            self.monitor.close_log()
+            return True
+        return self._open_log( path )
+
+
+    def _open_log( self, path ):
+        try:
+            self.monitor.open_log( path )
+        except OSError as err:
+            log.warning( 'Serial monitor log not opened: %s', err )
+            self.logfile = None
+            return False
+        return True
+
+
+    def _drain_hotplug( self ):
+        '''Show the ports added & removed by the hot-plug watcher thread and
+        tear down self.esp when its port is gone or can't be read.'''
+        removed = []
+        changed = False
+        try:
+            while True:
+                event = self._hotplug_events.get_nowait()
+                changed = True
+                log.info( 'Port %s', event )
+                if event.action == event.REMOVE:
+                    removed.append( event.port )
+        except queue.Empty:
+            pass
+        if changed:
+            self._list_ports()
+        if self.port.get() in removed:
+            self._unplugged( self.port.get() )
+        elif self.monitor and self.monitor.error and not self.busy:
+            log.warning( 'Disconnection event detected: %s', self.monitor.error )
+            self._unplugged( self.port.get() )
+        self.after( 200, self._drain_hotplug )
+
+
+    def _unplugged( self, port ):
+        '''Tear down self.esp after the port of it was removed. A worker
+        using it fails on its own, so wait for it to end first.'''
+        if self.port.get() != port:
+            return #Another port was selected meanwhile.
+        if self.busy or self.connecting:
+            self.after( 500, self._unplugged, port )
+            return
+        log.info( 'Disconnected.' )
+        self._stop_monitor( close=True )
+        if self.esp:
+            self.esp._port.close()
+        self._sop_for_not_connected()
+        self.status.set( ESP32Device.MSG0 )
 
 
     def _validate_baud( self, S ):
@@ -456,13 +570,48 @@ class ESP32Device(ttk.Labelframe):
             return False
 
 
+    def _reset_esp( self ):
+        '''Hard reset the ESP32 to run its firmware, which ends the session of
+        the stub loader. The port is kept open to monitor the output of the
+        firmware. The Port has to be reselected to connect again.'''
+        if not self.esp or self.busy or self.connecting:
+            return
+        log.info( 'Hard resetting ESP32 via RTS pin...' )
+        port = self.esp._port
+        self._stop_monitor()
+        try:
+            engine.hard_reset( self.esp )
+            port.baudrate = ESP32Device.MONITOR_BAUD
+        except ( SerialException, OSError ) as err:
+            log.error( err )
+            port.close()
+            self._sop_for_not_connected()
+            self.status.set( ESP32Device.MSG0 )
+            return
+        self._sop_for_not_connected()
+        self._start_monitor( port )
+        self.status.set( 'ESP32 is reset. Reselect Port to connect again.' )
+
+
+    def release( self ):
+        '''Close ESP32 device port without resetting it, e.g. for a gang-flash.'''
+        self._stop_monitor( close=True )
+        if self.esp:
+            self.esp._port.close()
+        self._sop_for_not_connected()
+        self.status.set( ESP32Device.MSG0 )
+
+
     def shutdown( self ):
         '''Close ESP32 device port.'''
+        if self._hotplug:
+            self._hotplug.stop()
+        self._stop_monitor( close=self.esp is None )
         if self.esp:
             if self.esp._port.isOpen():
-                print( '\nHard resetting ESP32 via RTS pin...' )
-                self.esp.hard_reset()
-            print( '\nClosing ESP32 port...' )
+                log.info( 'Hard resetting ESP32 via RTS pin...' )
+                engine.hard_reset( self.esp )
+            log.info( 'Closing ESP32 port...' )
             self.esp._port.__del__() # Close serial port when serial.Serial() instance is freed
             #self.esp._port.close() # Close serial port immediately.
 
@@ -470,6 +619,10 @@ class ESP32Device(ttk.Labelframe):
 
 class FlashFirmware(ttk.Labelframe):
 
+    MAX_IMAGES = 4 #Rows of Source/Offset, e.g. bootloader, partitions, app & OTA data
+    OFFSETS    = ( '0x1000', '0x8000', '0x10000', '0xd000' ) #Default offset of each row (ESP-IDF two-OTA table)
+    QUEUE_WORKERS = 4 #Boards written at once by QUEUE
+
     def __init__( self, master, device, style=None, fonts=None, *args, **kw ):
         super().__init__( master, *args, **kw )
         #Attributes
@@ -477,15 +630,23 @@ class FlashFirmware(ttk.Labelframe):
         self.device = device # an instance of ESP32Device()
         self.style = style
         self.fonts = fonts
-        self._filename = tk.StringVar()
-        self._filebasename = tk.StringVar()
-        self._address = tk.StringVar()
-        self._size = tk.IntVar()
+        self._filename = []     #tk.StringVar of the path of each image row
+        self._filebasename = [] #tk.StringVar of the file name of each image row
+        self._address = []      #tk.StringVar of the flash offset of each image row
+        self._size = []         #tk.IntVar of the bytes of each image row
         self._erase_all = tk.IntVar()
+        self._delta = tk.IntVar()
+        self._keep_session = tk.IntVar( value=True ) #Keep stub & baud after a write
         self.status = tk.StringVar()
-        self.pic_folder = tk.PhotoImage( file='./icon/iconfinder_folder_299060_x28a.png' )
+        self.pic_folder = tk.PhotoImage( file=os.path.join( ICON_DIR, 'iconfinder_folder_299060_x28a.png' ) )
         self.args = None
         self._canwrite = True
+        self._gangflasher = None #esp32gangflash.GangFlasher of the last gang-flash
+        self._scheduler = None   #esp32scheduler.FlashScheduler of the last QUEUE
+        self._worker = None      #Thread running self._write_flash_worker() or self._read_flash_worker()
+        self._queue = queue.Queue()      #Messages from self._worker
+        self._cancel = threading.Event() #Set to cancel the write or read of self._worker
+        self._image_cache = None #esp32imagecache.ImageCache of previous writes, see self._create_args()
         #Methods Initialized
         self._create_widgets()
         
@@ -500,56 +661,107 @@ class FlashFirmware(ttk.Labelframe):
         lb_byte   = ttk.Label( self, text='Bytes', style='header1.TLabel' )
         lb_offset = ttk.Label( self, text='Flash Offset', style='header1.TLabel' )
         lb_erase  = ttk.Label( self, text='Erase Entire Flash', style='header1.TLabel' )
+        lb_delta  = ttk.Label( self, text='Changes Only', style='header1.TLabel' )
+        lb_keep   = ttk.Label( self, text='Keep Session', style='header1.TLabel' )
+        self._add = ttk.Button( self, text='+', width=2, command=self._add_image_row,
+                                style='find.TButton' )
         #Row1
-        source = ttk.Entry( self, textvariable=self._filebasename, font=default,
-                            width=36, state="readonly", takefocus=False,
-                            justify='center' )
-        find = ttk.Button( self, text='...', width=2, command=self._get_sources,
-                           image=self.pic_folder, style='find.TButton' )
-        find.bind( '<KeyPress-Return>', self._get_sources )
-        byte = ttk.Label( self, textvariable=self._size, width=9,
-                          style='bytes.TLabel' )
-        offset = ttk.Entry( self, textvariable=self._address, font=default,
-                            width=9, justify='center' )
-        self._address.set('0x1000')
+        self._add_image_row()
         self._yes = ttk.Radiobutton( self, text='Yes', value=True, variable=self._erase_all )
         self._no  = ttk.Radiobutton( self, text='No', value=False, variable=self._erase_all )
         self._yes.bind( '<KeyPress-Return>', self._set_erase_all )
         self._no.bind( '<KeyPress-Return>', self._set_erase_all )
-        #Row2
+        delta = ttk.Checkbutton( self, variable=self._delta )
+        keep = ttk.Checkbutton( self, variable=self._keep_session )
+        #Last row
         self._write = ttk.Button( self, text='WRITE', command=self._write_flash )
+        self._gang = ttk.Button( self, text='WRITE ALL', command=self._gang_write_flash )
+        self._read = ttk.Button( self, text='READ', command=self._read_flash )
+        self._queue_button = ttk.Button( self, text='QUEUE', command=self._queue_write_flash )
         lb_detect = ttk.Label( self, textvariable=self.status, width=40,
                                style='write.TLabel')
         # Position widgets 
         lb_source.grid( row=0, column=0, padx=[10, 0], pady=[10,0], )
+        self._add.grid( row=0, column=1, padx=[ 2,0], pady=[10,0], )
         lb_byte.grid(   row=0, column=2, padx=[10, 0], pady=[10,0], )
         lb_offset.grid( row=0, column=3, padx=[10, 0], pady=[10,0], )
         lb_erase.grid(  row=0, column=4, padx=[10,10], pady=[10,0], columnspan=2 )
-        source.grid(    row=1, column=0, padx=[10,0], pady=[5,0], ipady=3 )
-        find.grid(      row=1, column=1, padx=[ 2,0], pady=[5,0], )
-        byte.grid(      row=1, column=2, padx=[10,0], pady=[5,0], )
-        offset.grid(    row=1, column=3, padx=[10,0], pady=[5,0], ipady=3 )
+        lb_delta.grid(  row=0, column=6, padx=[ 0,10], pady=[10,0], )
+        lb_keep.grid(   row=0, column=7, padx=[ 0,10], pady=[10,0], )
         self._yes.grid( row=1, column=4, padx=[ 5,0],)
         self._no.grid(  row=1, column=5, ) 
-        self._write.grid(row=2, column=3, padx=10, pady=[10,10], columnspan=3, sticky='nsew', )
-        lb_detect.grid( row=2, column=0, padx=10, pady=[10,10], columnspan=3, sticky='nsew', )
+        delta.grid(     row=1, column=6, padx=[ 0,10], )
+        keep.grid(      row=1, column=7, padx=[ 0,10], )
+        last = FlashFirmware.MAX_IMAGES + 1
+        self._write.grid(row=last, column=3, padx=[10,0], pady=[10,10], sticky='nsew', )
+        self._gang.grid( row=last, column=4, padx=[5,10], pady=[10,10], columnspan=2, sticky='nsew', )
+        self._read.grid( row=last, column=6, padx=[0,10], pady=[10,10], sticky='nsew', )
+        self._queue_button.grid( row=last, column=7, padx=[0,10], pady=[10,10], sticky='nsew', )
+        lb_detect.grid( row=last, column=0, padx=10, pady=[10,10], columnspan=3, sticky='nsew', )
+
+
+    def _add_image_row( self ):
+        '''Add a row of Source, Bytes & Flash Offset for one more image.'''
+        default = self.fonts['default']
+        index = len( self._filename )
+        self._filename.append( tk.StringVar() )
+        self._filebasename.append( tk.StringVar() )
+        self._address.append( tk.StringVar( value=FlashFirmware.OFFSETS[index] ) )
+        self._size.append( tk.IntVar() )
+        source = ttk.Entry( self, textvariable=self._filebasename[index], font=default,
+                            width=36, state="readonly", takefocus=False,
+                            justify='center' )
+        find = ttk.Button( self, text='...', width=2, image=self.pic_folder,
+                           style='find.TButton',
+                           command=lambda: self._get_sources( index=index ) )
+        find.bind( '<KeyPress-Return>', lambda event: self._get_sources( event, index ) )
+        byte = ttk.Label( self, textvariable=self._size[index], width=9,
+                          style='bytes.TLabel' )
+        offset = ttk.Entry( self, textvariable=self._address[index], font=default,
+                            width=9, justify='center' )
+        row = index + 1
+        source.grid(    row=row, column=0, padx=[10,0], pady=[5,0], ipady=3 )
+        find.grid(      row=row, column=1, padx=[ 2,0], pady=[5,0], )
+        byte.grid(      row=row, column=2, padx=[10,0], pady=[5,0], )
+        offset.grid(    row=row, column=3, padx=[10,0], pady=[5,0], ipady=3 )
+        if len( self._filename ) >= FlashFirmware.MAX_IMAGES:
+            self._add['state'] = 'disable'
 
        
     #### Widget Methods
-    def _get_sources( self, event=None ):
+    def _get_sources( self, event=None, index=0 ):
         filename = filedialog.askopenfilename(
             #defaultextension='bin',
             filetypes=[('bin','*.bin'),('py','*.py'), ('all files','*.*')],
             title='Select Firmware' )
         if filename:
-            self._filename.set( filename )
-            self._filebasename.set( os.path.basename( filename ) )
-            self._size.set( self._get_file_size( filename ) )
+            self._filename[index].set( filename )
+            self._filebasename[index].set( os.path.basename( filename ) )
+            self._size[index].set( self._get_file_size( filename ) )
+            self._preflight( index )
         else:
-            self._filename.set( '' )
-            self._filebasename.set( os.path.basename( '' ) )
-            self._size.set( 0 )
-        self._update_status('')
+            self._filename[index].set( '' )
+            self._filebasename[index].set( os.path.basename( '' ) )
+            self._size[index].set( 0 )
+            self._update_status('')
+
+
+    def _preflight( self, index ):
+        '''Check the Source of row index offline and show the outcome.'''
+        try:
+            address = int( self._address[index].get(), 16 )
+            result = preflight.check( self._filename[index].get(), address,
+                                      self._detected_flash_size() )
+        except ValueError:
+            return #Flash Offset is checked by WRITE
+        except OSError as err:
+            self.style.configure( 'write.TLabel', foreground='red' )
+            self._update_status( "Can't read: {}".format( err.strerror ) )
+            return
+        for warning in result.warnings:
+            log.warning( '%s: %s', self._filebasename[index].get(), warning )
+        self.style.configure( 'write.TLabel', foreground='black' if result.ok else 'red' )
+        self._update_status( str( result ) )
             
 
     def _get_file_size( self, file ):
@@ -584,77 +796,98 @@ class FlashFirmware(ttk.Labelframe):
         #self._status_color = 'blue'
         self.style.configure( 'write.TLabel', foreground='blue' )
         self._write['state'] = 'disable'
+        self._read['state'] = 'disable'
+        self._queue_button['state'] = 'disable'
+        self._gang['state'] = 'disable'
         if self.device:
             self.device.ports['state'] = 'disable'
         self._update_status('Preprocessing....')
 
         #2. Create agrs
         if not self._create_args():
-            print( "\nFlashFirmware: Failed to create args.\n" )
+            log.error( 'FlashFirmware: Failed to create args.' )
             self._post_write_flash_sop()
             return False
         args = self.args
     
         #3. Setup esp
-        #3.1 Use "stub loader" program instead of the UART bootloader in the ESP32 ROM.
-        if self.device.esp:
-            esp = self.device.esp
-            if not esp.IS_STUB:
-                try:
-                    esp = esp.run_stub()
-                except esptool.FatalError as err:
-                    self._post_write_flash_sop()
-                    self._update_status( err.__str__() )
-                    print( err )
-                    return False
-        else:
+        if not self.device.esp:
+            self._close_args_files()
             self._post_write_flash_sop()
-            print( "\nFlashFirmware: esp needs to be connected first.\n" )
-            print( ' -- ', err.__str__() )
+            log.error( 'FlashFirmware: esp needs to be connected first.' )
             return False
-                
-        #3.2 Use a different baud to write flash if avaialble
-        if args.baud != esptool.ESPLoader.ESP_ROM_BAUD:
-            self._change_baud( esp, args.baud )
-
-        #3.3 Use esptool.py "Default SPI flash interface" to write to flash chip.
-        #    Commented code is useful if the option of having non-default SPI is preferred.
-        #     https://github.com/espressif/esptool/wiki/Serial-Protocol#spi-attach-command
-        '''if hasattr( args, "spi_connection" ) and args.spi_connection is not None:
-            if esp.CHIP_NAME != "ESP32":
-                self._post_write_flash_sop()
-                raise FatalError( "Chip %s does not support --spi-connection option." % esp.CHIP_NAME )
-            print( "Configuring SPI flash mode..." )
-            esp.flash_spi_attach( args.spi_connection )
-        elif args.no_stub:
-            print( "Enabling default SPI flash mode..." )
-            # ROM loader doesn't enable flash unless we explicitly do it
-            esp.flash_spi_attach( 0 )'''
-
-        #3.4 Set some parameters of the SPI flash chip
-        if hasattr(args, "flash_size"):
-            print( "Configuring flash size..." )
-            esptool.detect_flash_size( esp, args )
-            esp.flash_set_parameters( esptool.flash_size_bytes( args.flash_size ) )
-
-        #print('\nargs = '); pprint( args.__dict__ )
-        #print('\nesp = '); pprint( esp.__dict__ )
-        #print('\nesp._port = '); pprint( esp._port.__dict__ )
-
-        #4. Start writing
+
+        #4. Start writing in a worker thread, so that the GUI stays responsive.
+        #   The worker reports to the GUI via self._queue; see self._drain_queue().
         self._writing = True
         self._completed = False
-        self._update_status( 'Writing....' )
+        self._cancel.clear()
+        self.device.busy = True
+        self._write.configure( text='CANCEL', command=self._cancel_write_flash,
+                               state='normal' )
+        keep_session = bool( self._keep_session.get() )
+        self._worker = threading.Thread( target=self._write_flash_worker,
+                                         args=( self.device.esp, args, keep_session,
+                                                self.device.info.get( 'mac' ) ),
+                                         name='write_flash', daemon=True )
+        self._worker.start()
+        self._drain_queue()
+        return True
+
+
+    def _write_flash_worker( self, esp, args, keep_session=False, mac=None ):
+        '''Setup esp and write to flash. Runs in a worker thread.
+
+        With keep_session, esp is left running the stub loader at the write
+        baud, so that the next write skips the stub upload & baud change.
+        A good write is recorded in esp32registry for the board mac.
+
+        It must not touch any Tk widget or variable. Progress is put in
+        self._queue as ('status', msg) and the outcome as ('done', esp, results)
+        or ('failed', esp, err).'''
+        esp32log.set_context( port=esp._port.port, mac=mac )
+        args.metrics = esp32metrics.Session( 'write', esp._port.port, mac )
+        error = None
         try:
+            #1. Use "stub loader" program instead of the UART bootloader in the ESP32 ROM.
+            #2. Use a different baud to write flash if avaialble
+            #3. Set some parameters of the SPI flash chip
+            esp = engine.setup_esp( esp, args, self._post_status )
+
+            #4. Use esptool.py "Default SPI flash interface" to write to flash chip.
+            #    Commented code is useful if the option of having non-default SPI is preferred.
+            #     https://github.com/espressif/esptool/wiki/Serial-Protocol#spi-attach-command
+            '''if hasattr( args, "spi_connection" ) and args.spi_connection is not None:
+                if esp.CHIP_NAME != "ESP32":
+                    raise FatalError( "Chip %s does not support --spi-connection option." % esp.CHIP_NAME )
+                print( "Configuring SPI flash mode..." )
+                esp.flash_spi_attach( args.spi_connection )
+            elif args.no_stub:
+                print( "Enabling default SPI flash mode..." )
+                # ROM loader doesn't enable flash unless we explicitly do it
+                esp.flash_spi_attach( 0 )'''
+
+            #5. Write
+            self._post_status( 'Writing....' )
             #esptool.write_flash( esp, args )      #original
-            self._esptool_write_flash( esp, args ) #allow more detailed display of the write to flash progress.
-        except esptool.FatalError:
-            self._post_write_flash_sop()
-            raise
+            results = self._esptool_write_flash( esp, args ) #allow more detailed display of the write to flash progress.
+            if mac:
+                esp32registry.record_write( mac, results, esp._port.baudrate, esp._port.port )
+            if not keep_session:
+                log.info( 'Revert to default Baud...' )
+                engine.change_baud( esp, esptool.ESPLoader.ESP_ROM_BAUD )
+        except Exception as err: #Any error, so that the GUI is never left busy
+            error = err
+            if isinstance( err, ( esptool.FatalError, SerialException, OSError ) ):
+                log.error( err )
+            else:
+                log.exception( err )
+            self._queue.put( ( 'failed', esp, err ) )
         else:
-            print( '\nRevert to default Baud...' )
-            self._change_baud( esp, esptool.ESPLoader.ESP_ROM_BAUD )            
+            self._queue.put( ( 'done', esp, results ) )
         finally:
+            args.metrics.finish( error )
+            esp32metrics.export( args.metrics )
             try:  
                 # Clean up AddrFilenamePairAction files
                 for address, argfile in args.addr_filename:
@@ -662,167 +895,355 @@ class FlashFirmware(ttk.Labelframe):
             except AttributeError:
                 pass
 
-        #5. Post writing setups
-        self._update_status( 'Completed writing Firmware to Flash.' )
-        self._post_write_flash_sop()
+
+    def _post_status( self, msg ):
+        '''Thread-safe self._update_status().'''
+        self._queue.put( ( 'status', msg ) )
+
+
+    def _drain_queue( self ):
+        '''Show the messages of the write worker. Runs in the Tk mainloop
+        every 100 ms until the worker is done.
+
+        Only the latest status is shown, so the GUI is repainted at most
+        10 times per second however fast the worker writes.'''
+        status = None
+        outcome = None
+        while True:
+            try:
+                message = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if message[0] == 'status':
+                status = message[1]
+            else:
+                outcome = message
+        if status is not None:
+            self.status.set( status )
+        if outcome is None:
+            self.after( 100, self._drain_queue )
+            return
+
+        #Post writing setups
+        kind, esp, value = outcome #value is the results, the ReadResult or the error
         self.device.esp = esp
-        print()
-        return True
+        self.device.busy = False
+        self._write.configure( text='WRITE', command=self._write_flash )
+        self._read.configure( text='READ', command=self._read_flash )
+        if kind == 'read':
+            self._update_status( 'Completed reading {} bytes of Flash{}.'.format(
+                value.size, ', MD5 verified' if value.verified else '' ) )
+        elif isinstance( value, engine.ReadCancelled ):
+            #The stub is still sending the rest of the flash.
+            self.device.release()
+            self._update_status( 'Read cancelled. Reselect Port to connect again.' )
+        elif kind == 'done':
+            skipped = sum( result.skipped for result in value )
+            if skipped:
+                self._update_status( 'Completed writing Firmware to Flash '
+                                     '({} bytes unchanged).'.format( skipped ) )
+            else:
+                self._update_status( 'Completed writing Firmware to Flash.' )
+        else:
+            self._update_status( value.__str__() )
+        self._post_write_flash_sop()
+
+
+    def _cancel_write_flash( self ):
+        '''Ask the write or read worker to stop after the block being sent.'''
+        self._cancel.set()
+        self._write['state'] = 'disable'
+        self._read['state'] = 'disable'
+        self._update_status( 'Cancelling....' )
+
+
+    def stop( self ):
+        '''Cancel a write in progress and wait for the write worker to end.'''
+        if self._worker and self._worker.is_alive():
+            self._cancel.set()
+            self._worker.join( timeout=5 )
+        if self._scheduler and self._scheduler.is_alive():
+            self._scheduler.stop( cancel=True )
+            self._scheduler.join( timeout=5 )
 
 
     #### Command Methods
     def _esptool_write_flash( self, esp, args ):
         '''Method to write to flash.
 
-        This method implements the esptool.py v2.6 write_flash(esp, args)
-        function with some modifications. The modifications are to allow the
-        progress of the write_flash(esp, args) to be shown in this GUI class.'''
-        # set args.compress based on default behaviour:
-        # -> if either --compress or --no-compress is set, honour that
-        # -> otherwise, set --compress unless --no-stub is set
-        if args.compress is None and not args.no_compress:
-            args.compress = not args.no_stub
-
-        # verify file sizes fit in flash
-        msg = 'Verifying file sizes can fit in flash...'
-        self._update_status( msg ); print( msg )
-        flash_end = esptool.flash_size_bytes( args.flash_size )
-        for address, argfile in args.addr_filename:
-            argfile.seek(0,2)  # seek to end
-            if address + argfile.tell() > flash_end:
-                raise esptool.FatalError(("File %s (length %d) at offset %d will not fit in %d bytes of flash. " +
-                                 "Use --flash-size argument, or change flashing address.")
-                                 % (argfile.name, argfile.tell(), address, flash_end))
-            argfile.seek(0)
-
-        if args.erase_all:
-            msg = 'Erasing flash (this may take a while)...'
-            self._update_status( msg )
-            esptool.erase_flash( esp, args )
-
-        for address, argfile in args.addr_filename:
-            if args.no_stub:
-                #print( 'Erasing flash...' )
-                msg = 'Erasing flash...'
-                self._update_status( msg ); print( msg )
-            image = esptool.pad_to( argfile.read(), 4 )
-            if len(image) == 0:
-                #print( 'WARNING: File %s is empty' % argfile.name )
-                msg = 'WARNING: File %s is empty' % argfile.name
-                self._update_status( msg ); print( msg )
-                continue
-            image = esptool._update_image_flash_params( esp, address, args, image )
-            calcmd5 = hashlib.md5( image ).hexdigest()
-            uncsize = len( image )
-            if args.compress:
-                uncimage = image
-                image = zlib.compress( uncimage, 9 )
-                ratio = uncsize / len( image )
-                blocks = esp.flash_defl_begin( uncsize, len(image), address )
-            else:
-                ratio = 1.0
-                blocks = esp.flash_begin( uncsize, address )
-            argfile.seek(0)  # in case we need it again
-            seq = 0
-            written = 0
-            t = time.time()
-            while len(image) > 0:
-                #print( '\rWriting at 0x%08x... (%d %%)' % ( address + seq * esp.FLASH_WRITE_SIZE, 100 * (seq + 1) // blocks), end='' )
-                msg = 'Writing at 0x%08x... (%d %%)' % ( address + seq * esp.FLASH_WRITE_SIZE, 100 * (seq + 1) // blocks)
-                self._update_status( msg ); print( msg, end='' )
-                sys.stdout.flush()
-                block = image[ 0:esp.FLASH_WRITE_SIZE ]
-                if args.compress:
-                    esp.flash_defl_block( block, seq, timeout=esptool.DEFAULT_TIMEOUT * ratio * 2 )
-                else:
-                    # Pad the last block
-                    block = block + b'\xff' * ( esp.FLASH_WRITE_SIZE - len(block) )
-                    esp.flash_block( block, seq )
-                image = image[ esp.FLASH_WRITE_SIZE: ]
-                seq += 1
-                written += len(block)
-            t = time.time() - t
-            speed_msg = ""
-            if args.compress:
-                if t > 0.0:
-                    speed_msg = " (effective %.1f kbit/s)" % ( uncsize / t * 8 / 1000 )
-                print( 'Wrote %d bytes (%d compressed) at 0x%08x in %.1f seconds%s...' % ( uncsize, written, address, t, speed_msg ) )
-            else:
-                if t > 0.0:
-                    speed_msg = " (%.1f kbit/s)" % ( written / t * 8 / 1000 )
-                print( 'Wrote %d bytes at 0x%08x in %.1f seconds%s...' % ( written, address, t, speed_msg ) )
-            msg = 'Writing completed in %.1f seconds%s...' % ( t, speed_msg )
-            self._update_status( msg )
-            try:
-                res = esp.flash_md5sum( address, uncsize )
-                if res != calcmd5:
-                    print( 'File  md5: %s' % calcmd5 )
-                    print( 'Flash md5: %s' % res )
-                    print( 'MD5 of 0xFF is %s' % ( hashlib.md5( b'\xFF' * uncsize ).hexdigest() ) )
-                    raise esptool.FatalError("MD5 of file does not match data in flash!")
-                else:
-                    #print( 'Hash of data verified.' )
-                    msg = 'Hash of data verified.'
-                    self._update_status( msg ); print( msg )
-            except esptool.NotImplementedInROMError:
-                pass
+        This method wraps esp32flashengine.write_flash(), an implementation of
+        the esptool.py v2.6 write_flash(esp, args) function, to allow the
+        progress of the write to flash to be shown in this GUI class.
+        It runs in the write worker thread.'''
+        def progress( report ):
+            #Called at most args.progress_rate times per second; see
+            #esp32flashengine.ProgressReporter.
+            msg = str( report )
+            self._post_status( msg ); log.debug( msg )
+
+        return engine.write_flash( esp, args, status=self._post_status,
+                                   progress=progress, cancel=self._cancel )
 
-        print('\nLeaving...')
 
-        if esp.IS_STUB:
-            # skip sending flash_finish to ROM loader here,
-            # as it causes the loader to exit and run user code
-            esp.flash_begin(0, 0)
-            if args.compress:
-                esp.flash_defl_finish(False)
+    def _read_flash( self ):
+        '''Dump the whole flash of the connected ESP32 to a file.'''
+        if not self.device.esp or self.device.busy:
+            self._update_status( "Can't read: Please select Port first." )
+            return False
+        flash_size = self._detected_flash_size()
+        if not flash_size:
+            self._update_status( "Can't read: Detected invalid Flash size." )
+            return False
+        try:
+            baud = self.device.baud.get()
+        except tk.TclError:
+            baud = None
+        if not baud:
+            self._update_status( "Can't read: No Baud." )
+            return False
+        filename = filedialog.asksaveasfilename(
+            defaultextension='.bin', filetypes=[('bin','*.bin'), ('all files','*.*')],
+            title='Save Flash' )
+        if not filename:
+            return False
+        try:
+            outfile = open( filename, 'wb' )
+        except OSError as err:
+            self._update_status( "Can't read: {}".format( err.strerror ) )
+            return False
+
+        args = engine.Args()
+        args.chip = 'esp32'
+        args.no_stub = False
+        args.baud = baud
+        args.auto_baud = bool( self.device.auto_baud.get() )
+        args.flash_size = flash_size
+
+        self.style.configure( 'write.TLabel', foreground='blue' )
+        self._update_status( 'Reading....' )
+        self._write['state'] = 'disable'
+        self._gang['state'] = 'disable'
+        self._queue_button['state'] = 'disable'
+        self.device.ports['state'] = 'disable'
+        self._cancel.clear()
+        self.device.busy = True
+        self._read.configure( text='CANCEL', command=self._cancel_write_flash )
+        keep_session = bool( self._keep_session.get() )
+        self._worker = threading.Thread( target=self._read_flash_worker,
+                                         args=( self.device.esp, args, outfile, keep_session ),
+                                         name='read_flash', daemon=True )
+        self._worker.start()
+        self._drain_queue()
+        return True
+
+
+    def _read_flash_worker( self, esp, args, outfile, keep_session=False ):
+        '''Setup esp and read its whole flash into outfile, which is closed.
+        Runs in a worker thread and reports like self._write_flash_worker(),
+        with ('read', esp, result) as the outcome of a read.'''
+        def progress( report ):
+            msg = str( report )
+            self._post_status( msg ); log.debug( msg )
+
+        esp32log.set_context( port=esp._port.port )
+        args.metrics = esp32metrics.Session( 'read', esp._port.port )
+        error = None
+        try:
+            esp = engine.setup_esp( esp, args, self._post_status )
+            result = engine.read_flash( esp, args, 0, esptool.flash_size_bytes( args.flash_size ),
+                                        outfile, status=self._post_status,
+                                        progress=progress, cancel=self._cancel )
+            if not keep_session:
+                log.info( 'Revert to default Baud...' )
+                engine.change_baud( esp, esptool.ESPLoader.ESP_ROM_BAUD )
+        except Exception as err: #Any error, so that the GUI is never left busy
+            error = err
+            if isinstance( err, ( esptool.FatalError, SerialException, OSError ) ):
+                log.error( err )
             else:
-                esp.flash_finish(False)
+                log.exception( err )
+            outfile.close()
+            os.remove( outfile.name ) #Don't leave a partial dump
+            self._queue.put( ( 'failed', esp, err ) )
+        else:
+            outfile.close()
+            log.info( 'Flash saved to %s.', outfile.name )
+            self._queue.put( ( 'read', esp, result ) )
+        finally:
+            args.metrics.finish( error )
+            esp32metrics.export( args.metrics )
+
+
+    def _gang_write_flash( self ):
+        '''Write the firmware to every attached ESP32 in parallel.'''
+        self.style.configure( 'write.TLabel', foreground='blue' )
+        self._write['state'] = 'disable'
+        self._gang['state'] = 'disable'
+        self._read['state'] = 'disable'
+        self._queue_button['state'] = 'disable'
+        self.device.ports['state'] = 'disable'
+        self._update_status('Preprocessing....')
+
+        ports = [ port for port in engine.find_ports()
+                  if not engine.port_is_busy( port ) ]
+        if not ports:
+            self._post_write_flash_sop()
+            self._update_status( "Can't write: No ESP32 found." )
+            return False
+
+        if not self._create_args( gang=True ):
+            log.error( 'FlashFirmware: Failed to create args.' )
+            self._post_write_flash_sop()
+            return False
+
+        #The port of the selected device is needed by the gang.
+        self.device.release()
+
+        log.info( 'Gang-flashing %d ESP32 devices: %s', len(ports), ports )
+        self._gangflasher = esp32gangflash.GangFlasher( ports, self.args )
+        self._gangflasher.start()
+        self._monitor_gang_write_flash()
+        return True
+
 
-        if args.verify:
-            print( 'Verifying just-written flash...' )
-            print( '(This option is deprecated, flash contents are now always read back after flashing.)' )
-            msg = 'Verifying just-written flash...'
-            self._update_status( msg ); #print( msg )            
-            esptool.verify_flash( esp, args )
-            msg = '-- verify OK (digest matched)'
-            self._update_status( msg ); #print( msg )
+    def _monitor_gang_write_flash( self ):
+        gang = self._gangflasher
+        if gang.is_alive():
+            self._update_status( gang.summary() )
+            self.after( 200, self._monitor_gang_write_flash )
+            return
+
+        for device in gang.devices:
+            log.info( '%s', device )
+        for address, argfile in self.args.addr_filename:
+            argfile.close()
+        self._update_status( gang.summary() )
+        self._post_write_flash_sop()
 
 
-    def _create_args(self):
+    def _queue_write_flash( self ):
+        '''Write the firmware to a number of boards as jobs of a
+        FlashScheduler: each board is written on whichever port it is
+        plugged in, and transient failures are retried.'''
+        boards = simpledialog.askinteger( 'Queue', 'Number of boards to write:',
+                                          minvalue=1, parent=self )
+        if not boards:
+            return False
+        self.style.configure( 'write.TLabel', foreground='blue' )
+        self._write['state'] = 'disable'
+        self._gang['state'] = 'disable'
+        self._read['state'] = 'disable'
+        self.device.ports['state'] = 'disable'
+        self._update_status('Preprocessing....')
+
+        if not self._create_args( gang=True ):
+            log.error( 'FlashFirmware: Failed to create args.' )
+            self._post_write_flash_sop()
+            return False
+        images = [ ( address, argfile.name ) for address, argfile in self.args.addr_filename ]
+        self._close_args_files()
+        self.args.flash_size = 'detect'
+        self.args.stream_compress = True #Each job writes one device
+
+        #The port of the selected device is needed by the scheduler.
+        self.device.release()
+
+        self._scheduler = esp32scheduler.FlashScheduler( FlashFirmware.QUEUE_WORKERS, args=self.args )
+        for i in range( boards ):
+            self._scheduler.submit( esp32scheduler.FlashJob( None, images ) )
+        log.info( 'Queued %d boards.', boards )
+        self._scheduler.start()
+        self._queue_button.configure( text='STOP', command=self._stop_queue_write_flash )
+        self._monitor_queue_write_flash()
+        return True
+
+
+    def _monitor_queue_write_flash( self ):
+        scheduler = self._scheduler
+        if scheduler.is_alive():
+            self._update_status( scheduler.summary() )
+            self.after( 500, self._monitor_queue_write_flash )
+            return
+
+        for job in scheduler.jobs:
+            log.info( '%s', job )
+        log.info( '%s', scheduler.stats() )
+        self._queue_button.configure( text='QUEUE', command=self._queue_write_flash )
+        self._update_status( scheduler.summary() )
+        self._post_write_flash_sop()
+
+
+    def _stop_queue_write_flash( self ):
+        '''Cancel the queued boards. The boards being written are finished.'''
+        self._scheduler.stop()
+        self._queue_button['state'] = 'disable'
+        self._update_status( 'Stopping....' )
+
+
+    def _create_args( self, gang=False ):
+        '''Create self.args. For a gang-flash, port & flash size are per device.'''
         self._update_status( 'Preprocessing: args....' )
         
-        self.args = Args()
+        self.args = engine.Args()
         self.args.chip = 'esp32'
         self.args.no_stub = False
 
-        self.args.baud = self.device.baud.get()
+        try:
+            self.args.baud = self.device.baud.get()
+        except tk.TclError:
+            self.args.baud = None
         if not self.args.baud:
             self._update_status( "Can't write: No Baud." )
             return False
  
-        self.args.port = self.device.port.get()
-        if not self.args.port or self.args.port=='-- please select --':
-            self._update_status( "Can't write: Please select Port first." )
-            return False
+        if not gang: #Each worker of a gang-flash has its own port.
+            self.args.port = self.device.port.get()
+            if not self.args.port or self.args.port=='-- please select --':
+                self._update_status( "Can't write: Please select Port first." )
+                return False
 
-        if not self._set_args_flash_size():
+        if gang:
+            pass #flash size is detected by each worker of the gang
+        elif not self._set_args_flash_size():
             self._update_status( "Can't write: Detected invalid Flash size." )
             return False
 
         if not self._set_args_addr_filename():
             self._update_status( "Can't write: Please provide Source/Offset first." )
             return False
+        try:
+            engine.check_overlap( self.args )
+            preflight.check_args( self.args )
+        except ( esptool.FatalError, OSError ) as err:
+            self._close_args_files()
+            self._update_status( "Can't write: {}".format( err ) )
+            return False
 
         self._set_args_erase_all()
+        self.args.delta = bool( self._delta.get() )
+        self.args.auto_baud = bool( self.device.auto_baud.get() )
+        self.args.compress_level = 'auto'
+        #A gang-flash shares one compressed image, so only stream a single write.
+        self.args.stream_compress = not gang
+        if self._image_cache is None:
+            self._image_cache = esp32imagecache.ImageCache()
+        self.args.image_cache = self._image_cache
         return True
 
 
-    def _set_args_flash_size( self ):
+    def _detected_flash_size( self ):
+        '''Return the flash size of the connected ESP32, e.g. '4MB', or None.'''
+        size = None
         for key in esptool.ESP32ROM.FLASH_SIZES:
             if key in self.device.flashsize.get():
-                self.args.flash_size = key
+                size = key
+        return size
+
+
+    def _set_args_flash_size( self ):
+        self.args.flash_size = self._detected_flash_size() or 'detect'
         if self.args.flash_size == 'detect':
-            print( "Invalid flash size used." )
+            log.error( 'Invalid flash size used.' )
             return False
         else:
             return True
@@ -830,24 +1251,32 @@ class FlashFirmware(ttk.Labelframe):
 
     def _set_args_addr_filename( self ):
         '''Convert addr, filename from a tuple of string & string to a tuple of
-        integer and open file.'''
+        integer and open file, for every image row with a Source.'''
         self.args.addr_filename = []
-        try:
-            addr = self._address.get()
-            addr = int( addr, 16 )
-        except ValueError as err:
-            #addr is not a hexidecimal 
-            return False
-        else:
+        for address, filename in zip( self._address, self._filename ):
+            if not filename.get():
+                continue #Unused row
+            try:
+                addr = address.get()
+                addr = int( addr, 16 )
+            except ValueError as err:
+                #addr is not a hexidecimal 
+                self._close_args_files()
+                return False
             try:
-                filename = self._filename.get()
-                filename = open(filename,'rb+')
+                argfile = open( filename.get(), 'rb+' )
             except IOError as err:
                 #Error open filename
+                self._close_args_files()
                 return False
-            else:
-                self.args.addr_filename.append( ( addr, filename ) )
-        return True
+            self.args.addr_filename.append( ( addr, argfile ) )
+        return len( self.args.addr_filename ) > 0
+
+
+    def _close_args_files( self ):
+        for address, argfile in self.args.addr_filename:
+            argfile.close()
+        self.args.addr_filename = []
 
 
     def _set_args_erase_all( self ):
@@ -861,80 +1290,116 @@ class FlashFirmware(ttk.Labelframe):
         self._writing = False
         self._completed = True
         self._write['state'] = 'normal'
+        self._read['state'] = 'normal'
+        self._queue_button['state'] = 'normal'
+        self._gang['state'] = 'normal'
         self.device.ports['state'] = 'normal'
         self.style.configure( 'write.TLabel', foreground='black' )
         self.update_idletasks()
 
 
-    def _change_baud( self, esp, baud ):
-        try:
-            esp.change_baud( baud )
-        except esptool.NotImplementedInROMError:
-            print("WARNING: ROM doesn't support changing baud rate. Keeping initial baud rate %d" % initial_baud)
-            self._post_write_flash_sop()
-            self._update_status( err.__str__() )
-            return False
-
-
-
-class Args(object):
 
-    def __init__( self ):
-        self.chip = None
-        self.port = None
-        #self.baud = esptool.ESPLoader.ESP_ROM_BAUD
-        self.baud = None
-        self.before = 'default_reset'
-        self.after = 'hard_reset'
-        self.no_stub = True
-        self.trace = True
-        self.override_vddsdio = "Off"
+class SerialMonitorPane(ttk.Labelframe):
+    '''GUI to show the output of the ESP32, e.g. its boot log, read by the
+    serial monitor of ESP32Device.'''
 
-        self.spi_connection = None
+    REFRESH_MS = 100  #Milliseconds between renders of new output
+    MAX_LINES  = 1000 #Lines kept in the pane
 
-        #positional arguments:
-        #load_ram
-        self.load_ram = None
-        self.filename = None
+    def __init__( self, master, device, style=None, fonts=None, *args, **kw ):
+        super().__init__( master, *args, **kw )
+        #Attributes
+        self.master = master
+        self.device = device
+        self.style = style
+        self.fonts = fonts
+        self.log = tk.IntVar( value=False ) #Append the output to a file
+        self._text = None
+        self._monitor = None  #SerialMonitor being shown
+        self._position = 0    #Position in self._monitor.buffer shown up to
+        self._decoder = None
 
-        #dump_mem
-        self.dump_mem = None
-        self.address = None
-        self.size = None
-        self.filename = None
+        #Methods Initialized
+        self._create_widgets()
+        self._render()
 
-        #read_mem
-        self.read_mem = None
-        self.address = None
 
-        #write_mem
-        self.write_mem = None
-        self.address = None
-        self.value = None
-        self.mask = None
+    def _create_widgets( self ):
+        lb_title = ttk.Label( self, text='Serial Monitor', style='header.TLabel' )
+        self['labelwidget'] = lb_title
 
-        #spi_flash
-        self.flash_freq = '40m'
-        self.flash_mode = 'dio' #Needs 'dio' to work 
-        self.flash_size = 'detect'
-        #self.flash_size = '4MB'
+        self._text = tk.Text( self, height=8, width=76, wrap='char',
+                              state='disabled', font='TkFixedFont' )
+        scroll = ttk.Scrollbar( self, orient='vertical', command=self._text.yview )
+        self._text['yscrollcommand'] = scroll.set
+        log = ttk.Checkbutton( self, text='Log to File', variable=self.log,
+                               command=self._set_log )
+        clear = ttk.Button( self, text='CLEAR', width=6, command=self._clear )
+
+        self.columnconfigure( 0, weight=1 )
+        self._text.grid( row=0, column=0, padx=[10,0], pady=[0,5], sticky='nsew', columnspan=2 )
+        scroll.grid(     row=0, column=2, padx=[0,10], pady=[0,5], sticky='ns' )
+        log.grid(        row=1, column=0, padx=10, pady=[0,10], sticky='w' )
+        clear.grid(      row=1, column=1, padx=[0,10], pady=[0,10], sticky='e', columnspan=2 )
+
+
+    def _set_log( self ):
+        path = None
+        if self.log.get():
+            path = filedialog.asksaveasfilename( title='Append ESP32 output to',
+                                                 defaultextension='.log',
+                                                 filetypes=( ('Log files','*.log'),
+                                                             ('All files','*.*') ) )
+            if not path:
+                self.log.set( False )
+                return
+        if not self.device.set_logfile( path ):
+            self.log.set( False )
+
+
+    def _clear( self ):
+        self._text['state'] = 'normal'
+        self._text.delete( '1.0', 'end' )
+        self._text['state'] = 'disabled'
+
+
+    def _render( self ):
+        '''Show the output received since the last render in one insert.'''
+        monitor = self.device.monitor
+        if monitor is not self._monitor:
+            self._monitor = monitor
+            self._position = 0
+            self._decoder = codecs.getincrementaldecoder( 'utf-8' )( errors='replace' )
+        if monitor:
+            data, self._position, lost = monitor.buffer.read( self._position )
+            if lost:
+                self._decoder.reset()
+                self._show( '\n[{} bytes lost]\n'.format( lost ) )
+            if data:
+                self._show( self._decoder.decode( data ).replace( '\r', '' ) )
+        self.after( SerialMonitorPane.REFRESH_MS, self._render )
+
+
+    def _show( self, text ):
+        at_end = self._text.yview()[1] >= 1.0
+        self._text['state'] = 'normal'
+        self._text.insert( 'end', text )
+        lines = int( self._text.index( 'end-1c' ).split( '.' )[0] )
+        if lines > SerialMonitorPane.MAX_LINES:
+            self._text.delete( '1.0', '{}.0'.format( lines - SerialMonitorPane.MAX_LINES + 1 ) )
+        self._text['state'] = 'disabled'
+        if at_end:
+            self._text.see( 'end' )
 
-        #write_flash
-        self.write_flash = None
-        self.erase_all = False
-        self.addr_filename = None
-        self.no_progress = True
-        self.verify = True
-        self.compress = True
-        self.no_compress = False
 
 
 def main():
-    print( '\n<<< ESP32FlashWriter >>>\n')
+    esp32log.setup()
+    log.info( '<<< ESP32FlashWriter >>>' )
     root = tk.Tk()
     root.resizable(width=False, height=False)
     root.title('ESP32 FLASH WRITER')
-    root.geometry('678x390+0+24')
+    root.geometry('678x580+0+24')
     root.rowconfigure(0, weight=1)
     root.columnconfigure(0, weight=1)
 
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+'''Gang-flash: write one firmware to every attached ESP32 in parallel.
+
+GangFlasher runs one worker thread per serial port. Every worker connects to
+its ESP32, uploads the stub, writes the firmware and verifies it, while
+keeping its own progress and result in a GangDevice instance. The firmware
+is padded, patched and compressed once per flash size and the resulting
+esp32flashengine.PreparedImage list is shared by all workers.
+
+Repository: https://github.com/sunbearc22/ESP32FlashWriter
+'''
+
+import copy
+import threading
+import time
+
+from serial.serialutil import SerialException
+import esptool
+
+import esp32flashengine as engine
+import esp32log
+import esp32metrics
+import esp32registry
+
+log = esp32log.get_logger( 'gang' )
+
+
+class GangDevice(object):
+    '''Progress and result of one ESP32 device of a gang-flash.'''
+
+    WAITING    = 'waiting'
+    CONNECTING = 'connecting'
+    WRITING    = 'writing'
+    DONE       = 'done'
+    FAILED     = 'failed'
+
+    def __init__( self, port ):
+        self.port = port
+        self.mac = None        #MAC of the ESP32, once connected
+        self.state = GangDevice.WAITING
+        self.percent = 0       #Progress of the image being written
+        self.message = ''      #Last status message of this device
+        self.results = []      #List of esp32flashengine.WriteResult
+        self.error = None      #Exception that failed this device
+        self.seconds = 0.0     #Duration from connecting to done/failed
+
+
+    def __str__( self ):
+        if self.state == GangDevice.FAILED:
+            return '{}: {} ({})'.format( self.port, self.state, self.error )
+        written = sum( result.uncsize for result in self.results )
+        return '{}: {} {} bytes in {:.1f} seconds'.format(
+            self.port, self.state, written, self.seconds )
+
+
+
+class GangFlasher(object):
+    '''Write the images of args.addr_filename to the ESP32 on every port.
+
+    args is an esp32flashengine.Args instance. It is copied for each worker,
+    so that each device can use its own detected flash size.'''
+
+    def __init__( self, ports, args ):
+        self.args = args
+        self.devices = [ GangDevice( port ) for port in ports ]
+        self._threads = []
+        self._images = {} # {flash_size: [PreparedImage, ...]}
+        self._lock = threading.Lock()
+
+
+    def start( self ):
+        '''Start one worker thread per device.'''
+        for device in self.devices:
+            thread = threading.Thread( target=self._worker, args=(device,),
+                                       name='gang-{}'.format( device.port ),
+                                       daemon=True )
+            self._threads.append( thread )
+            thread.start()
+
+
+    def join( self ):
+        for thread in self._threads:
+            thread.join()
+
+
+    def is_alive( self ):
+        return any( thread.is_alive() for thread in self._threads )
+
+
+    def count( self, state ):
+        return sum( 1 for device in self.devices if device.state == state )
+
+
+    def summary( self ):
+        return 'Gang: {} done, {} failed, {} busy of {} devices.'.format(
+            self.count( GangDevice.DONE ), self.count( GangDevice.FAILED ),
+            len( self.devices ) - self.count( GangDevice.DONE )
+            - self.count( GangDevice.FAILED ), len( self.devices ) )
+
+
+    def _get_images( self, esp, args, device ):
+        '''Return the shared PreparedImage list for args.flash_size.
+
+        The first worker to need a flash size prepares the images while the
+        other workers wait for it.'''
+        with self._lock:
+            images = self._images.get( args.flash_size )
+            if images is None:
+                device.message = 'Preparing image....'
+                with esp32metrics.timed( args.metrics, 'prepare' ):
+                    images = engine.prepare_images( esp, args )
+                self._images[ args.flash_size ] = images
+        return images
+
+
+    def _worker( self, device ):
+        esp32log.set_context( port=device.port )
+        args = copy.copy( self.args )
+        args.port = device.port
+        args.flash_size = 'detect'
+        # Every image is verified by its flash md5sum in engine.write_flash().
+        # esptool.verify_flash() re-reads the files, which are shared by all
+        # workers, so it is not used here.
+        args.verify = False
+        args.metrics = esp32metrics.Session( 'write', device.port )
+
+        def status( msg ):
+            device.message = msg
+
+        def progress( report ):
+            device.percent = report.percent
+
+        t = time.time()
+        esp = None
+        try:
+            device.state = GangDevice.CONNECTING
+            if engine.port_is_busy( device.port ):
+                raise SerialException( 'Port is used by another application.' )
+            esp = engine.open_esp( device.port, metrics=args.metrics )
+            with args.metrics.stage( 'read_mac' ):
+                device.mac = args.metrics.mac = engine.mac_address( esp )
+            esp32log.update_context( mac=device.mac )
+            esp = engine.setup_esp( esp, args, status )
+            images = self._get_images( esp, args, device )
+            device.state = GangDevice.WRITING
+            device.results = engine.write_flash( esp, args, images, status, progress )
+            esp32registry.record_write( device.mac, device.results, esp._port.baudrate,
+                                        device.port )
+            engine.hard_reset( esp )
+        except Exception as err: #Any error, so that the gang always finishes
+            if not isinstance( err, ( esptool.FatalError, SerialException, OSError ) ):
+                log.exception( '%s: unexpected error', device.port )
+            device.error = err
+            device.state = GangDevice.FAILED
+        else:
+            device.state = GangDevice.DONE
+        finally:
+            device.seconds = time.time() - t
+            if esp:
+                esp._port.close()
+            args.metrics.finish( device.error )
+            esp32metrics.export( args.metrics )
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+'''Hot-plug detection of USB serial ports.
+
+HotplugWatcher runs a thread that calls callback( event ) with a
+HotplugEvent when a USB serial port, e.g. /dev/ttyUSB0 or /dev/ttyACM0, is
+added or removed. It uses the first backend that works:
+   udev    -- netlink events of the tty subsystem, if pyudev is installed.
+   inotify -- create & delete events of /dev on Linux, through libc.
+   poll    -- esp32flashengine.find_ports() every second, e.g. on Windows.
+The first two are event driven, i.e. a port is reported as soon as the
+kernel has created or removed it.
+
+callback is called in the watcher thread. A GUI should hand the events to
+its mainloop, e.g. through a queue.Queue.
+
+Repository: https://github.com/sunbearc22/ESP32FlashWriter
+'''
+
+import ctypes
+import ctypes.util
+import os
+import platform
+import re
+import select
+import struct
+import threading
+
+import serial.tools.list_ports
+
+import esp32flashengine as engine
+import esp32log
+
+log = esp32log.get_logger( 'hotplug' )
+
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+
+
+USB_SERIAL = re.compile( r'tty(USB|ACM)\d+$' ) #Names of USB serial ports in /dev
+
+# inotify(7)
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_EVENT  = struct.Struct( 'iIII' ) #wd, mask, cookie, len of struct inotify_event
+
+
+class HotplugEvent(object):
+    '''A USB serial port that was added or removed.'''
+
+    ADD    = 'add'
+    REMOVE = 'remove'
+
+    def __init__( self, action, port, vid=None, pid=None, serial_number=None ):
+        self.action = action               #ADD or REMOVE
+        self.port = port                   #e.g. /dev/ttyUSB0
+        self.vid = vid                     #USB vendor id or None
+        self.pid = pid                     #USB product id or None
+        self.serial_number = serial_number #USB serial number or None
+
+
+    def __str__( self ):
+        if self.vid is None:
+            return '{} {}'.format( self.action, self.port )
+        return '{} {} ({:04x}:{:04x} {})'.format( self.action, self.port, self.vid,
+                                                  self.pid, self.serial_number or '' )
+
+
+
+def port_attributes( port ):
+    '''Return ( vid, pid, serial_number ) of the USB device of port, or Nones.'''
+    for info in serial.tools.list_ports.comports():
+        if info.device == port:
+            return info.vid, info.pid, info.serial_number
+    return None, None, None
+
+
+
+class HotplugWatcher(object):
+    '''Call callback( HotplugEvent ) when a USB serial port comes or goes.'''
+
+    def __init__( self, callback, interval=1.0 ):
+        self.callback = callback
+        self.interval = interval #Seconds between scans of the poll backend
+        self.backend = None      #'udev', 'inotify' or 'poll' once started
+        self._ports = {}         #{port: ( vid, pid, serial_number )} of present ports
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    @property
+    def event_driven( self ):
+        '''True unless the ports are polled.'''
+        return self.backend in ( 'udev', 'inotify' )
+
+
+    def start( self ):
+        for port in engine.find_ports():
+            self._ports[ port ] = port_attributes( port )
+        if pyudev is not None:
+            self.backend, target = 'udev', self._watch_udev
+        elif 'Linux' in platform.system() and os.path.isdir( '/dev' ):
+            self.backend, target = 'inotify', self._watch_inotify
+        else:
+            self.backend, target = 'poll', self._watch_poll
+        self._thread = threading.Thread( target=target, name='hotplug', daemon=True )
+        self._thread.start()
+
+
+    def stop( self ):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+
+    def _added( self, port, attributes=None ):
+        if port in self._ports:
+            return
+        attributes = attributes or port_attributes( port )
+        self._ports[ port ] = attributes
+        self.callback( HotplugEvent( HotplugEvent.ADD, port, *attributes ) )
+
+
+    def _removed( self, port ):
+        if port not in self._ports:
+            return
+        attributes = self._ports.pop( port )
+        self.callback( HotplugEvent( HotplugEvent.REMOVE, port, *attributes ) )
+
+
+    #### Backends
+    def _watch_udev( self ):
+        context = pyudev.Context()
+        monitor = pyudev.Monitor.from_netlink( context )
+        monitor.filter_by( subsystem='tty' )
+        monitor.start()
+        while not self._stop.is_set():
+            device = monitor.poll( timeout=0.5 )
+            if device is None or not device.device_node:
+                continue
+            port = device.device_node
+            if not USB_SERIAL.search( port ):
+                continue
+            if device.action == 'add':
+                vid = device.get( 'ID_VENDOR_ID' )
+                pid = device.get( 'ID_MODEL_ID' )
+                attributes = ( int( vid, 16 ) if vid else None,
+                               int( pid, 16 ) if pid else None,
+                               device.get( 'ID_SERIAL_SHORT' ) )
+                self._added( port, attributes )
+            elif device.action == 'remove':
+                self._removed( port )
+
+
+    def _watch_inotify( self ):
+        libc = ctypes.CDLL( ctypes.util.find_library( 'c' ) or 'libc.so.6', use_errno=True )
+        fd = libc.inotify_init()
+        if fd < 0 or libc.inotify_add_watch( fd, b'/dev', IN_CREATE | IN_DELETE ) < 0:
+            log.warning( 'inotify is not available: %s', os.strerror( ctypes.get_errno() ) )
+            if fd >= 0:
+                os.close( fd )
+            self.backend = 'poll'
+            return self._watch_poll()
+        try:
+            while not self._stop.is_set():
+                ready, _, _ = select.select( [fd], [], [], 0.5 )
+                if not ready:
+                    continue
+                data = os.read( fd, 4096 )
+                offset = 0
+                while offset < len( data ):
+                    wd, mask, cookie, length = IN_EVENT.unpack_from( data, offset )
+                    offset += IN_EVENT.size
+                    name = data[ offset:offset+length ].rstrip( b'\0' ).decode( errors='replace' )
+                    offset += length
+                    if not USB_SERIAL.match( name ):
+                        continue
+                    port = '/dev/' + name
+                    if mask & IN_CREATE:
+                        self._added( port )
+                    elif mask & IN_DELETE:
+                        self._removed( port )
+        finally:
+            os.close( fd )
+
+
+    def _watch_poll( self ):
+        while not self._stop.wait( self.interval ):
+            ports = set( engine.find_ports() )
+            for port in sorted( ports - set( self._ports ) ):
+                self._added( port )
+            for port in sorted( set( self._ports ) - ports ):
+                self._removed( port )
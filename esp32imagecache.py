@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+
+'''Cache of prepared firmware images.
+
+Preparing an image pads it, patches the flash parameters of a bootloader,
+hashes it and compresses it with zlib at args.compress_level. For the same firmware written
+to many boards this work is the same every time, so ImageCache keeps the
+resulting esp32flashengine.PreparedImage in memory and in a directory below
+esp32settings.settings_dir(), which survives restarts of the application.
+Images in the disk cache are memory mapped rather than read, so a cached
+image held in memory costs page cache that the OS can reclaim.
+
+An entry is keyed by the sha256 of the file content, the flash offset, the
+flash mode, frequency and size and the compression level. Both the memory
+and the disk cache are bounded in bytes and evict the least recently used
+entries first. esp32flashengine.prepare_image() uses the cache given as
+args.image_cache.
+
+The sha256 of the content is computed for every lookup, a hit or a miss. It
+is a small part of the work a hit saves, i.e. the md5, the choice of the
+compression level and the zlib compression: about 2 to 5% of the time of a
+miss, while a hit takes about a sixth of it, see
+benchmarks/bench_image_cache.py. The mapping of an entry is closed
+once it is dropped from memory and no PreparedImage given out by get() uses
+it any more.
+
+Repository: https://github.com/sunbearc22/ESP32FlashWriter
+'''
+
+import collections
+import hashlib
+import json
+import mmap
+import os
+import threading
+import weakref
+
+import esp32flashengine as engine
+import esp32log
+import esp32settings
+
+log = esp32log.get_logger( 'imagecache' )
+
+
+MB = 1024 * 1024
+
+
+class ImageCache(object):
+    '''A least recently used cache of PreparedImage in memory and on disk.
+
+    directory is where entries are stored, by default settings_dir('cache').
+    With persistent=False, entries are only kept in memory.'''
+
+    def __init__( self, directory=None, persistent=True,
+                  max_memory=64*MB, max_disk=512*MB ):
+        self.directory = None
+        if persistent:
+            try:
+                self.directory = directory or esp32settings.settings_dir( 'cache' )
+            except OSError as err:
+                log.warning( 'Image cache is not kept on disk: %s', err )
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.hits = 0
+        self.misses = 0
+        self._memory = collections.OrderedDict() # {key: PreparedImage}
+        self._memory_bytes = 0
+        self._users = {}  # {id of a mapped image: PreparedImage of get() using it}
+        self._lock = threading.RLock() #_release() may run while it is held
+
+
+    @staticmethod
+    def key( data, address, args, level ):
+        '''Return the key of file content data written at address with the
+        flash parameters of args and compressed at zlib level (0 for none, or
+        e.g. 'auto@921600' for the level chosen for a baud).'''
+        content = hashlib.sha256( data ).hexdigest()
+        return hashlib.sha256( '{} {:x} {} {} {} {}'.format(
+            content, address, args.flash_mode, args.flash_freq,
+            args.flash_size, level ).encode() ).hexdigest()
+
+
+    def get( self, key, name ):
+        '''Return the PreparedImage of key, named name, or None when key is
+        not cached.'''
+        with self._lock:
+            prepared = self._memory.get( key )
+            if prepared is not None:
+                self._memory.move_to_end( key )
+            else:
+                prepared = self._load( key )
+                if prepared is not None:
+                    self._remember( key, prepared )
+            if prepared is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # The same content may come from a file of another name.
+            copy = engine.PreparedImage( prepared.address, name, prepared.image,
+                                         prepared.calcmd5, prepared.compressed,
+                                         prepared.level )
+            if isinstance( prepared.image, mmap.mmap ):
+                key = id( prepared.image )
+                self._users[ key ] = self._users.get( key, 0 ) + 1
+                weakref.finalize( copy, self._release, prepared.image )
+        return copy
+
+
+    def put( self, key, prepared ):
+        '''Cache prepared as the entry of key.'''
+        with self._lock:
+            self._forget( key ) #Unmap the stored copy before it is replaced
+            image = prepared.image
+            if self._store( key, prepared ):
+                # Map the stored copy, not the source file, which may be
+                # rewritten, e.g. by the next build.
+                try:
+                    image = self._map( key )
+                except ( OSError, ValueError ):
+                    pass
+            if image is prepared.image and isinstance( image, mmap.mmap ):
+                image = bytes( image )
+            self._remember( key, engine.PreparedImage(
+                prepared.address, prepared.name, image, prepared.calcmd5,
+                prepared.compressed, prepared.level ) )
+
+
+    def clear( self ):
+        '''Remove every entry from memory and disk.'''
+        with self._lock:
+            for key in list( self._memory ):
+                self._forget( key )
+            for key, size, mtime in self._disk_entries():
+                self._remove( key )
+
+
+    @staticmethod
+    def _size( prepared ):
+        '''Return the bytes of memory held by prepared, without the pages of
+        a mapped image.'''
+        size = len( prepared.compressed or b'' )
+        if not isinstance( prepared.image, mmap.mmap ):
+            size += prepared.uncsize
+        return size
+
+
+    def _forget( self, key ):
+        '''Drop the entry of key from memory. Its mapping is closed once no
+        PreparedImage given out by get() uses it any more.'''
+        old = self._memory.pop( key, None )
+        if old is not None:
+            self._memory_bytes -= self._size( old )
+            self._unmap( old.image )
+
+
+    def _release( self, image ):
+        '''Called when a PreparedImage of get() using image is freed.'''
+        with self._lock:
+            key = id( image )
+            self._users[ key ] -= 1
+            if self._users[ key ]:
+                return
+            del self._users[ key ]
+            if not any( prepared.image is image for prepared in self._memory.values() ):
+                self._unmap( image )
+
+
+    def _unmap( self, image ):
+        '''Close image if it is a mapping that is no longer used.'''
+        if not isinstance( image, mmap.mmap ) or id( image ) in self._users:
+            return
+        try:
+            image.close()
+        except BufferError: #Still exported, e.g. by a memoryview; closed by GC
+            pass
+
+
+    def _remember( self, key, prepared ):
+        self._memory[ key ] = prepared
+        self._memory_bytes += self._size( prepared )
+        while self._memory_bytes > self.max_memory and len( self._memory ) > 1:
+            self._forget( next( iter( self._memory ) ) )
+
+
+    def _path( self, key, ext ):
+        return os.path.join( self.directory, key + ext )
+
+
+    def _load( self, key ):
+        '''Return the PreparedImage of key stored on disk or None.'''
+        if not self.directory:
+            return None
+        try:
+            with open( self._path( key, '.json' ) ) as f:
+                meta = json.load( f )
+            image = self._map( key )
+            compressed = None
+            if meta['compressed']:
+                with open( self._path( key, '.z' ), 'rb' ) as f:
+                    compressed = f.read()
+            os.utime( self._path( key, '.json' ) ) # Mark as recently used
+        except ( OSError, ValueError, KeyError ):
+            return None
+        if hashlib.md5( image ).hexdigest() != meta['md5']:
+            image.close() #A mapped file can't be removed on Windows
+            self._remove( key )
+            return None
+        return engine.PreparedImage( meta['address'], meta['name'], image,
+                                     meta['md5'], compressed, meta.get( 'level', 9 ) )
+
+
+    def _map( self, key ):
+        '''Return a read-only mmap of the image of key.'''
+        with open( self._path( key, '.bin' ), 'rb' ) as f:
+            return mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+
+
+    def _store( self, key, prepared ):
+        '''Write prepared to disk. The metadata file is written last, so that
+        only complete entries are found by _load(). Returns True if it was
+        written.'''
+        if not self.directory:
+            return False
+        meta = { 'address': prepared.address, 'name': prepared.name,
+                 'md5': prepared.calcmd5, 'level': prepared.level,
+                 'compressed': prepared.compressed is not None }
+        try:
+            self._write( self._path( key, '.bin' ), prepared.image )
+            if prepared.compressed is not None:
+                self._write( self._path( key, '.z' ), prepared.compressed )
+            self._write( self._path( key, '.json' ), json.dumps( meta ).encode() )
+            self._evict_disk()
+        except OSError as err:
+            log.warning( 'Image cache not written to disk: %s', err )
+            return False
+        return os.path.exists( self._path( key, '.json' ) )
+
+
+    @staticmethod
+    def _write( path, data ):
+        tmp = path + '.tmp'
+        with open( tmp, 'wb' ) as f:
+            f.write( data )
+        os.replace( tmp, path )
+
+
+    def _disk_entries( self ):
+        '''Return a list of ( key, bytes, mtime ) of the entries on disk.'''
+        entries = []
+        if not self.directory:
+            return entries
+        for filename in os.listdir( self.directory ):
+            key, ext = os.path.splitext( filename )
+            if ext != '.json':
+                continue
+            try:
+                mtime = os.path.getmtime( self._path( key, '.json' ) )
+                size = sum( os.path.getsize( self._path( key, ext ) )
+                            for ext in ( '.bin', '.z' )
+                            if os.path.exists( self._path( key, ext ) ) )
+            except OSError:
+                continue
+            entries.append( ( key, size, mtime ) )
+        return entries
+
+
+    def _evict_disk( self ):
+        entries = sorted( self._disk_entries(), key=lambda entry: entry[2] )
+        total = sum( size for key, size, mtime in entries )
+        while total > self.max_disk and len( entries ) > 1:
+            key, size, mtime = entries.pop( 0 )
+            self._remove( key )
+            total -= size
+
+
+    def _remove( self, key ):
+        self._forget( key )
+        for ext in ( '.json', '.bin', '.z' ):
+            try:
+                os.remove( self._path( key, ext ) )
+            except FileNotFoundError:
+                pass
+            except OSError as err:
+                #e.g. on Windows, while a write still maps the image
+                log.warning( 'Image cache entry not removed: %s', err )
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+'''Logging of ESP32FlashWriter.
+
+The modules log to loggers below 'esp32flashwriter', see get_logger(), with
+the levels of the logging module:
+   DEBUG    -- progress of every block and dumps, e.g. of esp.__dict__.
+   INFO     -- the stages of a connection, write or read.
+   WARNING  -- something that was worked around.
+   ERROR    -- the failure of a device.
+
+setup() sends the records through a QueueHandler to a QueueListener thread,
+which formats and writes them, so that a worker writing flash never waits on
+a slow terminal or serial console. Records carry the port, mac and job of
+the device the logging thread works on, e.g.
+
+   esp32log.set_context( port='/dev/ttyUSB0', job=3 )
+   esp = engine.open_esp( port )
+   esp32log.update_context( mac='24:0a:c4:00:01:02' )
+
+and are written as lines of text, e.g. '[/dev/ttyUSB0 job 3] Hash of data
+verified.', or as one JSON object per line. The level and the format default
+to the ESP32FLASHWRITER_LOG (e.g. DEBUG) and ESP32FLASHWRITER_LOG_FORMAT
+(text or json) environment variables.
+
+Repository: https://github.com/sunbearc22/ESP32FlashWriter
+'''
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+
+
+LOGGER = 'esp32flashwriter'
+CONTEXT = ( 'port', 'mac', 'job' )
+
+_local = threading.local()
+_listener = None
+_lock = threading.Lock()
+
+
+def get_logger( name ):
+    '''Return the logger of module name, e.g. 'engine'.'''
+    return logging.getLogger( LOGGER + '.' + name )
+
+
+def set_context( **values ):
+    '''Set the port, mac and job of the records logged by this thread, e.g.
+    at the start of the work on a device.'''
+    _local.values = values
+
+
+def get_context():
+    '''Return a copy of the context of this thread, e.g. to set it in a
+    helper thread that works on the same device.'''
+    return dict( getattr( _local, 'values', {} ) )
+
+
+def update_context( **values ):
+    '''Add values, e.g. the mac once it is read, to the context of this
+    thread.'''
+    _local.values = dict( getattr( _local, 'values', {} ), **values )
+
+
+class ContextFilter(logging.Filter):
+    '''Stamp a record with the context of the thread that logs it.
+
+    It is a filter of the QueueHandler, so it runs in the logging thread
+    rather than in the QueueListener.'''
+
+    def filter( self, record ):
+        values = getattr( _local, 'values', {} )
+        for name in CONTEXT:
+            if not hasattr( record, name ):
+                setattr( record, name, values.get( name ) )
+        return True
+
+
+
+class TextFormatter(logging.Formatter):
+    '''Format a record as its message, after its context in brackets and its
+    level when it is not INFO.'''
+
+    def format( self, record ):
+        text = super().format( record ).strip( '\n' )
+        if record.levelno != logging.INFO:
+            text = '{}: {}'.format( record.levelname, text )
+        labels = [ str( record.port ) if getattr( record, 'port', None ) else '',
+                   str( record.mac ) if getattr( record, 'mac', None ) else '',
+                   'job {}'.format( record.job ) if getattr( record, 'job', None ) else '' ]
+        labels = ' '.join( label for label in labels if label )
+        return '[{}] {}'.format( labels, text ) if labels else text
+
+
+
+class JsonFormatter(logging.Formatter):
+    '''Format a record as a JSON object.'''
+
+    def format( self, record ):
+        entry = { 'time': round( record.created, 3 ),
+                  'level': record.levelname,
+                  'logger': record.name,
+                  'message': record.getMessage().strip( '\n' ) }
+        for name in CONTEXT:
+            value = getattr( record, name, None )
+            if value is not None:
+                entry[name] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException( record.exc_info )
+        return json.dumps( entry )
+
+
+
+def setup( level=None, json_format=None, stream=None, filename=None ):
+    '''Log the records of the 'esp32flashwriter' loggers at level and above
+    to stream, sys.stderr by default, and to filename if given, as JSON lines
+    with json_format. May be called again to change them.'''
+    global _listener
+    if level is None:
+        level = os.environ.get( 'ESP32FLASHWRITER_LOG', 'INFO' )
+    if json_format is None:
+        json_format = os.environ.get( 'ESP32FLASHWRITER_LOG_FORMAT', 'text' ) == 'json'
+    formatter = JsonFormatter() if json_format else TextFormatter()
+    handlers = [ logging.StreamHandler( stream or sys.stderr ) ]
+    if filename:
+        handlers.append( logging.FileHandler( filename ) )
+    for handler in handlers:
+        handler.setFormatter( formatter )
+
+    with _lock:
+        if _listener:
+            _listener.stop()
+        logger = logging.getLogger( LOGGER )
+        for handler in list( logger.handlers ):
+            logger.removeHandler( handler )
+        logger.setLevel( level.upper() if isinstance( level, str ) else level )
+        logger.propagate = False
+        handler = logging.handlers.QueueHandler( queue.SimpleQueue() )
+        handler.addFilter( ContextFilter() )
+        logger.addHandler( handler )
+        _listener = logging.handlers.QueueListener( handler.queue, *handlers )
+        _listener.start()
+    return logger
+
+
+def shutdown():
+    '''Write the records still queued and stop the listener.'''
+    global _listener
+    with _lock:
+        if _listener:
+            _listener.stop()
+            _listener = None
+
+
+atexit.register( shutdown )
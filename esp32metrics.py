@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+'''Timing metrics of every stage of the work on an ESP32.
+
+A Session records the duration and the bytes of each stage of one connection,
+write or read of a board: e.g. opening the port, connecting, reading the chip
+info, running the stub, changing the baud, erasing and, per image, preparing,
+transmitting and the flash md5sum. esp32flashengine times the stages of a
+Session given as args.metrics, and open_esp() those given as its metrics.
+
+export() appends the record of a finished Session as one JSON line to
+esp32flashwriter.jsonl and adds it to the totals of every process, kept in
+esp32flashwriter.totals.json. It rewrites esp32flashwriter.prom, the totals
+in the Prometheus text format, which the textfile collector of node_exporter
+reads:
+
+   node_exporter --collector.textfile.directory ~/.esp32flashwriter/metrics
+
+The files are in settings_dir('metrics'), or in the directory named by the
+ESP32FLASHWRITER_METRICS environment variable. A GUI and any number of CLI
+runs may export at the same time: they take turns through a lock of
+esp32flashwriter.lock, so the counters never go backwards.
+
+Repository: https://github.com/sunbearc22/ESP32FlashWriter
+'''
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError: #Windows
+    fcntl = None
+    import msvcrt
+
+import esp32log
+import esp32settings
+
+
+MB = 1024 * 1024
+
+MAX_JSONL_BYTES = 64 * MB #esp32flashwriter.jsonl is moved to .jsonl.1 beyond it
+PREFIX = 'esp32flashwriter'
+
+log = esp32log.get_logger( 'metrics' )
+
+
+class Session(object):
+    '''Timing record of the stages of one connect, write or read of a board.'''
+
+    def __init__( self, kind, port=None, mac=None ):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind        #'connect', 'write' or 'read'
+        self.port = port
+        self.mac = mac
+        self.started = time.time()
+        self.seconds = 0.0      #Duration, set by finish()
+        self.ok = None          #True/False once finished
+        self.error = None       #Message of the failure
+        self.stages = []        #{'stage', 'seconds', 'bytes'[, 'address']} of each stage done
+        self._lock = threading.Lock()
+
+
+    def add( self, name, seconds, nbytes=0, address=None ):
+        '''Record a stage name that took seconds and moved nbytes.'''
+        stage = { 'stage': name, 'seconds': round( seconds, 6 ), 'bytes': nbytes }
+        if address is not None:
+            stage['address'] = address
+        with self._lock:
+            self.stages.append( stage )
+
+
+    @contextlib.contextmanager
+    def stage( self, name, nbytes=0, address=None ):
+        '''Record the duration of the with block as stage name, also when it
+        raises.'''
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add( name, time.perf_counter() - t, nbytes, address )
+
+
+    def finish( self, error=None ):
+        self.seconds = time.time() - self.started
+        self.ok = error is None
+        self.error = str( error ) if error is not None else None
+
+
+    def record( self ):
+        '''Return the session as a dict for JSON.'''
+        with self._lock:
+            stages = list( self.stages )
+        return { 'session': self.id, 'kind': self.kind, 'port': self.port,
+                 'mac': self.mac, 'started': round( self.started, 3 ),
+                 'seconds': round( self.seconds, 6 ), 'ok': self.ok,
+                 'error': self.error, 'stages': stages }
+
+
+
+def timed( session, name, nbytes=0, address=None ):
+    '''Return session.stage( name, ... ), or a context that does nothing for
+    session None.'''
+    if session is None:
+        return contextlib.suppress()
+    return session.stage( name, nbytes, address )
+
+
+
+@contextlib.contextmanager
+def _file_lock( path ):
+    '''Hold an exclusive lock of the file path, which every process takes.'''
+    with open( path, 'a+' ) as f:
+        if fcntl:
+            fcntl.flock( f.fileno(), fcntl.LOCK_EX )
+        else:
+            f.seek( 0 )
+            msvcrt.locking( f.fileno(), msvcrt.LK_LOCK, 1 )
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock( f.fileno(), fcntl.LOCK_UN )
+            else:
+                f.seek( 0 )
+                msvcrt.locking( f.fileno(), msvcrt.LK_UNLCK, 1 )
+
+
+
+class MetricsExporter(object):
+    '''Append Session records to a JSON lines file and keep the totals of
+    every stage, of all processes, in a Prometheus textfile, see the module
+    docstring.'''
+
+    def __init__( self, directory=None, enabled=True ):
+        self.directory = directory
+        self.enabled = enabled
+        self.sessions = collections.Counter()      #{( kind, outcome ): sessions}
+        self.session_seconds = collections.Counter() #{kind: seconds}
+        self.stage_seconds = collections.Counter() #{stage: seconds}
+        self.stage_count = collections.Counter()   #{stage: times done}
+        self.stage_bytes = collections.Counter()   #{stage: bytes}
+        self.last = 0.0                            #time.time() of the last export
+        #The counters are the totals of esp32flashwriter.totals.json, reloaded
+        #by every export.
+        self._lock = threading.Lock()
+        self._failed = False
+
+
+    def _directory( self ):
+        if self.directory is None:
+            self.directory = ( os.environ.get( 'ESP32FLASHWRITER_METRICS' )
+                               or esp32settings.settings_dir( 'metrics' ) )
+        os.makedirs( self.directory, exist_ok=True )
+        return self.directory
+
+
+    def export( self, session ):
+        '''Write the record of the finished session. Returns False if it
+        can't be written or the exporter isn't enabled.'''
+        if not self.enabled:
+            return False
+        record = session.record()
+        with self._lock:
+            try:
+                directory = self._directory()
+                path = os.path.join( directory, PREFIX )
+                with _file_lock( path + '.lock' ):
+                    self._load( path + '.totals.json' )
+                    self._add( record )
+                    self._append( path + '.jsonl', record )
+                    self._replace( path + '.totals.json', json.dumps( self.totals() ) )
+                    self._replace( path + '.prom', self.prometheus() )
+            except OSError as err:
+                if not self._failed: #Don't repeat it for every board
+                    log.warning( 'Metrics not written: %s', err )
+                self._failed = True
+                return False
+        self._failed = False
+        return True
+
+
+    def _add( self, record ):
+        outcome = 'ok' if record['ok'] else 'failed'
+        self.sessions[ ( record['kind'], outcome ) ] += 1
+        self.session_seconds[ record['kind'] ] += record['seconds']
+        for stage in record['stages']:
+            self.stage_seconds[ stage['stage'] ] += stage['seconds']
+            self.stage_count[ stage['stage'] ] += 1
+            self.stage_bytes[ stage['stage'] ] += stage['bytes']
+        self.last = time.time()
+
+
+    def totals( self ):
+        '''Return the counters as a dict for JSON.'''
+        return { 'sessions': { '{}:{}'.format( kind, outcome ): count
+                               for ( kind, outcome ), count in self.sessions.items() },
+                 'session_seconds': dict( self.session_seconds ),
+                 'stage_seconds': dict( self.stage_seconds ),
+                 'stage_count': dict( self.stage_count ),
+                 'stage_bytes': dict( self.stage_bytes ),
+                 'last': self.last }
+
+
+    def _load( self, path ):
+        '''Replace the counters with the totals saved in path by totals().'''
+        try:
+            with open( path ) as f:
+                totals = json.load( f )
+        except FileNotFoundError:
+            return
+        except ValueError as err:
+            log.warning( 'Metrics totals %s not read, counting from zero: %s', path, err )
+            totals = {}
+        self.sessions = collections.Counter( {
+            tuple( key.split( ':', 1 ) ): count
+            for key, count in totals.get( 'sessions', {} ).items() } )
+        for name in ( 'session_seconds', 'stage_seconds', 'stage_count', 'stage_bytes' ):
+            setattr( self, name, collections.Counter( totals.get( name, {} ) ) )
+        self.last = totals.get( 'last', 0.0 )
+
+
+    @staticmethod
+    def _append( path, record ):
+        try:
+            if os.path.getsize( path ) > MAX_JSONL_BYTES:
+                os.replace( path, path + '.1' )
+        except FileNotFoundError:
+            pass
+        with open( path, 'a' ) as f:
+            f.write( json.dumps( record ) + '\n' )
+
+
+    def prometheus( self ):
+        '''Return the totals in the Prometheus text format.'''
+        lines = []
+        def metric( name, kind, help, samples ):
+            lines.append( '# HELP {}_{} {}'.format( PREFIX, name, help ) )
+            lines.append( '# TYPE {}_{} {}'.format( PREFIX, name, kind ) )
+            for labels, value in samples:
+                text = ','.join( '{}="{}"'.format( key, label ) for key, label in labels )
+                lines.append( '{}_{}{{{}}} {}'.format( PREFIX, name, text, value )
+                              if text else '{}_{} {}'.format( PREFIX, name, value ) )
+
+        metric( 'sessions_total', 'counter', 'Sessions by kind and outcome.',
+                [ ( ( ( 'kind', kind ), ( 'outcome', outcome ) ), count )
+                  for ( kind, outcome ), count in sorted( self.sessions.items() ) ] )
+        metric( 'session_seconds_total', 'counter', 'Seconds spent in sessions by kind.',
+                [ ( ( ( 'kind', kind ), ), round( seconds, 6 ) )
+                  for kind, seconds in sorted( self.session_seconds.items() ) ] )
+        #A summary without quantiles is its _sum & _count samples
+        metric( 'stage_seconds', 'summary', 'Seconds spent in each stage.', [] )
+        for stage in sorted( self.stage_seconds ):
+            lines.append( '{}_stage_seconds_sum{{stage="{}"}} {}'.format(
+                PREFIX, stage, round( self.stage_seconds[stage], 6 ) ) )
+            lines.append( '{}_stage_seconds_count{{stage="{}"}} {}'.format(
+                PREFIX, stage, self.stage_count[stage] ) )
+        metric( 'stage_bytes_total', 'counter', 'Bytes moved in each stage.',
+                [ ( ( ( 'stage', stage ), ), count )
+                  for stage, count in sorted( self.stage_bytes.items() ) ] )
+        metric( 'last_session_timestamp_seconds', 'gauge', 'Time of the last session exported.',
+                [ ( (), round( self.last, 3 ) ) ] )
+        return '\n'.join( lines ) + '\n'
+
+
+    @staticmethod
+    def _replace( path, text ):
+        #Written to a temporary file of this process and renamed, so that the
+        #collector never reads a partial file.
+        tmp = '{}.{}.tmp'.format( path, os.getpid() )
+        with open( tmp, 'w' ) as f:
+            f.write( text )
+        os.replace( tmp, path )
+
+
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def exporter():
+    '''Return the MetricsExporter of this process.'''
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None:
+            _exporter = MetricsExporter()
+        return _exporter
+
+
+def configure( directory=None, enabled=True ):
+    '''Set the directory of the files of exporter(), e.g. of a --metrics
+    option, and whether it writes them at all.'''
+    metrics = exporter()
+    with metrics._lock:
+        if directory is not None:
+            metrics.directory = directory
+        metrics.enabled = enabled
+
+
+def export( session ):
+    '''Export the finished session with exporter().'''
+    return exporter().export( session )
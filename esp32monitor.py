@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+'''Serial monitor of an ESP32 port.
+
+SerialMonitor reads everything the ESP32 sends, e.g. its boot log and the
+output of the firmware after a reset, in a thread into a RingBuffer of a
+fixed size. When a reader falls behind chatty firmware, the oldest bytes are
+overwritten, so memory stays bounded. The bytes can be streamed to a log
+file too.
+
+A GUI reads the new bytes with RingBuffer.read() at its own refresh rate.
+SerialMonitor.error is set when the port can't be read any more, e.g. when
+the ESP32 was unplugged.
+
+The port is shared with esptool, so pause() the monitor while esptool uses
+the port and resume() it afterwards.
+
+Repository: https://github.com/sunbearc22/ESP32FlashWriter
+'''
+
+import threading
+
+from serial.serialutil import SerialException
+
+import esp32log
+
+log = esp32log.get_logger( 'monitor' )
+
+
+KB = 1024
+
+READ_TIMEOUT = 0.05 #Seconds a read of the port waits for a byte
+
+
+class RingBuffer(object):
+    '''A byte buffer of a fixed size that overwrites its oldest bytes.
+
+    A reader keeps a position, the number of bytes written before the ones
+    it has yet to read, and passes it to read().'''
+
+    def __init__( self, size=64*KB ):
+        self.size = size
+        self._buffer = bytearray( size )
+        self._written = 0 #Bytes written since the buffer was created
+        self._lock = threading.Lock()
+
+
+    @property
+    def written( self ):
+        return self._written
+
+
+    def write( self, data ):
+        with self._lock:
+            n = len( data )
+            if n > self.size:
+                self._written += n - self.size
+                data = memoryview( data )[ -self.size: ]
+                n = self.size
+            start = self._written % self.size
+            first = min( n, self.size - start )
+            self._buffer[ start:start+first ] = data[ :first ]
+            self._buffer[ :n-first ] = data[ first: ]
+            self._written += n
+
+
+    def read( self, position ):
+        '''Return ( data, position, lost ): the bytes written since position,
+        the position to read from next and the number of bytes after position
+        that were overwritten before they were read.'''
+        with self._lock:
+            lost = max( 0, self._written - self.size - position )
+            position += lost
+            n = self._written - position
+            if not n:
+                return b'', position, lost
+            start = position % self.size
+            end = start + n
+            if end <= self.size:
+                data = bytes( self._buffer[ start:end ] )
+            else:
+                data = bytes( self._buffer[ start: ] ) + bytes( self._buffer[ :end-self.size ] )
+            return data, self._written, lost
+
+
+
+class SerialMonitor(object):
+    '''Read port, a serial.Serial, into self.buffer in a thread.'''
+
+    def __init__( self, port, size=64*KB, logfile=None ):
+        self.port = port
+        self.buffer = RingBuffer( size )
+        self.error = None    #The exception that ended the reading of port
+        self._log = None     #File the bytes read are appended to
+        self._log_lock = threading.Lock()
+        self._saved_timeout = None
+        self._running = threading.Event() #Set while port may be read
+        self._stop = threading.Event()
+        self._lock = threading.Lock() #Held while port is read
+        self._thread = threading.Thread( target=self._read, name='monitor', daemon=True )
+        if logfile:
+            self.open_log( logfile )
+
+
+    def start( self ):
+        self._thread.start()
+        self.resume()
+
+
+    def pause( self ):
+        '''Stop reading port, e.g. while esptool uses it.'''
+        self._running.clear()
+        with self._lock:
+            if self._saved_timeout is not None:
+                self._restore_timeout()
+
+
+    def resume( self ):
+        '''Read port again after pause().'''
+        if self.error or self._stop.is_set():
+            return
+        with self._lock:
+            if self._saved_timeout is None:
+                self._saved_timeout = ( self.port.timeout, )
+                self.port.timeout = READ_TIMEOUT
+        self._running.set()
+
+
+    def stop( self ):
+        '''End the thread and close the log file. port is left open.'''
+        self._stop.set()
+        self.pause()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.close_log()
+
+
+    def open_log( self, path ):
+        '''Append the bytes read from now on to the file path.'''
+        f = open( path, 'ab' )
+        with self._log_lock:
+            old, self._log = self._log, f
+        if old:
+            old.close()
+
+
+    def close_log( self ):
+        with self._log_lock:
+            old, self._log = self._log, None
+        if old:
+            old.close()
+
+
+    def _restore_timeout( self ):
+        try:
+            self.port.timeout = self._saved_timeout[0]
+        except ( SerialException, OSError, ValueError ):
+            pass #port is gone or closed
+        self._saved_timeout = None
+
+
+    def _read( self ):
+        while not self._stop.is_set():
+            if not self._running.wait( 0.2 ):
+                continue
+            with self._lock:
+                if not self._running.is_set():
+                    continue
+                try:
+                    data = self.port.read( self.port.in_waiting or 1 )
+                except ( SerialException, OSError ) as err:
+                    self.error = err
+                    self._running.clear()
+                    return
+            if data:
+                self.buffer.write( data )
+                with self._log_lock:
+                    if self._log:
+                        try:
+                            self._log.write( data )
+                            self._log.flush() #Let the log be followed, e.g. with tail -f
+                        except OSError as err:
+                            log.warning( 'Serial monitor log closed: %s', err )
+                            self._log.close()
+                            self._log = None
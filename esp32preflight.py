@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+'''Offline checks of firmware files before they are written.
+
+check() parses a file that is an ESP32 app image, i.e. a bootloader or an
+application starting with the magic byte 0xE9, like the ROM and the
+bootloader load it: the image header, the extended header and every segment.
+It verifies the checksum of the segments and, when one is appended, the
+SHA-256 digest of the image, and confirms that the file fits in flash at its
+offset. Other files, e.g. a partition table, are only checked to fit. At the
+bootloader offset 0x1000 an app image is required.
+
+No ESP32 is needed, so a bad file is rejected in milliseconds when it is
+chosen, before any serial traffic. The analysis of a file is cached by its
+path, size and modification time, so checking it again doesn't read it.
+
+Repository: https://github.com/sunbearc22/ESP32FlashWriter
+'''
+
+import collections
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+import esptool
+
+import esp32log
+
+log = esp32log.get_logger( 'preflight' )
+
+
+MAX_SEGMENTS = 16          #Segments the ROM & bootloader can load
+IROM_ALIGN   = 0x10000     #Flash offset alignment of an application
+HEADER       = struct.Struct( '<BBBBI' ) #magic, segments, flash mode, flash size & freq, entry
+EXTENDED_HEADER_SIZE = 16  #Last byte is 1 when a SHA-256 digest is appended
+SEGMENT_HEADER = struct.Struct( '<II' )  #load address, length
+DIGEST_SIZE  = 32
+CACHE_SIZE   = 64          #Analyses kept by check()
+
+
+class Preflight(object):
+    '''The outcome of check() for one file.'''
+
+    def __init__( self, name, address, size ):
+        self.name = name          #Path of the file
+        self.address = address    #Flash offset
+        self.size = size          #Bytes of the file
+        self.is_image = False     #True for an ESP32 app image
+        self.entry = None         #Entry point of the app image
+        self.segments = []        #( load address, length ) of each segment
+        self.digest = None        #True/False when the appended SHA-256 matched, or None
+        self.errors = []          #Reasons the file can't be written
+        self.warnings = []        #Things that are likely wrong
+
+
+    @property
+    def ok( self ):
+        return not self.errors
+
+
+    def __str__( self ):
+        name = os.path.basename( self.name )
+        if self.errors:
+            return '{}: {}'.format( name, self.errors[0] )
+        if not self.is_image:
+            return '{}: {} bytes of data.'.format( name, self.size )
+        return '{}: app image, {} segments{}.'.format(
+            name, len( self.segments ), ', SHA-256 OK' if self.digest else '' )
+
+
+
+def _xor_bytes( data, state=0 ):
+    '''Return state XOR every byte of data, like esptool.ESPLoader.checksum()
+    but folded as one integer instead of byte by byte.'''
+    x = int.from_bytes( data, 'little' )
+    width = 1
+    while width < len( data ):
+        width *= 2
+    while width > 1:
+        width //= 2
+        x = ( x >> ( 8 * width ) ) ^ ( x & ( ( 1 << ( 8 * width ) ) - 1 ) )
+    return state ^ x
+
+
+def analyse( data ):
+    '''Return ( is_image, entry, segments, digest, errors, warnings ) of the
+    content data of a file; see Preflight.'''
+    view = memoryview( data )
+    if len( view ) < 1 or view[0] != esptool.ESPLoader.ESP_IMAGE_MAGIC:
+        return False, None, [], None, [], []
+    errors = []
+    warnings = []
+    segments = []
+    digest = None
+    if len( view ) < HEADER.size + EXTENDED_HEADER_SIZE:
+        return True, None, [], None, [ 'Image header is truncated.' ], []
+    magic, count, flash_mode, flash_size_freq, entry = HEADER.unpack_from( view, 0 )
+    append_digest = view[ HEADER.size + EXTENDED_HEADER_SIZE - 1 ]
+    if count > MAX_SEGMENTS:
+        errors.append( 'Invalid segment count {} (max {}).'.format( count, MAX_SEGMENTS ) )
+        return True, entry, segments, digest, errors, warnings
+    if append_digest not in ( 0, 1 ):
+        errors.append( 'Invalid SHA-256 flag 0x{:02x} in the extended header.'.format( append_digest ) )
+        return True, entry, segments, digest, errors, warnings
+    offset = HEADER.size + EXTENDED_HEADER_SIZE
+    checksum = esptool.ESPLoader.ESP_CHECKSUM_MAGIC
+    for i in range( count ):
+        if offset + SEGMENT_HEADER.size > len( view ):
+            errors.append( 'Segment {} header is beyond the end of the file.'.format( i ) )
+            return True, entry, segments, digest, errors, warnings
+        load_address, length = SEGMENT_HEADER.unpack_from( view, offset )
+        offset += SEGMENT_HEADER.size
+        if offset + length > len( view ):
+            errors.append( 'Segment {} at 0x{:08x} of {} bytes overflows the file by {} bytes.'.format(
+                i, load_address, length, offset + length - len( view ) ) )
+            return True, entry, segments, digest, errors, warnings
+        if length % 4:
+            warnings.append( 'Segment {} length {} is not a multiple of 4.'.format( i, length ) )
+        segments.append( ( load_address, length ) )
+        checksum = _xor_bytes( view[ offset:offset+length ], checksum )
+        offset += length
+    # The checksum is the last byte of a 16 byte block.
+    offset += 15 - offset % 16
+    if offset >= len( view ):
+        errors.append( 'Checksum is beyond the end of the file.' )
+        return True, entry, segments, digest, errors, warnings
+    if view[ offset ] != checksum:
+        errors.append( 'Checksum mismatch: 0x{:02x} stored, 0x{:02x} calculated.'.format(
+            view[ offset ], checksum ) )
+    offset += 1
+    if append_digest:
+        stored = bytes( view[ offset:offset+DIGEST_SIZE ] )
+        if len( stored ) < DIGEST_SIZE:
+            errors.append( 'SHA-256 digest is beyond the end of the file.' )
+        else:
+            digest = hashlib.sha256( view[ :offset ] ).digest() == stored
+            if not digest:
+                errors.append( 'SHA-256 digest mismatch.' )
+        offset += DIGEST_SIZE
+    if offset < len( view ):
+        warnings.append( '{} bytes follow the end of the image.'.format( len( view ) - offset ) )
+    return True, entry, segments, digest, errors, warnings
+
+
+_cache = collections.OrderedDict() #{_key(): ( size, analyse() result, first byte )}
+_cache_lock = threading.Lock()
+
+
+def _key( path, stat ):
+    return ( os.path.abspath( path ), stat.st_size, stat.st_mtime_ns )
+
+
+def _analyse_file( path ):
+    '''Return _key(), the size, analyse() and the first byte (None when
+    empty) of the file path, which is mapped only while it is analysed.'''
+    with open( path, 'rb' ) as f:
+        stat = os.fstat( f.fileno() )
+        if stat.st_size == 0:
+            return _key( path, stat ), 0, analyse( b'' ), None
+        with mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ ) as data:
+            return _key( path, stat ), stat.st_size, analyse( data ), data[0]
+
+
+def check( path, address, flash_size=None ):
+    '''Return a Preflight of the file path to be written at address.
+
+    flash_size is an esptool flash size, e.g. '4MB', or None or 'detect'
+    when it is not known yet, which skips the check that the file fits.
+    Raises OSError when path can't be read.'''
+    key = _key( path, os.stat( path ) )
+    with _cache_lock:
+        cached = _cache.get( key )
+        if cached is not None:
+            _cache.move_to_end( key )
+    if cached is None:
+        key, *cached = _analyse_file( path ) #The key of the file as analysed
+        with _cache_lock:
+            _cache[ key ] = cached
+            while len( _cache ) > CACHE_SIZE:
+                _cache.popitem( last=False )
+    size, analysis, first = cached
+    preflight = Preflight( path, address, size )
+    ( preflight.is_image, preflight.entry, segments, preflight.digest,
+      errors, warnings ) = analysis
+    preflight.segments = list( segments )
+    preflight.errors = list( errors )
+    preflight.warnings = list( warnings )
+
+    if not preflight.size:
+        preflight.errors.append( 'File is empty.' )
+    if address % 4:
+        preflight.errors.append( 'Offset 0x{:x} is not a multiple of 4.'.format( address ) )
+    if address == esptool.ESP32ROM.BOOTLOADER_FLASH_OFFSET and preflight.size and not preflight.is_image:
+        preflight.errors.insert( 0, 'Invalid image magic 0x{:02x} for a bootloader at 0x{:x}.'.format(
+            first, address ) )
+    elif ( preflight.is_image and address != esptool.ESP32ROM.BOOTLOADER_FLASH_OFFSET
+           and address % IROM_ALIGN ):
+        preflight.warnings.append( 'An application at offset 0x{:x} is not on a 0x{:x} boundary.'.format(
+            address, IROM_ALIGN ) )
+    if flash_size and flash_size != 'detect':
+        flash_end = esptool.flash_size_bytes( flash_size )
+        if address + preflight.size > flash_end:
+            preflight.errors.append( 'Does not fit in {} of flash at offset 0x{:x} ({} bytes over).'.format(
+                flash_size, address, address + preflight.size - flash_end ) )
+    return preflight
+
+
+def check_args( args ):
+    '''Check every file of args.addr_filename for args.flash_size. Prints the
+    warnings and raises esptool.FatalError for the first file with errors.'''
+    for address, argfile in args.addr_filename:
+        preflight = check( argfile.name, address, args.flash_size )
+        for warning in preflight.warnings:
+            log.warning( '%s: %s', os.path.basename( argfile.name ), warning )
+        if not preflight.ok:
+            raise esptool.FatalError( 'File {} at offset 0x{:x}: {}'.format(
+                argfile.name, address, ' '.join( preflight.errors ) ) )
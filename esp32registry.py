@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+'''Registry of the ESP32 boards that ESP32FlashWriter has seen.
+
+Each board is recorded by its MAC in devices.json of esp32settings, with:
+   description, features, manufacturer, device, flashsize
+                -- the chip info of esp32flashengine.get_chip_info().
+   adapter      -- 'vid:pid:serial number' of its USB-serial adapter, see
+                   esp32flashengine.adapter_id(), if it is a USB device.
+   port         -- the port it was last seen on.
+   baud         -- the baud of its last good write.
+   firmware     -- [ { 'address', 'size', 'md5' } ] of its last good write.
+   seen/written -- time.time() it was last connected to/written.
+
+esp32flashengine.identify() connects to a board in the registry with a
+single MAC read instead of reading all of its chip info. The registry can
+be looked up without a serial port, e.g. by fleet tooling:
+
+   python3 esp32flashwriter.py --devices --json
+
+Repository: https://github.com/sunbearc22/ESP32FlashWriter
+'''
+
+import threading
+import time
+
+import esp32settings
+
+
+REGISTRY_SETTINGS = 'devices.json' #{'devices': {mac: record}, 'adapters': {adapter: mac}}
+INFO = ( 'description', 'features', 'manufacturer', 'device', 'flashsize' )
+
+_lock = threading.Lock()
+
+
+def _load():
+    data = esp32settings.load( REGISTRY_SETTINGS, {} )
+    data.setdefault( 'devices', {} )
+    data.setdefault( 'adapters', {} )
+    return data
+
+
+def devices():
+    '''Return the records of every board, most recently seen first.'''
+    with _lock:
+        records = list( _load()['devices'].values() )
+    return sorted( records, key=lambda record: record.get( 'seen', 0 ), reverse=True )
+
+
+def lookup( mac=None, adapter=None ):
+    '''Return the record of the board mac, or of the board last seen on the
+    USB-serial adapter, or None.'''
+    with _lock:
+        data = _load()
+    if mac is None and adapter is not None:
+        mac = data['adapters'].get( adapter )
+    return data['devices'].get( mac ) if mac else None
+
+
+def update( mac, adapter=None, **fields ):
+    '''Merge fields into the record of the board mac and mark it as seen.
+    Returns False if the registry can't be saved.'''
+    with _lock:
+        data = _load()
+        record = data['devices'].setdefault( mac, { 'mac': mac } )
+        record.update( fields )
+        record['seen'] = time.time()
+        if adapter:
+            record['adapter'] = adapter
+            data['adapters'][ adapter ] = mac
+        return esp32settings.save( REGISTRY_SETTINGS, data )
+
+
+def record_write( mac, results, baud=None, port=None ):
+    '''Record the images of results, the list of esp32flashengine.WriteResult
+    of a good write, as the firmware of the board mac.'''
+    fields = { 'firmware': [ { 'address': result.address, 'size': result.uncsize,
+                               'md5': result.md5 } for result in results ],
+               'written': time.time() }
+    if baud:
+        fields['baud'] = baud
+    if port:
+        fields['port'] = port
+    return update( mac, **fields )
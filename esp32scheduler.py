@@ -0,0 +1,543 @@
+#!/usr/bin/env python3
+
+'''Fleet scheduler: work through a queue of flash jobs on a pool of workers.
+
+A FlashJob names the board to write by a selector, the firmware set to write
+to it and esp32flashengine.Args options. The selector is one of:
+   a port     -- e.g. '/dev/ttyUSB0'.
+   a MAC      -- e.g. '24:0a:c4:00:01:02', written on whichever port the
+                 board with that MAC is plugged in.
+   None       -- any board that this scheduler hasn't written yet, e.g. the
+                 next board plugged into a production line.
+
+FlashScheduler runs the jobs in order of priority, then of submission, on at
+most workers threads and never two jobs on one port. The MAC of every port
+it connects to is remembered until the port is unplugged, so a board is only
+probed once. A job that fails with a transient error, e.g. a connect that
+timed out (ESP32Device.MSG2/MSG2a in the GUI), is queued again after a
+backoff that doubles for each attempt, instead of waiting for a human. With
+board_timeout, a job whose board isn't plugged in for that many seconds
+fails with BoardNotFound instead of waiting forever.
+
+stats() returns the queue depth, the boards per hour and the failure
+counters.
+
+Repository: https://github.com/sunbearc22/ESP32FlashWriter
+'''
+
+import collections
+import copy
+import itertools
+import re
+import threading
+import time
+
+from serial.serialutil import SerialException
+import esptool
+
+import esp32flashengine as engine
+import esp32log
+import esp32metrics
+import esp32preflight as preflight
+import esp32registry
+from esp32flashengine import Args
+from esp32imagecache import ImageCache
+
+log = esp32log.get_logger( 'scheduler' )
+
+
+MAC = re.compile( r'^([0-9a-f]{2}:){5}[0-9a-f]{2}$' )
+
+#esptool.FatalError messages of failures that may not happen again, e.g.
+#after the board is reconnected or BOOT is held down.
+TRANSIENT_ERRORS = ( 'Failed to connect',
+                     'Timed out waiting for packet',
+                     'Invalid head of packet',
+                     'Invalid SLIP escape',
+                     "Response doesn't match request",
+                     'Only got',
+                     'Failed to start stub',
+                     'Corrupt data',
+                     'Digest mismatch',
+                     'MD5 of file does not match data in flash' )
+
+POLL_SECONDS = 1.0 #Seconds between scans for a port to run a queued job on
+
+
+class BoardNotFound(esptool.FatalError):
+    '''The failure of a job whose board wasn't found within board_timeout.'''
+
+
+
+def _int_option( name, value, low, high=None ):
+    if isinstance( value, bool ) or not isinstance( value, ( int, str ) ):
+        raise ValueError( 'Invalid {}: {!r}'.format( name, value ) )
+    try:
+        number = int( value )
+    except ValueError:
+        raise ValueError( 'Invalid {}: {!r}'.format( name, value ) )
+    if number < low or ( high is not None and number > high ):
+        raise ValueError( 'Invalid {}: {!r}'.format( name, value ) )
+    return number
+
+
+def apply_options( args, options ):
+    '''Set options, a dict of esp32flashengine.Args attributes, on args. The
+    values are converted like the command line options, e.g. a 'baud' of
+    'auto' sets args.auto_baud. Raises ValueError for an unknown option or a
+    bad value.'''
+    for name, value in options.items():
+        if not hasattr( args, name ):
+            raise ValueError( 'Unknown option: {}'.format( name ) )
+        if name == 'baud':
+            args.auto_baud = value == 'auto'
+            if args.auto_baud:
+                value = esptool.ESPLoader.ESP_ROM_BAUD
+            else:
+                value = _int_option( name, value, 1 )
+        elif name == 'compress_level':
+            if value != 'auto':
+                value = _int_option( name, value, 1, 9 )
+        elif name in ( 'compress', 'no_compress' ):
+            if not isinstance( value, bool ):
+                raise ValueError( 'Invalid {}: {!r}'.format( name, value ) )
+            args.compress = value if name == 'compress' else not value
+            args.no_compress = not args.compress
+            continue
+        setattr( args, name, value )
+
+
+def is_transient( err ):
+    '''Return True if the failure err of a job is worth another attempt.'''
+    if isinstance( err, engine.WriteCancelled ):
+        return False
+    if isinstance( err, ( SerialException, OSError ) ):
+        return not isinstance( err, FileNotFoundError )
+    if isinstance( err, esptool.FatalError ):
+        return any( msg in str( err ) for msg in TRANSIENT_ERRORS )
+    return False
+
+
+def _reason( err ):
+    '''Return the failure counter of err, e.g. 'FatalError: Failed to connect'.'''
+    msg = str( err ).split( '\n' )[0]
+    for transient in TRANSIENT_ERRORS:
+        if transient in msg:
+            msg = transient
+            break
+    return '{}: {}'.format( type( err ).__name__, msg[:60] )
+
+
+
+class FlashJob(object):
+    '''A firmware set to write to the board of selector, see the module
+    docstring.
+
+    images is a list of ( offset, path ) and options a dict of attributes of
+    esp32flashengine.Args, e.g. { 'baud': 921600, 'erase_all': True }, set by
+    apply_options(). A job of a higher priority runs first.'''
+
+    QUEUED    = 'queued'
+    RUNNING   = 'running'
+    DONE      = 'done'
+    FAILED    = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__( self, selector, images, options=None, priority=0 ):
+        if selector and MAC.match( selector.lower() ):
+            selector = selector.lower()
+        self.selector = selector
+        self.images = list( images )
+        self.options = dict( options or {} )
+        self.priority = priority
+        self.id = None         #Number of submission, set by FlashScheduler.submit()
+        self.state = FlashJob.QUEUED
+        self.port = None       #Port of the last attempt
+        self.mac = None        #MAC of the board written
+        self.attempts = 0
+        self.not_before = 0.0  #time.time() before which the job isn't attempted again
+        self.missing_since = None #time.time() since which no board of the job is plugged in
+        self.percent = 0       #Progress of the image being written
+        self.message = ''      #Last status message
+        self.results = []      #List of esp32flashengine.WriteResult
+        self.error = None      #Exception of the last failed attempt
+        self.seconds = 0.0     #Duration of the last attempt
+
+
+    @property
+    def by_mac( self ):
+        return bool( self.selector and MAC.match( self.selector ) )
+
+
+    def __str__( self ):
+        name = 'Job {} ({})'.format( self.id, self.selector or 'any board' )
+        if self.state == FlashJob.FAILED:
+            return '{}: {} after {} attempts ({})'.format( name, self.state, self.attempts, self.error )
+        if self.state == FlashJob.DONE:
+            written = sum( result.uncsize for result in self.results )
+            return '{}: {} {} bytes to {} on {} in {:.1f} seconds'.format(
+                name, self.state, written, self.mac, self.port, self.seconds )
+        return '{}: {}'.format( name, self.state )
+
+
+
+class FlashScheduler(object):
+    '''Run submitted FlashJob on a pool of at most workers threads.
+
+    args is the esp32flashengine.Args the options of every job are applied
+    to. A failed attempt is retried up to retries times, the first time after
+    backoff seconds and then after twice the previous delay, at most
+    max_backoff seconds. find_ports returns the ports to look for boards on,
+    by default esp32flashengine.find_ports. A queued job fails once no board
+    it could run on has been plugged in for board_timeout seconds, unless it
+    is None.'''
+
+    def __init__( self, workers=4, retries=3, backoff=2.0, max_backoff=60.0, args=None,
+                  find_ports=None, board_timeout=None ):
+        self.workers = workers
+        self.board_timeout = board_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        if args is None:
+            args = Args()
+            args.chip = 'esp32'
+            args.no_stub = False
+            args.flash_size = 'detect'
+            args.compress_level = 'auto'
+            args.image_cache = ImageCache()
+        # Every image is verified by its flash md5sum in engine.write_flash().
+        args.verify = False
+        self.args = args
+        self.find_ports = find_ports or engine.find_ports
+        self.jobs = []          #Every submitted FlashJob
+        self.done = 0
+        self.failed = 0         #Jobs that failed after their last attempt
+        self.retried = 0        #Failed attempts that were queued again
+        self.failures = collections.Counter() #{_reason(): failed attempts}
+        self._queue = []        #Queued FlashJob
+        self._ports = {}        #{port: MAC of the board on it}
+        self._port_not_before = {} #{port: time.time() before which it isn't probed again}
+        self._claimed = set()   #Ports a worker is using
+        self._running = set()   #MACs being written
+        self._written = set()   #MACs written by a job with no port or MAC
+        self._ids = itertools.count( 1 )
+        self._started = None    #time.time() of the first attempt
+        self._lock = threading.Condition()
+        self._stop = threading.Event()
+        self._cancel = threading.Event() #Cancels the writes in progress
+        self._threads = []
+
+
+    def submit( self, job ):
+        '''Queue job and return it. Raises esptool.FatalError when a file of
+        job can't be written, which no retry would fix, and ValueError for a
+        bad option, see apply_options().'''
+        self._check( job )
+        with self._lock:
+            job.id = next( self._ids )
+            job.state = FlashJob.QUEUED
+            self.jobs.append( job )
+            self._queue.append( job )
+            self._lock.notify()
+        return job
+
+
+    def _check( self, job ):
+        args = self._create_args( job ) #Raises ValueError for a bad option
+        try:
+            engine.check_overlap( args )
+            preflight.check_args( args )
+        finally:
+            self._close_args_files( args )
+
+
+    def start( self ):
+        '''Start the worker threads.'''
+        for i in range( self.workers ):
+            thread = threading.Thread( target=self._worker, name='scheduler-{}'.format( i ),
+                                       daemon=True )
+            self._threads.append( thread )
+            thread.start()
+
+
+    def stop( self, cancel=False ):
+        '''Cancel the queued jobs and end the workers once their jobs are
+        done, or cancelled too with cancel. Doesn't wait, see join().'''
+        with self._lock:
+            for job in self._queue:
+                job.state = FlashJob.CANCELLED
+            self._queue = []
+            self._stop.set()
+            if cancel:
+                self._cancel.set()
+            self._lock.notify_all()
+
+
+    def join( self, timeout=None ):
+        '''Wait until every job is done, failed or cancelled. Returns False
+        on timeout.'''
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while self._queue or self._claimed:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._lock.wait( remaining )
+        return True
+
+
+    def is_alive( self ):
+        with self._lock:
+            return bool( self._queue or self._claimed )
+
+
+    def stats( self ):
+        '''Return a dict of the queue depth, the jobs running, done and
+        failed, the boards written per hour and the failure counters.'''
+        with self._lock:
+            hours = ( time.time() - self._started ) / 3600 if self._started else 0.0
+            return { 'queued': len( self._queue ),
+                     'running': len( self._claimed ),
+                     'done': self.done,
+                     'failed': self.failed,
+                     'retried': self.retried,
+                     'boards_per_hour': round( self.done / hours, 1 ) if hours else 0.0,
+                     'failures': dict( self.failures ) }
+
+
+    def summary( self ):
+        stats = self.stats()
+        return 'Queue: {} done, {} failed, {} running, {} queued, {:.0f} boards/hour.'.format(
+            stats['done'], stats['failed'], stats['running'], stats['queued'],
+            stats['boards_per_hour'] )
+
+
+    #### Workers
+    def _worker( self ):
+        while True:
+            present = self.find_ports() #Not under self._lock: a USB scan takes a while
+            with self._lock:
+                if self._stop.is_set() and not self._queue:
+                    return
+                job, port = self._next_job( present )
+                if job is None:
+                    self._lock.wait( POLL_SECONDS )
+                    continue
+                self._queue.remove( job )
+                self._claimed.add( port )
+                if self._started is None:
+                    self._started = time.time()
+            try:
+                self._run( job, port )
+            except Exception as err: #Keep the worker, e.g. after a failing export
+                log.exception( 'Job %s on %s: unexpected error', job.id, port )
+                if job.state == FlashJob.RUNNING:
+                    self._failed( job, port, err )
+            finally:
+                with self._lock:
+                    self._claimed.discard( port )
+                    self._lock.notify_all()
+
+
+    def _next_job( self, present ):
+        '''Return ( job, port ) of the queued job to attempt next and the port
+        of present, the ports found, to attempt it on, or ( None, None ).
+        Fails the jobs that waited too long for a board. Called with
+        self._lock held.'''
+        now = time.time()
+        for port in list( self._ports ):
+            if port not in present: #Unplugged, so forget its board
+                del self._ports[ port ]
+        ports = [ port for port in present
+                  if port not in self._claimed and self._port_not_before.get( port, 0 ) <= now ]
+        ready = [ job for job in self._queue if job.not_before <= now ]
+        ready.sort( key=lambda job: ( -job.priority, job.id ) )
+        for job in ready:
+            port = self._choose_port( job, ports )
+            if port is not None:
+                job.missing_since = None
+                return job, port
+            if self._board_present( job, present ):
+                job.missing_since = None
+            elif job.missing_since is None:
+                job.missing_since = now
+            elif self.board_timeout is not None and now - job.missing_since > self.board_timeout:
+                self._board_not_found( job )
+        return None, None
+
+
+    def _board_present( self, job, present ):
+        '''Return True if a board that job may run on is on a port of present,
+        e.g. busy with another job.'''
+        if job.selector and not job.by_mac:
+            return job.selector in present
+        for port in present:
+            mac = self._ports.get( port )
+            if mac is None: #Not probed yet
+                return True
+            if job.by_mac and mac == job.selector:
+                return True
+            if ( not job.selector and mac not in self._written
+                 and mac not in self._running ):
+                return True
+        return False
+
+
+    def _board_not_found( self, job ):
+        err = BoardNotFound( 'No board for the job found in {:.0f} seconds'.format(
+            self.board_timeout ) )
+        log.warning( 'Job %s (%s) failed: %s', job.id, job.selector or 'any board', err )
+        self._queue.remove( job )
+        job.error = err
+        job.state = FlashJob.FAILED
+        job.message = str( err )
+        self.failures[ _reason( err ) ] += 1
+        self.failed += 1
+        self._lock.notify_all()
+
+
+    def _choose_port( self, job, ports ):
+        if job.selector and not job.by_mac:
+            return job.selector if job.selector in ports else None
+        unknown = None
+        for port in ports:
+            mac = self._ports.get( port )
+            if mac is None:
+                unknown = unknown or port
+            elif mac in self._running:
+                continue
+            elif job.by_mac and mac == job.selector:
+                return port
+            elif not job.selector and mac not in self._written:
+                return port
+        return unknown #To be probed for its MAC
+
+
+    def _run( self, job, port ):
+        '''Make one attempt of job on port.'''
+        job.state = FlashJob.RUNNING
+        job.port = port
+        job.attempts += 1
+        job.error = None
+        job.message = 'Connecting....'
+        esp32log.set_context( port=port, job=job.id )
+        t = time.time()
+        esp = None
+        args = None
+        metrics = esp32metrics.Session( 'write', port )
+        try:
+            if engine.port_is_busy( port ):
+                raise SerialException( 'Port is used by another application.' )
+            esp = engine.open_esp( port, metrics=metrics )
+            with metrics.stage( 'read_mac' ):
+                mac = engine.mac_address( esp )
+            metrics.mac = mac
+            esp32log.update_context( mac=mac )
+            with self._lock:
+                self._ports[ port ] = mac
+                wanted = ( mac == job.selector if job.by_mac
+                           else job.selector or mac not in self._written )
+                if not wanted or mac in self._running:
+                    #Another board: leave it for another job.
+                    metrics.kind = 'connect'
+                    job.attempts -= 1
+                    job.state = FlashJob.QUEUED
+                    self._queue.append( job )
+                    return
+                self._running.add( mac )
+            job.mac = mac
+            try:
+                args = self._create_args( job, port )
+                args.metrics = metrics
+                esp = engine.setup_esp( esp, args, self._status( job ) )
+                job.results = engine.write_flash( esp, args, status=self._status( job ),
+                                                  progress=self._progress( job ),
+                                                  cancel=self._cancel )
+                esp32registry.record_write( mac, job.results, esp._port.baudrate, port )
+                engine.hard_reset( esp )
+            finally:
+                with self._lock:
+                    self._running.discard( mac )
+        except ( esptool.FatalError, SerialException, OSError ) as err:
+            job.seconds = time.time() - t
+            self._failed( job, port, err )
+        except Exception as err: #A bug fails the job, which is_transient() doesn't retry
+            log.exception( 'Job %s attempt %d on %s: unexpected error', job.id, job.attempts, port )
+            job.seconds = time.time() - t
+            self._failed( job, port, err )
+        else:
+            job.seconds = time.time() - t
+            with self._lock:
+                job.state = FlashJob.DONE
+                job.message = 'Done.'
+                self.done += 1
+                if not job.selector:
+                    self._written.add( job.mac )
+        finally:
+            if args:
+                self._close_args_files( args )
+            if esp:
+                esp._port.close()
+            metrics.finish( job.error )
+            esp32metrics.export( metrics )
+
+
+    def _failed( self, job, port, err ):
+        log.warning( 'Job %s attempt %d on %s failed: %s', job.id, job.attempts, port, err )
+        with self._lock:
+            job.error = err
+            if isinstance( err, engine.WriteCancelled ):
+                job.state = FlashJob.CANCELLED
+                job.message = str( err )
+                return
+            self.failures[ _reason( err ) ] += 1
+            delay = min( self.max_backoff, self.backoff * 2 ** ( job.attempts - 1 ) )
+            if job.by_mac or not job.selector:
+                #Let other jobs skip a board that failed for a while too.
+                self._port_not_before[ port ] = time.time() + delay
+            if ( is_transient( err ) and job.attempts <= self.retries
+                 and not self._stop.is_set() ):
+                self.retried += 1
+                job.state = FlashJob.QUEUED
+                job.message = 'Retrying in {:.0f} seconds: {}'.format( delay, err )
+                job.not_before = time.time() + delay
+                self._queue.append( job )
+            else:
+                job.state = FlashJob.FAILED
+                job.message = str( err )
+                self.failed += 1
+
+
+    def _status( self, job ):
+        def status( msg ):
+            job.message = msg
+        return status
+
+
+    def _progress( self, job ):
+        def progress( report ):
+            job.percent = report.percent
+        return progress
+
+
+    def _create_args( self, job, port=None ):
+        '''Return a copy of self.args with the options and the open files of job.'''
+        args = copy.copy( self.args )
+        apply_options( args, job.options )
+        args.port = port
+        args.addr_filename = []
+        try:
+            for offset, path in job.images:
+                args.addr_filename.append( ( offset, open( path, 'rb' ) ) )
+        except OSError:
+            self._close_args_files( args )
+            raise
+        return args
+
+
+    @staticmethod
+    def _close_args_files( args ):
+        for address, argfile in args.addr_filename:
+            argfile.close()
+        args.addr_filename = []
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+'''Location of the files that ESP32FlashWriter keeps between sessions.
+
+Everything is kept below settings_dir(), which is ~/.esp32flashwriter unless
+the ESP32FLASHWRITER_HOME environment variable names another directory.
+Small settings are JSON files in it that are read by load() and written by
+save().
+
+Repository: https://github.com/sunbearc22/ESP32FlashWriter
+'''
+
+import json
+import os
+import threading
+
+import esp32log
+
+log = esp32log.get_logger( 'settings' )
+
+
+def settings_dir( *names ):
+    '''Return the settings directory, or its sub-directory names, creating
+    it when it does not exist yet.'''
+    path = os.environ.get( 'ESP32FLASHWRITER_HOME' )
+    if not path:
+        path = os.path.join( os.path.expanduser( '~' ), '.esp32flashwriter' )
+    path = os.path.join( path, *names )
+    os.makedirs( path, exist_ok=True )
+    return path
+
+
+def load( name, default ):
+    '''Return the data of the JSON file name in settings_dir(), or default
+    when it does not exist or can't be read.'''
+    try:
+        with open( os.path.join( settings_dir(), name ) ) as f:
+            return json.load( f )
+    except ( OSError, ValueError ):
+        return default
+
+
+def save( name, data ):
+    '''Write data to the JSON file name in settings_dir(). Returns False if
+    it can't be written.'''
+    tmp = None
+    try:
+        path = os.path.join( settings_dir(), name )
+        #A temporary file of this thread, as the GUI, the CLI and the workers
+        #of a gang or scheduler may save the same file at once.
+        tmp = '{}.{}.{}.tmp'.format( path, os.getpid(), threading.get_ident() )
+        with open( tmp, 'w' ) as f:
+            json.dump( data, f, indent=1, sort_keys=True )
+        os.replace( tmp, path )
+    except OSError as err:
+        log.warning( 'Settings %s not saved: %s', name, err )
+        if tmp and os.path.exists( tmp ):
+            os.remove( tmp )
+        return False
+    return True
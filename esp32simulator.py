@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+
+'''A simulated ESP32 that speaks the esptool.py serial protocol on a pty.
+
+SimulatedESP32 opens a Linux pseudo-terminal and serves the SLIP framed
+commands of the ESP32 ROM bootloader and of the esptool.py stub loader from
+a thread. Its flash is an in-memory bytearray. esptool.ESP32ROM, and hence
+ESP32Device, FlashFirmware and esp32flashengine, can connect to its port,
+e.g. /dev/pts/3, like they connect to /dev/ttyUSB0.
+
+Supported commands: sync, read_reg/write_reg (MAC, chip description and SPI
+flash ID), mem_begin/data/end (stub upload), spi_set_params, spi_attach,
+change_baud, flash_begin/data/end, flash_defl_begin/data/end, spi_flash_md5,
+erase_flash, erase_region and read_flash.
+
+The time a real device spends on the wire and on commands is simulated by:
+   byte_time       -- seconds per byte sent or received. None means the
+                      time of 10 bits at the current baud.
+   command_latency -- seconds spent on each command.
+   md5_rate        -- bytes per second hashed by spi_flash_md5.
+   max_baud        -- fastest baud that works; replies are lost above it.
+
+Usage:
+   python3 esp32simulator.py [--flash-size 4MB] [--byte-time 0]
+   The port of the simulated ESP32, e.g. /dev/pts/3, is printed. Ctrl+C ends
+   the simulation. To list it in the GUI's Port, start the GUI with
+   ESP32_EXTRA_PORTS=/dev/pts/3 python3 esp32flashwriter.py
+
+Pseudo-terminals have no DTR & RTS lines. esp32flashengine connects to a pty
+with esptool's 'no_reset' mode and does not hard reset it. The simulated
+ESP32 instead returns from the stub to the ROM loader when it is synced
+again, as a reset would.
+
+Repository: https://github.com/sunbearc22/ESP32FlashWriter
+'''
+
+import argparse
+import hashlib
+import os
+import pty
+import select
+import struct
+import threading
+import time
+import tty
+import zlib
+
+
+class SimulatedESP32(object):
+    '''ESP32 ROM & stub loader served on a pseudo-terminal.'''
+
+    # Commands, see esptool.ESPLoader
+    FLASH_BEGIN     = 0x02
+    FLASH_DATA      = 0x03
+    FLASH_END       = 0x04
+    MEM_BEGIN       = 0x05
+    MEM_END         = 0x06
+    MEM_DATA        = 0x07
+    SYNC            = 0x08
+    WRITE_REG       = 0x09
+    READ_REG        = 0x0a
+    SPI_SET_PARAMS  = 0x0b
+    SPI_ATTACH      = 0x0d
+    CHANGE_BAUDRATE = 0x0f
+    FLASH_DEFL_BEGIN = 0x10
+    FLASH_DEFL_DATA = 0x11
+    FLASH_DEFL_END  = 0x12
+    SPI_FLASH_MD5   = 0x13
+    ERASE_FLASH     = 0xd0
+    ERASE_REGION    = 0xd1
+    READ_FLASH      = 0xd2
+
+    STUB_ONLY = ( ERASE_FLASH, ERASE_REGION, READ_FLASH )
+
+    # Registers
+    UART_DATA_REG_ADDR = 0x60000078
+    DATE_REG_VALUE     = 0x15122500
+    EFUSE_REG_BASE     = 0x6001a000
+    SPI_REG_BASE       = 0x60002000
+    SPI_CMD_REG        = SPI_REG_BASE + 0x00
+    SPI_USR2_REG       = SPI_REG_BASE + 0x24
+    SPI_W0_REG         = SPI_REG_BASE + 0x80
+    SPI_CMD_USR        = 1 << 18
+
+    SPIFLASH_RDID = 0x9f
+    SECTOR_SIZE = 0x1000
+    FLASH_IDS = { '1MB':0x1440ef, '2MB':0x1540ef, '4MB':0x1640ef,
+                  '8MB':0x1740ef, '16MB':0x1840ef }
+    FLASH_SIZES = { '1MB':0x100000, '2MB':0x200000, '4MB':0x400000,
+                    '8MB':0x800000, '16MB':0x1000000 }
+
+    def __init__( self, flash_size='4MB', mac=(0x24,0x0a,0xc4,0x00,0x01,0x02),
+                  baud=115200, byte_time=None, command_latency=0.0,
+                  md5_rate=None, max_baud=None ):
+        self.flash = bytearray( b'\xff' * SimulatedESP32.FLASH_SIZES[flash_size] )
+        self.flash_id = SimulatedESP32.FLASH_IDS[flash_size]
+        self.mac = mac
+        self.baud = baud
+        self.byte_time = byte_time
+        self.command_latency = command_latency
+        self.md5_rate = md5_rate
+        self.max_baud = max_baud #Replies above it are lost, like a bad cable
+        self.is_stub = False
+        self.port = None         #Name of the pty, e.g. /dev/pts/3
+        self.commands = {}       #{op: count} of received commands
+        self.rx_bytes = 0        #Bytes received from the host
+        self.tx_bytes = 0        #Bytes sent to the host
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._running = False
+        self._regs = self._create_registers()
+        self._write = None       #State of flash_begin/flash_defl_begin
+        self._read = None        #State of read_flash
+
+
+    def _create_registers( self ):
+        m = self.mac
+        base = SimulatedESP32.EFUSE_REG_BASE
+        return { SimulatedESP32.UART_DATA_REG_ADDR: SimulatedESP32.DATE_REG_VALUE,
+                 base + 4: (m[2] << 24) | (m[3] << 16) | (m[4] << 8) | m[5],
+                 base + 8: (m[0] << 8) | m[1],
+                 base + 12: 0,
+                 base + 16: 0,
+                 base + 24: 0 }
+
+
+    #### Life cycle
+    def start( self ):
+        '''Open the pty and start serving commands. Returns the port name.'''
+        self._master, self._slave = pty.openpty()
+        tty.setraw( self._slave )
+        self.port = os.ttyname( self._slave )
+        self._running = True
+        self._thread = threading.Thread( target=self._serve, name='esp32sim',
+                                         daemon=True )
+        self._thread.start()
+        return self.port
+
+
+    def stop( self ):
+        self._running = False
+        if self._thread:
+            self._thread.join()
+        for fd in ( self._master, self._slave ):
+            if fd is not None:
+                os.close( fd )
+        self._master = self._slave = None
+
+
+    def __enter__( self ):
+        self.start()
+        return self
+
+
+    def __exit__( self, *exc ):
+        self.stop()
+
+
+    #### Wire
+    def _delay( self, nbytes ):
+        byte_time = self.byte_time
+        if byte_time is None:
+            byte_time = 10.0 / self.baud
+        if byte_time:
+            time.sleep( nbytes * byte_time )
+
+
+    def _send_packet( self, packet ):
+        if self.max_baud and self.baud > self.max_baud:
+            return
+        buf = b'\xc0' + packet.replace( b'\xdb', b'\xdb\xdd' ).replace( b'\xc0', b'\xdb\xdc' ) + b'\xc0'
+        self._delay( len(buf) )
+        self.tx_bytes += len(buf)
+        view = memoryview( buf )
+        while view:
+            n = os.write( self._master, view )
+            view = view[n:]
+
+
+    def _packets( self ):
+        '''Generator of the SLIP packets received from the host.'''
+        buf = b''
+        while self._running:
+            ready, _, _ = select.select( [self._master], [], [], 0.1 )
+            if not ready:
+                continue
+            try:
+                data = os.read( self._master, 65536 )
+            except OSError:
+                continue #host closed its end of the pty
+            self.rx_bytes += len(data)
+            self._delay( len(data) )
+            buf += data
+            while True:
+                start = buf.find( b'\xc0' )
+                if start < 0:
+                    buf = b'' #garbage between packets is ignored like the ROM does
+                    break
+                end = buf.find( b'\xc0', start + 1 )
+                if end < 0:
+                    buf = buf[start:]
+                    break
+                packet = buf[start+1:end]
+                buf = buf[end:] #a frame end may also start the next frame
+                if packet:
+                    yield packet.replace( b'\xdb\xdc', b'\xc0' ).replace( b'\xdb\xdd', b'\xdb' )
+
+
+    def _serve( self ):
+        for packet in self._packets():
+            if self._read is not None and len(packet) == 4:
+                self._read_ack( struct.unpack( '<I', packet )[0] )
+                continue
+            if len(packet) < 8 or packet[0] != 0:
+                continue
+            _, op, size, chk = struct.unpack( '<BBHI', packet[:8] )
+            data = packet[8:8+size]
+            self.commands[op] = self.commands.get( op, 0 ) + 1
+            if self.command_latency:
+                time.sleep( self.command_latency )
+            self._handle( op, data, chk )
+
+
+    def _reply( self, op, val=0, data=b'', error=0 ):
+        status_len = 2 if self.is_stub else 4
+        status = bytes( [1 if error else 0, error] ) + b'\x00' * ( status_len - 2 )
+        body = data + status
+        self._send_packet( struct.pack( '<BBHI', 1, op, len(body), val ) + body )
+
+
+    #### Commands
+    def _handle( self, op, data, chk ):
+        S = SimulatedESP32
+        if op in S.STUB_ONLY and not self.is_stub:
+            return self._reply( op, error=0x05 )
+        if op in ( S.FLASH_DATA, S.FLASH_DEFL_DATA, S.MEM_DATA ):
+            size = struct.unpack( '<I', data[:4] )[0]
+            payload = data[16:16+size]
+            if self._checksum( payload ) != chk:
+                return self._reply( op, error=0x07 ) #invalid checksum
+        if op == S.SYNC:
+            if self.is_stub:
+                # The host only syncs after resetting the chip, which a pty
+                # can't signal, so a sync to the stub resets to the ROM.
+                self.is_stub = False
+                self._write = None
+                self._read = None
+            for _ in range( 8 ):
+                self._reply( op, val=0x20120707 )
+        elif op == S.READ_REG:
+            addr = struct.unpack( '<I', data[:4] )[0]
+            self._reply( op, val=self._regs.get( addr, 0 ) )
+        elif op == S.WRITE_REG:
+            addr, value, mask, _ = struct.unpack( '<IIII', data[:16] )
+            old = self._regs.get( addr, 0 )
+            self._regs[addr] = ( old & ~mask ) | ( value & mask )
+            if addr == S.SPI_CMD_REG and value & S.SPI_CMD_USR:
+                self._run_spiflash_command()
+            self._reply( op )
+        elif op in ( S.MEM_BEGIN, S.MEM_DATA, S.SPI_SET_PARAMS, S.SPI_ATTACH ):
+            self._reply( op )
+        elif op == S.MEM_END:
+            self._reply( op )
+            if not self.is_stub:
+                self.is_stub = True
+                self._send_packet( b'OHAI' )
+        elif op == S.CHANGE_BAUDRATE:
+            baud = struct.unpack( '<I', data[:4] )[0]
+            self._reply( op )
+            self.baud = baud
+        elif op == S.FLASH_BEGIN:
+            erase_size, _, block_size, offset = struct.unpack( '<IIII', data[:16] )
+            self._begin( offset, erase_size, block_size, None )
+            self._reply( op )
+        elif op == S.FLASH_DEFL_BEGIN:
+            write_size, _, block_size, offset = struct.unpack( '<IIII', data[:16] )
+            self._begin( offset, write_size, block_size, zlib.decompressobj() )
+            self._reply( op )
+        elif op in ( S.FLASH_DATA, S.FLASH_DEFL_DATA ):
+            self._reply( op, error=self._data( op, data ) )
+        elif op in ( S.FLASH_END, S.FLASH_DEFL_END ):
+            self._write = None
+            self._reply( op )
+        elif op == S.SPI_FLASH_MD5:
+            addr, size = struct.unpack( '<II', data[:8] )
+            if self.md5_rate:
+                time.sleep( size / self.md5_rate )
+            digest = hashlib.md5( self.flash[addr:addr+size] )
+            if self.is_stub:
+                self._reply( op, data=digest.digest() )
+            else:
+                self._reply( op, data=digest.hexdigest().encode() )
+        elif op == S.ERASE_FLASH:
+            self.flash[:] = b'\xff' * len( self.flash )
+            self._reply( op )
+        elif op == S.READ_FLASH:
+            offset, size, block_size, in_flight = struct.unpack( '<IIII', data[:16] )
+            if offset + size > len( self.flash ):
+                return self._reply( op, error=0x0b )
+            self._reply( op )
+            self._read = { 'offset': offset, 'end': offset + size, 'cursor': offset,
+                           'block_size': block_size, 'window': block_size * in_flight,
+                           'acked': 0 }
+            self._read_ack( 0 )
+        elif op == S.ERASE_REGION:
+            offset, size = struct.unpack( '<II', data[:8] )
+            if offset % S.SECTOR_SIZE or size % S.SECTOR_SIZE:
+                return self._reply( op, error=0x02 )
+            self._erase( offset, size )
+            self._reply( op )
+        else:
+            self._reply( op, error=0x05 ) #unsupported command
+
+
+    @staticmethod
+    def _checksum( data ):
+        state = 0xef
+        for b in data:
+            state ^= b
+        return state
+
+
+    def _run_spiflash_command( self ):
+        S = SimulatedESP32
+        command = self._regs.get( S.SPI_USR2_REG, 0 ) & 0xff
+        if command == S.SPIFLASH_RDID:
+            self._regs[S.SPI_W0_REG] = self.flash_id
+        else:
+            self._regs[S.SPI_W0_REG] = 0
+        self._regs[S.SPI_CMD_REG] = 0 #command is done
+
+
+    def _read_ack( self, acked ):
+        '''Send the read_flash packets that fit in the window after acked
+        bytes and, once every byte is acked, the md5 of the region.'''
+        state = self._read
+        state['acked'] = acked
+        start = state['offset']
+        while ( state['cursor'] < state['end']
+                and state['cursor'] - start - acked < state['window'] ):
+            cursor = state['cursor']
+            end = min( cursor + state['block_size'], state['end'] )
+            self._send_packet( bytes( self.flash[cursor:end] ) )
+            state['cursor'] = end
+        if acked >= state['end'] - start:
+            self._send_packet( hashlib.md5( self.flash[start:state['end']] ).digest() )
+            self._read = None
+
+
+    def _erase( self, offset, size ):
+        '''Erase the sectors that hold [offset, offset+size).'''
+        start = offset - offset % SimulatedESP32.SECTOR_SIZE
+        end = min( len(self.flash), -(-( offset + size ) // SimulatedESP32.SECTOR_SIZE)
+                   * SimulatedESP32.SECTOR_SIZE )
+        if end > start:
+            self.flash[start:end] = b'\xff' * ( end - start )
+
+
+    def _begin( self, offset, size, block_size, decompressor ):
+        if size:
+            self._erase( offset, size )
+        self._write = { 'offset': offset, 'end': offset + size, 'cursor': offset,
+                        'block_size': block_size, 'seq': 0,
+                        'decompressor': decompressor }
+
+
+    def _data( self, op, data ):
+        '''Write a block to flash. Returns an error code or 0.'''
+        state = self._write
+        if state is None:
+            return 0x09 #not in flash mode
+        size, seq = struct.unpack( '<II', data[:8] )
+        if seq != state['seq']:
+            return 0x0a #bad sequence
+        state['seq'] += 1
+        payload = data[16:16+size]
+        if op == SimulatedESP32.FLASH_DEFL_DATA:
+            payload = state['decompressor'].decompress( payload )
+            payload = payload[:state['end'] - state['cursor']]
+        cursor = state['cursor']
+        if cursor + len(payload) > len( self.flash ):
+            return 0x0b #beyond end of flash
+        # NOR flash can only clear bits; an unerased sector shows up as corrupt data
+        end = cursor + len(payload)
+        old = int.from_bytes( self.flash[cursor:end], 'little' )
+        new = int.from_bytes( payload, 'little' )
+        self.flash[cursor:end] = ( old & new ).to_bytes( len(payload), 'little' )
+        state['cursor'] = cursor + len(payload)
+        return 0
+
+
+
+def main():
+    parser = argparse.ArgumentParser( description='Simulated ESP32 on a pty.' )
+    parser.add_argument( '--flash-size', default='4MB',
+                         choices=sorted( SimulatedESP32.FLASH_SIZES ) )
+    parser.add_argument( '--byte-time', type=float, default=None,
+                         help='seconds per byte, default is 10 bits at the baud' )
+    parser.add_argument( '--command-latency', type=float, default=0.0,
+                         help='seconds per command' )
+    parser.add_argument( '--md5-rate', type=float, default=None,
+                         help='bytes per second hashed by spi_flash_md5' )
+    parser.add_argument( '--max-baud', type=int, default=None,
+                         help='fastest baud that works, to try auto baud' )
+    args = parser.parse_args()
+
+    sim = SimulatedESP32( args.flash_size, byte_time=args.byte_time,
+                          command_latency=args.command_latency,
+                          md5_rate=args.md5_rate, max_baud=args.max_baud )
+    print( 'Simulated ESP32 on {}'.format( sim.start() ) )
+    try:
+        while True:
+            time.sleep( 1 )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.stop()
+
+
+if __name__ == '__main__':
+    main()
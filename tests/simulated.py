@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+'''Helpers of the tests that write and read an esp32simulator.SimulatedESP32.
+
+The simulated ESP32 runs on a pty, so the tests that import this module are
+skipped where there is no pty module, e.g. on Windows. The settings, image
+cache and metrics of a test are kept in a temporary ESP32FLASHWRITER_HOME.
+'''
+
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import esp32flashengine as engine
+try:
+    from esp32simulator import SimulatedESP32
+except ImportError: #No pty module, skips the tests that import this module
+    raise unittest.SkipTest( 'The simulated ESP32 needs a pty.' )
+
+
+def firmware( size, seed=1 ):
+    '''Return size bytes of which every 4 KB holds a random amount of random
+    bytes followed by zeros, which compresses about as well as firmware.'''
+    rng = random.Random( seed )
+    chunks = []
+    for offset in range( 0, size, 0x1000 ):
+        length = min( 0x1000, size - offset )
+        noise = rng.randrange( length + 1 )
+        chunks.append( rng.getrandbits( 8 * noise ).to_bytes( noise, 'little' ) if noise else b'' )
+        chunks.append( b'\x00' * ( length - noise ) )
+    return b''.join( chunks )
+
+
+def create_args( **options ):
+    '''Return the esp32flashengine.Args of a stub session at 921600 baud with
+    the attributes of options.'''
+    args = engine.Args()
+    args.chip = 'esp32'
+    args.no_stub = False
+    args.baud = 921600
+    args.verify = False
+    for name, value in options.items():
+        setattr( args, name, value )
+    return args
+
+
+def image_file( data, name='firmware.bin' ):
+    '''Return data as a file object for args.addr_filename.'''
+    argfile = io.BytesIO( data )
+    argfile.name = name
+    return argfile
+
+
+
+class WrongMd5(SimulatedESP32):
+    '''Answers every flash md5sum of the stub with a wrong digest.'''
+
+    def _handle( self, op, data, chk ):
+        if op == SimulatedESP32.SPI_FLASH_MD5 and self.is_stub:
+            return self._reply( op, data=b'\x00' * 16 )
+        return super()._handle( op, data, chk )
+
+
+
+class SimulatorTestCase(unittest.TestCase):
+    '''Starts the simulator of self.simulator() on self.port for each test.'''
+
+    def setUp( self ):
+        home = tempfile.mkdtemp()
+        self.addCleanup( shutil.rmtree, home, True )
+        environ = mock.patch.dict( os.environ, { 'ESP32FLASHWRITER_HOME': home } )
+        environ.start()
+        self.addCleanup( environ.stop )
+        self.sim = self.simulator()
+        self.port = self.sim.start()
+        self.addCleanup( self.sim.stop )
+
+
+    def simulator( self ):
+        return SimulatedESP32( byte_time=0 )
+
+
+    def connect( self, args ):
+        '''Return the esptool.ESP32StubLoader of a session with self.port.'''
+        esp = engine.setup_esp( engine.open_esp( self.port ), args )
+        self.addCleanup( esp._port.close )
+        return esp
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+'''esp32flashengine.write_flash() with args.delta only writes the sectors of
+a simulated ESP32 that differ from the image, and verifies the whole image.
+
+   python3 -m pytest tests
+'''
+
+import os
+import sys
+import unittest
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import esptool
+
+import esp32flashengine as engine
+from simulated import SimulatedESP32, SimulatorTestCase, WrongMd5, create_args, firmware, image_file
+
+
+ADDRESS = 0x10000
+SIZE = 0x80000
+SECTOR = esptool.ESPLoader.FLASH_SECTOR_SIZE
+
+
+class DeltaWriteTest(SimulatorTestCase):
+
+    def setUp( self ):
+        super().setUp()
+        self.data = bytearray( firmware( SIZE ) )
+
+
+    def write( self, **options ):
+        '''Write self.data and return its WriteResult and the data blocks sent.'''
+        options.setdefault( 'delta', True )
+        args = create_args( **options )
+        args.addr_filename = [ ( ADDRESS, image_file( bytes( self.data ) ) ) ]
+        esp = self.connect( args )
+        blocks = self._blocks()
+        result, = engine.write_flash( esp, args )
+        return result, self._blocks() - blocks
+
+
+    def _blocks( self ):
+        commands = self.sim.commands
+        return ( commands.get( SimulatedESP32.FLASH_DATA, 0 )
+                 + commands.get( SimulatedESP32.FLASH_DEFL_DATA, 0 ) )
+
+
+    def assertWritten( self, result ):
+        self.assertTrue( result.verified )
+        self.assertEqual( bytes( self.sim.flash[ ADDRESS:ADDRESS+SIZE ] ), bytes( self.data ) )
+
+
+    def test_unchanged_image_is_skipped( self ):
+        result, blocks = self.write()
+        self.assertWritten( result )
+        self.assertEqual( result.skipped, 0 ) #Erased flash differs everywhere
+        result, blocks = self.write()
+        self.assertWritten( result )
+        self.assertEqual( result.skipped, SIZE )
+        self.assertEqual( result.written, 0 )
+        self.assertEqual( blocks, 0 )
+
+
+    def test_only_changed_sectors_are_written( self ):
+        self.write()
+        self.data[ 5 * SECTOR + 10 ] ^= 0xff
+        self.data[ 40 * SECTOR:42 * SECTOR ] = os.urandom( 2 * SECTOR )
+        self.data[ -3: ] = b'end'
+        result, blocks = self.write()
+        self.assertWritten( result )
+        self.assertEqual( result.skipped, SIZE - 4 * SECTOR )
+        self.assertGreater( blocks, 0 )
+
+
+    def test_uncompressed( self ):
+        self.write( compress=False, no_compress=True )
+        self.data[ 7 * SECTOR ] ^= 0xff
+        result, blocks = self.write( compress=False, no_compress=True )
+        self.assertWritten( result )
+        self.assertEqual( result.skipped, SIZE - SECTOR )
+        self.assertEqual( blocks, 1 )
+
+
+    def test_streamed( self ):
+        self.write()
+        self.data[ 3 * SECTOR ] ^= 0xff
+        result, blocks = self.write( stream_compress=True )
+        self.assertWritten( result )
+        self.assertEqual( result.skipped, SIZE - SECTOR )
+
+
+    def test_compare_time_is_reported_apart( self ):
+        result, blocks = self.write()
+        self.assertGreater( result.compare_seconds, 0.0 )
+        result, blocks = self.write( delta=False )
+        self.assertEqual( result.compare_seconds, 0.0 )
+
+
+    def test_erase_all_writes_everything( self ):
+        self.write()
+        result, blocks = self.write( erase_all=True )
+        self.assertWritten( result )
+        self.assertEqual( result.skipped, 0 )
+
+
+
+class WrongMd5Test(SimulatorTestCase):
+
+    def simulator( self ):
+        return WrongMd5( byte_time=0 )
+
+
+    def test_write_is_not_verified( self ):
+        args = create_args( delta=True )
+        args.addr_filename = [ ( ADDRESS, image_file( firmware( SIZE ) ) ) ]
+        esp = self.connect( args )
+        with self.assertRaisesRegex( esptool.FatalError, 'MD5 of file does not match' ):
+            engine.write_flash( esp, args )
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+'''ESP32Device._drain_hotplug() refreshes the Port list on hot-plug events.
+
+Runs without a display: the method is called on a stand-in for the Tk
+widget.
+
+   python3 -m pytest tests
+'''
+
+import os
+import queue
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+from esp32flashwriter_v4_2 import ESP32Device
+from esp32hotplug import HotplugEvent
+
+
+def _device( port='-- please select --' ):
+    device = mock.Mock()
+    device._hotplug_events = queue.Queue()
+    device.port.get.return_value = port
+    device.monitor = None
+    device.busy = False
+    return device
+
+
+class DrainHotplugTest(unittest.TestCase):
+
+    def test_add_refreshes_ports( self ):
+        device = _device()
+        device._hotplug_events.put( HotplugEvent( HotplugEvent.ADD, '/dev/ttyUSB0' ) )
+        ESP32Device._drain_hotplug( device )
+        device._list_ports.assert_called_once_with()
+        device._unplugged.assert_not_called()
+        device.after.assert_called_once_with( 200, device._drain_hotplug )
+
+
+    def test_remove_of_selected_port( self ):
+        device = _device( '/dev/ttyUSB0' )
+        device._hotplug_events.put( HotplugEvent( HotplugEvent.REMOVE, '/dev/ttyUSB0' ) )
+        ESP32Device._drain_hotplug( device )
+        device._list_ports.assert_called_once_with()
+        device._unplugged.assert_called_once_with( '/dev/ttyUSB0' )
+
+
+    def test_no_event_keeps_ports( self ):
+        device = _device()
+        ESP32Device._drain_hotplug( device )
+        device._list_ports.assert_not_called()
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+'''esp32flashengine.read_flash() reads the flash of a simulated ESP32 and
+checks it against the md5 of the stub and the flash md5sum.
+
+   python3 -m pytest tests
+'''
+
+import hashlib
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import esptool
+
+import esp32flashengine as engine
+from simulated import SimulatedESP32, SimulatorTestCase, WrongMd5, create_args, firmware
+
+
+ADDRESS = 0x10000
+SIZE = 0x40000
+
+
+class CorruptRead(SimulatedESP32):
+    '''Flips a byte of the first read_flash packet, like a noisy line.'''
+
+    def _send_packet( self, packet ):
+        read = self._read
+        if read is not None and read['cursor'] == read['offset'] and len( packet ) == read['block_size']:
+            packet = bytes( [ packet[0] ^ 0xff ] ) + packet[1:]
+        super()._send_packet( packet )
+
+
+
+class ReadFlashTest(SimulatorTestCase):
+
+    def setUp( self ):
+        super().setUp()
+        self.data = firmware( SIZE )
+        self.sim.flash[ ADDRESS:ADDRESS+SIZE ] = self.data
+
+
+    def read( self, verify=True ):
+        args = create_args()
+        esp = self.connect( args )
+        outfile = io.BytesIO()
+        result = engine.read_flash( esp, args, ADDRESS, SIZE, outfile, verify=verify )
+        return result, outfile.getvalue()
+
+
+    def test_read_is_verified( self ):
+        result, data = self.read()
+        self.assertEqual( data, self.data )
+        self.assertEqual( result.md5, hashlib.md5( self.data ).hexdigest() )
+        self.assertTrue( result.verified )
+
+
+    def test_read_without_verify( self ):
+        result, data = self.read( verify=False )
+        self.assertEqual( data, self.data )
+        self.assertFalse( result.verified )
+        self.assertNotIn( SimulatedESP32.SPI_FLASH_MD5, self.sim.commands )
+
+
+
+class CorruptReadTest(ReadFlashTest):
+
+    def simulator( self ):
+        return CorruptRead( byte_time=0 )
+
+
+    def test_read_is_verified( self ):
+        with self.assertRaisesRegex( esptool.FatalError, 'Digest mismatch' ):
+            self.read()
+
+
+    def test_read_without_verify( self ):
+        #The md5 of the stub is checked even without verify
+        with self.assertRaisesRegex( esptool.FatalError, 'Digest mismatch' ):
+            self.read( verify=False )
+
+
+
+class WrongMd5Test(ReadFlashTest):
+
+    def simulator( self ):
+        return WrongMd5( byte_time=0 )
+
+
+    def test_read_is_verified( self ):
+        with self.assertRaisesRegex( esptool.FatalError, 'MD5 of flash does not match' ):
+            self.read()
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+'''esp32scheduler.FlashScheduler retries the jobs on a simulated ESP32 after
+a backoff, applies their options and fails those whose board never shows up.
+
+   python3 -m pytest tests
+'''
+
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import esp32scheduler
+from esp32scheduler import BoardNotFound, FlashJob, FlashScheduler
+from simulated import SimulatedESP32, SimulatorTestCase, create_args, firmware
+
+
+ADDRESS = 0x10000
+SIZE = 0x20000
+BACKOFF = 0.2
+
+
+class BadVerify(SimulatedESP32):
+    '''Answers the first failures flash md5sums of the stub with a wrong
+    digest and records the time of every flash_defl_begin.'''
+
+    def __init__( self, failures, **kwargs ):
+        super().__init__( **kwargs )
+        self.failures = failures
+        self.begins = []
+
+
+    def _handle( self, op, data, chk ):
+        if op == SimulatedESP32.FLASH_DEFL_BEGIN:
+            self.begins.append( time.time() )
+        if op == SimulatedESP32.SPI_FLASH_MD5 and self.is_stub and self.failures:
+            self.failures -= 1
+            return self._reply( op, data=b'\x00' * 16 )
+        return super()._handle( op, data, chk )
+
+
+
+class SchedulerTestCase(SimulatorTestCase):
+
+    def setUp( self ):
+        super().setUp()
+        poll = mock.patch.object( esp32scheduler, 'POLL_SECONDS', 0.05 )
+        poll.start()
+        self.addCleanup( poll.stop )
+        self.path = os.path.join( os.environ['ESP32FLASHWRITER_HOME'], 'app.bin' )
+        self.data = firmware( SIZE )
+        with open( self.path, 'wb' ) as f:
+            f.write( self.data )
+
+
+    def scheduler( self, **kwargs ):
+        kwargs.setdefault( 'workers', 1 )
+        kwargs.setdefault( 'backoff', BACKOFF )
+        scheduler = FlashScheduler( args=create_args(), find_ports=lambda: [ self.port ],
+                                    **kwargs )
+        self.addCleanup( scheduler.stop, True )
+        return scheduler
+
+
+    def run_jobs( self, scheduler, *jobs ):
+        for job in jobs:
+            scheduler.submit( job )
+        scheduler.start()
+        self.assertTrue( scheduler.join( timeout=30 ) )
+
+
+    def assertWritten( self ):
+        self.assertEqual( bytes( self.sim.flash[ ADDRESS:ADDRESS+SIZE ] ), self.data )
+
+
+
+class RetryTest(SchedulerTestCase):
+
+    def simulator( self ):
+        return BadVerify( 2, byte_time=0 )
+
+
+    def test_retry_after_backoff( self ):
+        scheduler = self.scheduler( retries=3 )
+        job = FlashJob( self.port, [ ( ADDRESS, self.path ) ] )
+        self.run_jobs( scheduler, job )
+        self.assertEqual( job.state, FlashJob.DONE )
+        self.assertEqual( job.attempts, 3 )
+        self.assertWritten()
+        stats = scheduler.stats()
+        self.assertEqual( ( stats['done'], stats['failed'], stats['retried'] ), ( 1, 0, 2 ) )
+        self.assertEqual( stats['failures'],
+                          { 'FatalError: MD5 of file does not match data in flash': 2 } )
+        #The backoff doubles for each attempt
+        first, second, third = self.sim.begins
+        self.assertGreaterEqual( second - first, BACKOFF )
+        self.assertGreaterEqual( third - second, 2 * BACKOFF )
+
+
+    def test_fail_after_retries( self ):
+        scheduler = self.scheduler( retries=1 )
+        job = FlashJob( self.port, [ ( ADDRESS, self.path ) ] )
+        self.run_jobs( scheduler, job )
+        self.assertEqual( job.state, FlashJob.FAILED )
+        self.assertEqual( job.attempts, 2 )
+        self.assertIn( 'MD5 of file does not match', str( job.error ) )
+        stats = scheduler.stats()
+        self.assertEqual( ( stats['done'], stats['failed'], stats['retried'] ), ( 0, 1, 1 ) )
+
+
+    def test_no_retry_of_a_lasting_error( self ):
+        scheduler = self.scheduler( retries=3 )
+        job = scheduler.submit( FlashJob( self.port, [ ( ADDRESS, self.path ) ] ) )
+        os.remove( self.path )
+        self.run_jobs( scheduler )
+        self.assertEqual( job.state, FlashJob.FAILED )
+        self.assertEqual( job.attempts, 1 )
+        self.assertIsInstance( job.error, FileNotFoundError )
+
+
+
+class OptionsTest(SchedulerTestCase):
+
+    def test_baud( self ):
+        job = FlashJob( self.port, [ ( ADDRESS, self.path ) ], { 'baud': 460800 } )
+        self.run_jobs( self.scheduler(), job )
+        self.assertEqual( job.state, FlashJob.DONE )
+        self.assertEqual( self.sim.baud, 460800 )
+        self.assertWritten()
+
+
+    def test_auto_baud( self ):
+        job = FlashJob( self.port, [ ( ADDRESS, self.path ) ],
+                        { 'baud': 'auto', 'compress_level': 'auto' } )
+        self.run_jobs( self.scheduler(), job )
+        self.assertEqual( job.state, FlashJob.DONE )
+        self.assertWritten()
+
+
+    def test_bad_options_are_rejected( self ):
+        scheduler = self.scheduler()
+        for options in ( { 'baud': 'fast' }, { 'baud': 0 }, { 'compress_level': 12 },
+                         { 'compress': 'yes' }, { 'bogus': 1 } ):
+            with self.assertRaises( ValueError ):
+                scheduler.submit( FlashJob( self.port, [ ( ADDRESS, self.path ) ], options ) )
+        self.assertEqual( scheduler.jobs, [] )
+
+
+    def test_no_compress( self ):
+        job = FlashJob( self.port, [ ( ADDRESS, self.path ) ], { 'no_compress': True } )
+        self.run_jobs( self.scheduler(), job )
+        self.assertEqual( job.state, FlashJob.DONE )
+        self.assertNotIn( SimulatedESP32.FLASH_DEFL_DATA, self.sim.commands )
+        self.assertWritten()
+
+
+
+class BoardTimeoutTest(SchedulerTestCase):
+
+    def test_missing_board_fails( self ):
+        scheduler = self.scheduler( board_timeout=0.3 )
+        missing = FlashJob( '24:0a:c4:ff:ff:ff', [ ( ADDRESS, self.path ) ] )
+        present = FlashJob( None, [ ( ADDRESS, self.path ) ] )
+        self.run_jobs( scheduler, missing, present )
+        self.assertEqual( present.state, FlashJob.DONE )
+        self.assertEqual( missing.state, FlashJob.FAILED )
+        self.assertIsInstance( missing.error, BoardNotFound )
+        self.assertEqual( missing.attempts, 0 )
+        self.assertEqual( scheduler.stats()['failed'], 1 )
+
+
+    def test_without_timeout_the_job_waits( self ):
+        scheduler = self.scheduler()
+        job = scheduler.submit( FlashJob( '/dev/nonexistent', [ ( ADDRESS, self.path ) ] ) )
+        scheduler.start()
+        self.assertFalse( scheduler.join( timeout=0.5 ) )
+        self.assertEqual( job.state, FlashJob.QUEUED )
+        scheduler.stop()
+        self.assertTrue( scheduler.join( timeout=5 ) )
+        self.assertEqual( job.state, FlashJob.CANCELLED )
+
+
+
+if __name__ == '__main__':
+    unittest.main()